@@ -1,21 +1,170 @@
 import argparse
 import os
 import shutil
+import signal
+import sys
 import logging
-import pandas as pd
-
-from .utils import (
-    reorient_to_lps,
-    run_DLWMLS,
-    register_flair_to_t1,
-    apply_saved_transform,
-    segment_multilabel_mask_and_calculate_volumes
+import threading
+import time
+from concurrent.futures import Executor
+from typing import Dict, List, Optional, Tuple
+
+# Only modules without heavy dependencies are imported here; pandas, nibabel
+# and SimpleITK are imported by the code paths that use them, so --help,
+# --version and argument errors return without loading them.
+from .instrumentation import configure, write_report
+from .manifest import (
+    STAGES,
+    load_manifest,
+    plan_stages,
+    stage_done,
+    start_subject,
+    subject_inputs
 )
+from .watch import watch
 
 VERSION = "0.0.1"
 
 
+def merge_main(argv: list) -> None:
+    """
+    Combines the shard outputs of a --shard run into the standard output layout.
+    """
+    parser = argparse.ArgumentParser(prog="NiChart_DLWMLS merge",
+                                     description="Merge the shard outputs of NiChart_DLWMLS --shard runs")
+    parser.add_argument('--out_dir', required=True, type=str, help="The output folder the shards were run with (REQUIRED)")
+    parser.add_argument('--list', type=str, default=None, help="List of MRIDs giving the row order of the cohort table (Default: sorted)")
+    parser.add_argument('--keep_shards', type=str, default='False', help="Copy the shard outputs and keep the shard folders (Default: False)")
+    args = parser.parse_args(argv)
+
+    import pandas as pd
+    from .shards import merge_shards
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(message)s')
+    mrids = pd.read_csv(args.list, dtype=str).iloc[:, 0].tolist() if args.list else None
+    merge_shards(args.out_dir, keep_shards=args.keep_shards.lower() == 'true', mrids=mrids)
+
+
+def convert_main(argv: list) -> None:
+    """
+    Converts the segmented masks of existing output folders between NIfTI and
+    the compact lesion voxel format.
+    """
+    parser = argparse.ArgumentParser(prog="NiChart_DLWMLS convert",
+                                     description="Convert the segmented masks of NiChart_DLWMLS output folders")
+    parser.add_argument('--out_dir', required=True, nargs='+', type=str, help="Output folders of NiChart_DLWMLS runs (REQUIRED)")
+    parser.add_argument('--to', type=str, default='sparse', choices=['sparse', 'nifti'], help="Format to convert the segmented masks to (Default: sparse)")
+    parser.add_argument('--keep_source', type=str, default='False', help="Keep the masks in the old format (Default: False)")
+    args = parser.parse_args(argv)
+
+    from .sparse_mask import convert_folder
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(message)s')
+    for out_dir in args.out_dir:
+        convert_folder(os.path.join(out_dir, 'DLWMLS_DLMUSE_Segmented'), args.to,
+                       keep_source=args.keep_source.lower() == 'true')
+
+
+def select_subjects(args: argparse.Namespace,
+                    shard: Optional[Tuple[int, int]]) -> Tuple[List[str], Dict[str, Dict[str, str]]]:
+    """
+    Indexes the input folders once and lists the subjects of the run.
+
+    Args:
+        args (argparse.Namespace): The command line arguments.
+        shard (tuple): (index, count) of the shard to process, or None for all subjects.
+
+    Returns:
+        tuple: (mrids, inputs). inputs is the index of every input kind, see preflight.index_dir.
+    """
+    import pandas as pd
+    from .preflight import index_dir
+    from .shards import partition
+
+    inputs = {
+        'fl': index_dir(args.fl_dir, args.fl_suff),
+        't1': index_dir(args.t1_dir, args.t1_suff),
+        'dlmuse': index_dir(args.dlmuse_dir, args.dlmuse_suff),
+    }
+    if args.list:
+        df_list = pd.read_csv(args.list, dtype=str)
+        mrids = df_list.iloc[:, 0].tolist()
+    else:
+        mrids = sorted(inputs['fl'])
+    if shard:
+        mrids = partition(mrids, inputs, shard[1])[shard[0]]
+    return mrids, inputs
+
+
+def process_subjects(mrids: List[str],
+                     layout: dict,
+                     params: dict,
+                     inference: dict,
+                     args: argparse.Namespace,
+                     isolate: bool = False,
+                     executor: Optional[Executor] = None) -> Tuple[Dict[str, List[str]], List[str]]:
+    """
+    Runs the pipeline on the subjects that are not up to date.
+
+    Args:
+        mrids (list): Subjects to process.
+        layout (dict): Input/output folders and file suffixes of the run.
+        params (dict): Parameters that change the results (see manifest.plan_stages).
+        inference (dict): Device and chunking options of the DLWMLS calls.
+        args (argparse.Namespace): The command line arguments.
+        isolate (bool): Also exclude the subjects that fail reorientation,
+                        instead of stopping the run.
+        executor (Executor): Long-lived pool of the per-subject stages.
+
+    Returns:
+        tuple: (plans, failed). plans maps every processed subject to the
+               stages it ran.
+    """
+    from .pipeline import infer_subjects, load_subject_images, postprocess_subject, reorient_subject, run_subjects
+    from .scheduler import run_overlapped
+
+    # Find the stages every subject has to run (none: up to date)
+    plans = {}
+    for mrid in mrids:
+        inputs = subject_inputs(mrid, layout, use_hash=args.fingerprint == 'hash')
+        stages = plan_stages(load_manifest(layout, mrid), inputs, params, layout, mrid)
+        if stages:
+            start_subject(layout, mrid, inputs, params, stages)
+            plans[mrid] = stages
+    logging.info(f"{len(mrids) - len(plans)} subjects up to date, {len(plans)} to process")
+    if not plans:
+        return plans, []
+
+    if args.overlap.lower() == 'true':
+        logging.info("Running the stages of every subject as soon as their inputs exist")
+        failed = run_overlapped(plans, layout, inference, jobs=args.jobs, executor=executor)
+    else:
+        logging.info("LPS Orienting and saving the images")
+        reorient_mrids = [m for m, s in plans.items() if 'reorient' in s]
+        failed = run_subjects(reorient_subject, reorient_mrids, layout, jobs=args.jobs,
+                              isolate=isolate, executor=executor)
+
+        logging.info("Processing DLWMLS on FLAIR folder")
+        dlwmls_mrids = [m for m, s in plans.items() if 'dlwmls' in s and m not in failed]
+        failed_dlwmls = infer_subjects(dlwmls_mrids, layout, **inference)
+        for mrid in failed_dlwmls:
+            print(f"{mrid} excluded due to missing DLWMLS mask")
+        failed += failed_dlwmls
+
+        logging.info("Creating transformation matrix from FL to T1, applying to the DLWMLS Masks")
+        failed += run_subjects(postprocess_subject, [m for m in plans if m not in failed], layout,
+                               jobs=args.jobs, executor=executor, load=load_subject_images)
+    return plans, failed
+
+
 def main() -> None:
+    if len(sys.argv) > 1 and sys.argv[1] == 'merge':
+        merge_main(sys.argv[2:])
+        return
+    if len(sys.argv) > 1 and sys.argv[1] == 'convert':
+        convert_main(sys.argv[2:])
+        return
+
     prog = "NiChart_DLWMLS"
     description = "NiCHART White Matter Lesion Segmentation Pipeline"
     usage = """
@@ -25,19 +174,122 @@ def main() -> None:
     Required arguments:
         [-fl, --fl_dir] : Name of the input folder with FL scans  (REQUIRED)
         [-o, --out_dir] : Name of the output folder for segmentation (REQUIRED)
-        [--list]        List of MRIDs; first raw (column header) skipped (OPTIONAL)
+        [--list]        List of MRIDs; first raw (column header) skipped (OPTIONAL,
+                        DEFAULT: every FLAIR scan with the FLAIR suffix in the FLAIR folder)
         [--t1_dir]      Name of the input folder with T1 scans  (OPTIONAL)
         [--t1_suff]     Suffix of the input T1 scans (OPTIONAL, DEFAULT: _T1.nii.gz)
         [--dlmuse_dir]  Name of the input folder with T1 scans  (OPTIONAL)
         [--dlmuse_suff] Suffix of the input T1 scans (OPTIONAL, DEFAULT: _T1_LPS_DLMUSE.nii.gz)
     
     Optional arguments:
-        [-r, --remove_intermediate]  Remove all intermediate files. (DEFAULT: True)
+        [-r, --remove_intermediate]  Remove all intermediate files. With 'False' the
+                        transforms (TFMs) and the DLWMLS masks in T1 space
+                        (DLWMLS_TFM_to_T1) are also written (DEFAULT: True)
         [-d, --device]  Device to run segmentation ('cuda' (GPU), 'cpu' (CPU) or 
                         'mps' (Apple M-series chips supporting 3D CNN))
+        [-j, --jobs]    Number of worker processes for the per-subject stages (DEFAULT: 1)
+        [--incremental] Keep the output folder and only process subjects whose inputs
+                        or settings changed, or that did not finish. Only the stages a change
+                        affects are rerun: with -r True the LPS T1 images, the DLWMLS masks and
+                        the transforms (TFMs) are kept for that, so DLWMLS only runs again for
+                        a new FLAIR image or device, and registration for new images or
+                        registration settings (DEFAULT: False)
+        [--reg_preset]  FLAIR to T1 registration preset: 'default', 'fast' (multi-resolution)
+                        or 'accurate' (multi-resolution with rigid initialization) (DEFAULT: default)
+        [--reg_iterations]  Gradient-descent iterations per level (DEFAULT: from preset)
+        [--reg_sampling]    Fraction of voxels sampled by the metric (DEFAULT: from preset)
+        [--reg_threads]     Threads per registration (DEFAULT: from preset, 0 for all)
+        [--reg_seed]        Seed of the metric sampling, for reproducible transforms (DEFAULT: random)
+        [--tfm_cache_dir]     Folder of a persistent FLAIR to T1 transform cache, shared
+                              between runs and keyed by the content of the T1 and FLAIR
+                              images and the registration settings (DEFAULT: none)
+        [--tfm_cache_size_mb] Size cap of the transform cache; the least recently used
+                              transforms are evicted beyond it (DEFAULT: 1024, 0 for no cap)
+        [--prefetch_depth] Number of subjects whose T1, FLAIR, DLWMLS and DLMUSE images
+                        are read and decoded in background threads while the current
+                        subject is registered and split, with --jobs 1 (with more jobs
+                        the workers already overlap reads and compute) (DEFAULT: 1,
+                        0 to disable)
+        [--prefetch_memory_mb] Memory cap of the read-ahead images; no further subject
+                        is read ahead beyond it (DEFAULT: 2048, 0 for no cap)
+        [--shard]       Process only shard i of N (0 <= i < N) of the subjects, balanced by
+                        input size, into <out_dir>/shards/shard_<i>_of_<N> (e.g. one SLURM
+                        array task per shard); combine the shards afterwards with
+                        'NiChart_DLWMLS merge --out_dir <out_dir>' (DEFAULT: all subjects)
+        [--preflight]   Check the headers of every subject's inputs (existence, dimensions,
+                        T1/DLMUSE grids) before any processing and exclude the subjects
+                        that would fail (DEFAULT: True)
+        [--watch]       Keep running as a service: poll the input folders (and the --list
+                        file, re-read at every poll, e.g. as a queue file a scanner appends
+                        to) and process every subject as soon as its FLAIR, T1 and DLMUSE
+                        images are complete, with the libraries and the worker pool kept
+                        loaded between batches. Results are written in place (as with
+                        --incremental); stop with Ctrl-C or SIGTERM (DEFAULT: False)
+        [--watch_interval] Seconds between polls; inputs count as complete once they
+                        were not modified for this long (DEFAULT: 10)
+        [--fingerprint] How inputs are compared between runs: 'mtime' (size and
+                        modification time) or 'hash' (sha256 of the content) (DEFAULT: mtime)
+        [--overlap]     Start registration while DLWMLS inference is still running and
+                        split each mask as soon as its inference chunk finishes (DEFAULT: False)
+        [--dlwmls_chunk_size] Number of subjects per DLWMLS call (DEFAULT: 0, all in one call)
+        [--dlwmls_timeout]    Seconds after which a DLWMLS call is killed (DEFAULT: 0, no limit)
+        [--dlwmls_retries]    Number of times a failed DLWMLS chunk is run again (DEFAULT: 1)
+        [--inference_workers] Number of concurrent DLWMLS processes, each on its own
+                              shard of the FLAIR images (DEFAULT: 1)
+        [--inference_threads] Threads per DLWMLS process (DEFAULT: 0, cores split
+                              evenly between the inference workers)
+        [--intermediate_ext] Format of the intermediate images the pipeline writes (T1_LPS,
+                             DLWMLS_TFM_to_T1): '.nii.gz' or '.nii' (uncompressed, faster
+                             to write and read). FLAIR_LPS and the DLWMLS masks stay
+                             '.nii.gz' as DLWMLS reads and writes them (DEFAULT: .nii.gz)
+        [--intermediate_compresslevel] gzip level (1-9) of the gzipped intermediate
+                             images (DEFAULT: library default)
+        [--segmented_format] Format of the segmented masks: 'nifti' (.nii.gz) or 'sparse'
+                           (.npz with only the lesion voxels, as run-length encoded
+                           labels with the affine, shape and header; many times smaller
+                           and faster to load, see NiChart_DLWMLS.sparse_mask.load_sparse)
+                           (DEFAULT: nifti)
+        [--cohort_table]   Also write the ROI volumes of all subjects to one table,
+                           DLWMLS_DLMUSE_Segmented_Volumes.csv, with a column for
+                           every label of the label list (DEFAULT: True)
+        [--cohort_parquet] Also write the cohort table as Parquet (needs pyarrow) (DEFAULT: False)
+        [--label_list]     CSV with the label columns of the cohort table in its first
+                           column (DEFAULT: the packaged MUSE ROI list)
+        [--cohort_store]   Also append the lesion mask (in T1 space) and the segmented map
+                           of every subject, as it finishes, to an uncompressed memory-
+                           mapped cohort array store, DLWMLS_Cohort_Store, with a
+                           subject index, for group analyses such as voxelwise lesion
+                           frequency (see NiChart_DLWMLS.cohort_store) (DEFAULT: False)
+        [--composite_rois] Also report the lesion volumes of composite ROIs (lobes,
+                           hemispheres, deep GM, WM, ventricles...), summed from the
+                           single ROI volumes, after the single ROI columns of the
+                           volume CSVs and the cohort table. The Periventricular_WM and
+                           Deep_WM composites split the WM lesions by their distance to
+                           the lateral ventricles (10 mm or less: periventricular). The
+                           composite columns are named by index (1001 to 1059 for the
+                           packaged list); their names are written to
+                           DLWMLS_DLMUSE_Composite_ROIs.csv (columns Index, Name) in the
+                           output folder (DEFAULT: True)
+        [--composite_list] CSV mapping the labels to the composite ROIs, one row per
+                           member (columns Index, Name, Label; a member may be another
+                           composite) (DEFAULT: the packaged MUSE composite ROIs)
+        [--report]      Write a run report with the wall time, CPU time, peak memory (of the
+                        stage, and of the process so far) and I/O of every stage of every
+                        subject, including the input loading, the time, final metric and
+                        iterations of every registration, and cohort percentiles, to
+                        run_report.json and run_report.csv in the output folder (DEFAULT: False)
+        [--profile_stage] Run a stage ('reorient', 'dlwmls', 'register', 'apply' or
+                          'segment') under cProfile; the profiles are written to the
+                          profiles folder of the output folder (DEFAULT: none)
         [-h, --help]    Show this help message and exit.
         [-V, --version] Show program's version number and exit.
         
+    Subcommands:
+        merge           Combine the outputs of --shard runs:
+                        NiChart_DLWMLS merge --out_dir <out_dir> [--list <list>] [--keep_shards True]
+        convert         Convert the segmented masks of existing output folders:
+                        NiChart_DLWMLS convert --out_dir <out_dir> [<out_dir> ...] [--to sparse|nifti] [--keep_source True]
+
     EXAMPLE USAGE:
 
         Executing the full pipeline including seperating WMLS mask into Brain ROI level 
@@ -66,7 +318,7 @@ def main() -> None:
     
     parser.add_argument('--out_dir', required=True, type=str, help='Name of the output folder for segmentation (REQUIRED)')
     
-    parser.add_argument('--list', type=str, default=None, help='List of MRIDs; first row (column header) skipped (OPTIONAL)')
+    parser.add_argument('--list', type=str, default=None, help='List of MRIDs; first row (column header) skipped (OPTIONAL, DEFAULT: all FLAIR scans)')
     
     parser.add_argument('--t1_dir', required=True, type=str, default=None, help='Name of the input folder with T1 scans (OPTIONAL)')
     parser.add_argument('--t1_suff', type=str, default='_T1.nii.gz', help='Suffix of the input T1 scans (OPTIONAL, DEFAULT: _T1.nii.gz)')
@@ -75,6 +327,39 @@ def main() -> None:
     parser.add_argument('--dlmuse_suff', type=str, default='_T1_LPS_DLMUSE.nii.gz', help='Suffix of the input DLMUSE masks (OPTIONAL, DEFAULT: _T1_LPS_DLMUSE.nii.gz)')
     parser.add_argument('-r', '--remove_intermediate', type=str, default='True', help="Remove all intermediate files (Default: True)")
     parser.add_argument('-d', '--device', type=str, default="cuda", help="Device to run segmentation ('cuda' (GPU), 'cpu' (CPU) or 'mps' (Apple M-series chips supporting 3D CNN))")
+    parser.add_argument('-j', '--jobs', type=int, default=1, help="Number of worker processes for the per-subject stages (Default: 1)")
+    parser.add_argument('--incremental', type=str, default='False', help="Keep the output folder and only process new, changed or unfinished subjects (Default: False)")
+    parser.add_argument('--overlap', type=str, default='False', help="Overlap registration with DLWMLS inference (Default: False)")
+    parser.add_argument('--dlwmls_chunk_size', type=int, default=0, help="Number of subjects per DLWMLS call (Default: 0, all in one call)")
+    parser.add_argument('--dlwmls_timeout', type=float, default=0, help="Seconds after which a DLWMLS call is killed (Default: 0, no limit)")
+    parser.add_argument('--dlwmls_retries', type=int, default=1, help="Number of times a failed DLWMLS chunk is run again (Default: 1)")
+    parser.add_argument('--inference_workers', type=int, default=1, help="Number of concurrent DLWMLS processes (Default: 1)")
+    parser.add_argument('--inference_threads', type=int, default=0, help="Threads per DLWMLS process (Default: 0, cores split evenly between the workers)")
+    parser.add_argument('--reg_preset', type=str, default='default', choices=['default', 'fast', 'accurate'], help="FLAIR to T1 registration preset (Default: default)")
+    parser.add_argument('--reg_iterations', type=int, default=None, help="Gradient-descent iterations per level (Default: from preset)")
+    parser.add_argument('--reg_sampling', type=float, default=None, help="Fraction of voxels sampled by the metric (Default: from preset)")
+    parser.add_argument('--reg_threads', type=int, default=None, help="Threads per registration (Default: from preset, 0 for all)")
+    parser.add_argument('--reg_seed', type=int, default=None, help="Seed of the metric sampling (Default: random)")
+    parser.add_argument('--intermediate_ext', type=str, default='.nii.gz', choices=['.nii.gz', '.nii'], help="Format of the intermediate images (Default: .nii.gz)")
+    parser.add_argument('--intermediate_compresslevel', type=int, default=None, choices=range(1, 10), metavar='[1-9]', help="gzip level of the gzipped intermediate images (Default: library default)")
+    parser.add_argument('--segmented_format', type=str, default='nifti', choices=['nifti', 'sparse'], help="Format of the segmented masks: 'nifti' or 'sparse' (Default: nifti)")
+    parser.add_argument('--cohort_table', type=str, default='True', help="Write the ROI volumes of all subjects to one table (Default: True)")
+    parser.add_argument('--cohort_parquet', type=str, default='False', help="Also write the cohort table as Parquet (Default: False)")
+    parser.add_argument('--label_list', type=str, default=None, help="CSV with the label columns of the cohort table (Default: the packaged MUSE ROI list)")
+    parser.add_argument('--cohort_store', type=str, default='False', help="Also append the lesion masks and segmented maps to a memory-mapped cohort store (Default: False)")
+    parser.add_argument('--composite_rois', type=str, default='True', help="Also report the volumes of composite ROIs (Default: True)")
+    parser.add_argument('--composite_list', type=str, default=None, help="CSV mapping the labels to the composite ROIs (Default: the packaged MUSE composite ROIs)")
+    parser.add_argument('--report', type=str, default='False', help="Write a per-stage timing and resource report of the run (Default: False)")
+    parser.add_argument('--profile_stage', type=str, default=None, choices=STAGES, help="Stage to run under cProfile (Default: none)")
+    parser.add_argument('--tfm_cache_dir', type=str, default='', help="Folder of a persistent transform cache (Default: none)")
+    parser.add_argument('--tfm_cache_size_mb', type=float, default=1024, help="Size cap of the transform cache in MB (Default: 1024, 0 for no cap)")
+    parser.add_argument('--prefetch_depth', type=int, default=1, help="Subjects whose inputs are read ahead in the background (Default: 1, 0 to disable)")
+    parser.add_argument('--prefetch_memory_mb', type=float, default=2048, help="Memory cap of the read-ahead inputs in MB (Default: 2048, 0 for no cap)")
+    parser.add_argument('--shard', type=str, default=None, help="Process only shard i/N of the subjects (Default: all subjects)")
+    parser.add_argument('--preflight', type=str, default='True', help="Check the input headers and exclude failing subjects before processing (Default: True)")
+    parser.add_argument('--watch', type=str, default='False', help="Keep running and process new or changed subjects as their inputs appear (Default: False)")
+    parser.add_argument('--watch_interval', type=float, default=10, help="Seconds between polls of the input folders in watch mode (Default: 10)")
+    parser.add_argument('--fingerprint', type=str, default='mtime', choices=['mtime', 'hash'], help="How inputs are compared between runs: 'mtime' or 'hash' (Default: mtime)")
     
     parser.add_argument('-h', '--help', action='help', default=argparse.SUPPRESS, help='Show this help message and exit.')
     
@@ -82,12 +367,17 @@ def main() -> None:
 
     args = parser.parse_args()
 
-    # For demonstration, print the parsed arguments (remove or replace with pipeline logic as needed)
-    print('Parsed arguments:')
-    for arg, value in vars(args).items():
-        print(f'  {arg}: {value}')
+    from .cohort_store import COHORT_STORE_NAME
+    from .cohort_table import COHORT_TABLE_NAME, finalize_table, load_label_list
+    from .composite_rois import COMPOSITE_NAMES_NAME, DEFAULT_COMPOSITE_LIST, load_composites, write_composite_names
+    from .manifest import hash_file
+    from .pipeline import remove_subject_intermediates, subject_pool
+    from .preflight import preflight
+    from .shards import parse_shard, shard_dir
+    from .utils import nifti_suffix, registration_settings, result_settings
 
     logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(message)s')
+    logging.debug('Parsed arguments: %s', vars(args))
 
     # Suffixes to verify input files
     t1_image_suffix = args.t1_suff
@@ -95,25 +385,37 @@ def main() -> None:
     t1_path = args.t1_dir
     fl_path = args.fl_dir
     output_directory = args.out_dir
+    shard = parse_shard(args.shard) if args.shard else None
+    if shard:
+        # Every shard owns its sub-tree, so array tasks never touch each other's files
+        output_directory = shard_dir(args.out_dir, *shard)
     dlmuse_directory = args.dlmuse_dir
     dlmuse_suffix = args.dlmuse_suff
     # Suffixes for intermediate files
+    # (FLAIR_LPS and DLWMLS stay .nii.gz: they are the DLWMLS input and output)
+    t1_lps_suffix = nifti_suffix(t1_image_suffix, args.intermediate_ext)
     dlwmls_suffix = '_FL_LPS_DLWMLS.nii.gz'
     fl_to_t1_xfm_suffix = '_FL_to_T1.tfm'
-    dlwmls_to_t1_reg_suffix = '_DLWMLS_REG_to_T1.nii.gz'
-    dlwmls_dlmuse_segmented_suffix = "_DLWMLS_DLMUSE_Segmented.nii.gz"
+    dlwmls_to_t1_reg_suffix = nifti_suffix('_DLWMLS_REG_to_T1', args.intermediate_ext)
+    dlwmls_dlmuse_segmented_suffix = "_DLWMLS_DLMUSE_Segmented" + ('.npz' if args.segmented_format == 'sparse' else '.nii.gz')
     dlwmls_roi_volume_csv_suffix = '_DLWMLS_DLMUSE_Segmented_Volumes.csv'
 
     # Other args
     remove_intermediate = args.remove_intermediate.lower() == 'true'
+    incremental = args.incremental.lower() == 'true'
+    cohort_table = args.cohort_table.lower() == 'true'
+    composites = load_composites(args.composite_list) if args.composite_rois.lower() == 'true' else None
+    watching = args.watch.lower() == 'true'
     
     if not os.path.exists(output_directory):
-        logging.warning(f"Output folder '{output_directory}' not found. Creating '{output_directory}'")
-        os.mkdir(output_directory)
+        logging.warning(f"Output folder {output_directory!r} not found. Creating {output_directory!r}")
+        os.makedirs(output_directory)
+    elif incremental or watching:
+        logging.warning(f"Output folder {output_directory!r} found. Reusing results of up-to-date subjects")
     else:
         shutil.rmtree(output_directory)
         logging.warning(f"Output folder '{output_directory}' found. Removing existing files and re-creating '{output_directory}'")
-        os.mkdir(output_directory)
+        os.makedirs(output_directory)
 
     flair_lps_path = os.path.join(output_directory, 'FLAIR_LPS')
     t1_lps_path = os.path.join(output_directory, 'T1_LPS')
@@ -122,64 +424,176 @@ def main() -> None:
     dlwmls_tfmed = os.path.join(output_directory,'DLWMLS_TFM_to_T1')
     dlwmls_dlmuse_segmented_path = os.path.join(output_directory,'DLWMLS_DLMUSE_Segmented')
     
-    os.mkdir(flair_lps_path)
-    os.mkdir(t1_lps_path)
-    os.mkdir(dlwmls_path)
-    os.mkdir(tfm_path)
-    os.mkdir(dlwmls_tfmed)
-    os.mkdir(dlwmls_dlmuse_segmented_path)
+    os.makedirs(flair_lps_path, exist_ok=True)
+    os.makedirs(t1_lps_path, exist_ok=True)
+    os.makedirs(dlwmls_path, exist_ok=True)
+    os.makedirs(tfm_path, exist_ok=True)
+    os.makedirs(dlwmls_tfmed, exist_ok=True)
+    os.makedirs(dlwmls_dlmuse_segmented_path, exist_ok=True)
+    if composites:
+        write_composite_names(composites, os.path.join(output_directory, COMPOSITE_NAMES_NAME + '.csv'))
 
-    df_list = pd.read_csv(args.list)
-    mrids = df_list.iloc[:, 0].tolist()
+    mrids, inputs = select_subjects(args, shard)
+    if not args.list:
+        logging.info(f"No list given: found {len(mrids)} FLAIR scans in {fl_path}")
+    if shard:
+        logging.info(f"Shard {shard[0]}/{shard[1]}: {len(mrids)} subjects")
+
+    report = args.report.lower() == 'true'
+    records_path = os.path.join(output_directory, 'run_report_records')
+    if os.path.exists(records_path):
+        shutil.rmtree(records_path)
+    configure(records_dir=records_path if report or args.profile_stage else None,
+              profile_stage=args.profile_stage,
+              profile_dir=os.path.join(output_directory, 'profiles'))
+    run_start = time.perf_counter()
 
     #####################################################
     ########## START NiChart_DLWMLS Pipeline ############
     #####################################################
 
-    logging.info(f"LPS Orienting and saving the images")
-    for mrid in mrids:
-        # Reorient T1
-        reorient_to_lps(input_path=os.path.join(t1_path, mrid + t1_image_suffix),
-                        output_path=os.path.join(t1_lps_path, mrid + t1_image_suffix))
-        # Reorient FLAIR
-        reorient_to_lps(input_path=os.path.join(fl_path, mrid + fl_image_suffix),
-                        output_path=os.path.join(flair_lps_path, mrid + fl_image_suffix))
-        
-    logging.info(f"Processing DLWMLS on FLAIR folder")
-    # Check if the folder exists
-    
-    run_DLWMLS(in_dir=flair_lps_path, 
-               out_dir=dlwmls_path,
-               device=args.device)
+    layout = {
+        'out_dir': output_directory,
+        't1_dir': t1_path,
+        'fl_dir': fl_path,
+        'dlmuse_dir': dlmuse_directory,
+        't1_lps_dir': t1_lps_path,
+        'flair_lps_dir': flair_lps_path,
+        'dlwmls_dir': dlwmls_path,
+        'tfm_dir': tfm_path,
+        'dlwmls_tfmed_dir': dlwmls_tfmed,
+        'segmented_dir': dlwmls_dlmuse_segmented_path,
+        't1_suff': t1_image_suffix,
+        'fl_suff': fl_image_suffix,
+        'dlmuse_suff': dlmuse_suffix,
+        't1_lps_suff': t1_lps_suffix,
+        'dlwmls_suff': dlwmls_suffix,
+        'fl_to_t1_xfm_suff': fl_to_t1_xfm_suffix,
+        'dlwmls_to_t1_reg_suff': dlwmls_to_t1_reg_suffix,
+        'dlwmls_dlmuse_segmented_suff': dlwmls_dlmuse_segmented_suffix,
+        'dlwmls_roi_volume_csv_suff': dlwmls_roi_volume_csv_suffix,
+        'manifest': True,
+        'keep_intermediate': not remove_intermediate,
+        # Reruns of the later stages (e.g. for a new DLMUSE map) reuse the transforms
+        'keep_transforms': not remove_intermediate or incremental or watching,
+        'compresslevel': args.intermediate_compresslevel,
+        'tfm_cache_dir': args.tfm_cache_dir,
+        'tfm_cache_max_bytes': int(args.tfm_cache_size_mb * 1024 * 1024),
+        'prefetch': {'depth': args.prefetch_depth, 'max_bytes': int(args.prefetch_memory_mb * 1024 * 1024)},
+        'registration': registration_settings(args.reg_preset,
+                                              iterations=args.reg_iterations,
+                                              sampling_percentage=args.reg_sampling,
+                                              threads=args.reg_threads,
+                                              seed=args.reg_seed),
+        'cohort_table': os.path.join(output_directory, COHORT_TABLE_NAME + '.csv') if cohort_table else '',
+        'labels': load_label_list(args.label_list) + (composites['indices'] if composites else []) if cohort_table else None,
+        'composites': composites,
+        'cohort_store': os.path.join(output_directory, COHORT_STORE_NAME) if args.cohort_store.lower() == 'true' else '',
+    }
 
-    
-    logging.info(f"Creating transformation matrix from FL to T1, applying to the DLWMLS Masks")
-    for mrid in mrids:
+    # Parameters that change the results; a change invalidates the manifest
+    params = {
+        'version': VERSION,
+        'device': args.device,
+        'registration': result_settings(layout['registration']),
+        'dlmuse_suff': dlmuse_suffix,
+        'composites': hash_file(args.composite_list or DEFAULT_COMPOSITE_LIST) if composites else None,
+    }
+
+    inference = {
+        'device': args.device,
+        'chunk_size': args.dlwmls_chunk_size,
+        'timeout': args.dlwmls_timeout if args.dlwmls_timeout > 0 else None,
+        'retries': args.dlwmls_retries,
+        'workers': args.inference_workers,
+        'threads': args.inference_threads,
+    }
+
+    processed: List[str] = []
+    failed: List[str] = []
+    excluded: Dict[str, str] = {}
+
+    def process(batch: List[str]) -> None:
+        # The stages take the input paths from the index instead of the folders
+        layout['inputs'] = inputs
+        # Exclude subjects with missing or mismatched inputs before any heavy work
+        if args.preflight.lower() == 'true':
+            errors = preflight(batch, inputs)
+            for mrid, error in errors.items():
+                print(f"{mrid} excluded due to {error}")
+            for mrid in batch:
+                excluded.pop(mrid, None)
+            excluded.update(errors)
+            batch = [m for m in batch if m not in errors]
+        plans, batch_failed = process_subjects(batch, layout, params, inference, args,
+                                               isolate=watching, executor=executor)
+        processed.extend(plans)
+        failed.extend(batch_failed)
+
+        if cohort_table:
+            finished = [m for m in mrids if m not in excluded and stage_done(layout, m, 'segment')]
+            subject_csv = {m: os.path.join(output_directory, m + dlwmls_roi_volume_csv_suffix) for m in finished}
+            finalize_table(layout['cohort_table'], layout['labels'], finished, subject_csv,
+                           parquet=args.cohort_parquet.lower() == 'true')
+
+        if remove_intermediate and (incremental or watching):
+            # Keep the intermediates of unfinished subjects so a rerun can resume them
+            for mrid in batch:
+                if stage_done(layout, mrid, 'segment'):
+                    remove_subject_intermediates(mrid, layout)
+
+    executor = None
+    if watching:
+        def scan() -> Tuple[List[str], Dict[str, Dict[str, str]]]:
+            nonlocal mrids, inputs
+            mrids, inputs = select_subjects(args, shard)
+            return mrids, inputs
+
+        stop = threading.Event()
+        main_pid = os.getpid()
+
+        def request_stop(signum: int, frame: object) -> None:
+            # Pool workers inherit the handler: they finish their subject, and the
+            # main process stops once the batch is done
+            if os.getpid() == main_pid:
+                logging.warning("Stopping after the current batch")
+                stop.set()
+        signal.signal(signal.SIGINT, request_stop)
+        signal.signal(signal.SIGTERM, request_stop)
+
+        # The libraries stay loaded in this process and in the workers between batches
+        if args.jobs > 1 or args.overlap.lower() == 'true':
+            executor = subject_pool(args.jobs)
         try:
-            register_flair_to_t1(t1_image_path=os.path.join(t1_lps_path, mrid + t1_image_suffix),
-                                flair_image_path=os.path.join(flair_lps_path, mrid + fl_image_suffix),
-                                output_path=os.path.join(tfm_path, mrid+fl_to_t1_xfm_suffix))
-            
-            apply_saved_transform(fixed_image_path=os.path.join(t1_lps_path, mrid + t1_image_suffix),
-                                moving_image_path=os.path.join(dlwmls_path, mrid + dlwmls_suffix),
-                                transform_path=os.path.join(tfm_path, mrid + fl_to_t1_xfm_suffix),
-                                output_image_path=os.path.join(dlwmls_tfmed, mrid + dlwmls_to_t1_reg_suffix))
-            
-            segment_multilabel_mask_and_calculate_volumes(mask_a_path=os.path.join(dlwmls_tfmed, mrid + dlwmls_to_t1_reg_suffix),
-                                                        mask_b_path=os.path.join(dlmuse_directory, mrid + dlmuse_suffix),
-                                                        output_path=os.path.join(dlwmls_dlmuse_segmented_path, mrid + dlwmls_dlmuse_segmented_suffix),
-                                                        save_as_csv=True,
-                                                        csv_path=os.path.join(output_directory, mrid + dlwmls_roi_volume_csv_suffix),
-                                                        mrid = mrid)
-        except Exception as e:
-            print(f"{mrid} excluded due to {e}")
-
-    if remove_intermediate:
-        shutil.rmtree(flair_lps_path)
-        shutil.rmtree(t1_lps_path)
-        shutil.rmtree(dlwmls_path)
-        shutil.rmtree(tfm_path)
-        shutil.rmtree(dlwmls_tfmed)
+            watch(scan, process, interval=args.watch_interval, stop=stop)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+    else:
+        process(mrids)
+        if remove_intermediate and not incremental:
+            shutil.rmtree(flair_lps_path)
+            shutil.rmtree(t1_lps_path)
+            shutil.rmtree(dlwmls_path)
+            shutil.rmtree(tfm_path)
+            shutil.rmtree(dlwmls_tfmed)
+
+    if report:
+        report_path = os.path.join(output_directory, 'run_report')
+        write_report(records_path, report_path, run_info={
+            'version': VERSION,
+            'subjects': len([m for m in mrids if m not in excluded]),
+            'processed': len(processed),
+            'failed': sorted(failed),
+            'excluded': excluded,
+            'jobs': args.jobs,
+            'wall_s': time.perf_counter() - run_start,
+            'settings': params,
+            'inference': inference,
+        })
+        logging.info(f"Run report written to {report_path}.json and {report_path}.csv")
+    if os.path.exists(records_path):
+        shutil.rmtree(records_path)
 
 if __name__ == "__main__":
     #print("Please use CMD to run NiChart_DLWMLS or NiChart_DLWMLS_essential.")
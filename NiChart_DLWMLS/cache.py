@@ -0,0 +1,159 @@
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+from typing import Optional
+
+import SimpleITK as sitk
+
+from .manifest import hash_file
+from .utils import result_settings
+
+# Bump when the key or file layout changes, so old entries are never reused
+CACHE_VERSION = 1
+TRANSFORM_EXT = '.tfm'
+
+
+def transform_key(t1_path: str, flair_path: str, settings: Optional[dict]) -> str:
+    """
+    Content address of a FLAIR to T1 transform: the sha256 of both input
+    images and of the registration settings that determine the transform
+    (the thread count does not).
+
+    Args:
+        t1_path (str): The T1 input image.
+        flair_path (str): The FLAIR input image.
+        settings (dict): Registration settings (see utils.registration_settings).
+
+    Returns:
+        str: The hex key.
+    """
+    sha = hashlib.sha256()
+    sha.update(json.dumps({'version': CACHE_VERSION,
+                           't1': hash_file(t1_path),
+                           'flair': hash_file(flair_path),
+                           'settings': result_settings(settings)}, sort_keys=True).encode())
+    return sha.hexdigest()
+
+
+def _entry_path(cache_dir: str, key: str) -> str:
+    return os.path.join(cache_dir, key[:2], key + TRANSFORM_EXT)
+
+
+def lookup(cache_dir: str, key: str) -> Optional[str]:
+    """
+    Finds a cached transform and marks it as recently used.
+
+    Returns:
+        str or None: Path of the cached transform, or None on a miss.
+    """
+    path = _entry_path(cache_dir, key)
+    try:
+        os.utime(path)
+    except OSError:
+        return None
+    return path
+
+
+def fetch(cache_dir: str, key: str, output_path: str) -> bool:
+    """
+    Copies a cached transform to output_path.
+
+    The entry is copied rather than hard-linked: the transform writers
+    overwrite output_path in place, which would change the entry through a
+    link.
+
+    Returns:
+        bool: True on a hit.
+    """
+    path = lookup(cache_dir, key)
+    if path is None:
+        return False
+    if os.path.lexists(output_path):
+        os.remove(output_path)
+    try:
+        shutil.copyfile(path, output_path)
+    except FileNotFoundError:
+        # Evicted in the meantime
+        return False
+    return True
+
+
+def read_transform(cache_dir: str, key: str) -> Optional[sitk.Transform]:
+    """
+    Reads a cached transform (None on a miss).
+    """
+    path = lookup(cache_dir, key)
+    if path is None:
+        return None
+    try:
+        transform: sitk.Transform = sitk.ReadTransform(path)
+        return transform
+    except RuntimeError:
+        # Evicted in the meantime
+        return None
+
+
+def store(cache_dir: str, key: str, transform: sitk.Transform, max_bytes: int = 0) -> None:
+    """
+    Adds a transform to the cache and evicts the least recently used entries
+    beyond max_bytes.
+
+    The entry is written to a temporary file and renamed, so concurrent
+    workers only ever see complete transforms.
+
+    Args:
+        cache_dir (str): Root folder of the cache.
+        key (str): Content address of the transform (see transform_key).
+        transform (sitk.Transform): The transform to store.
+        max_bytes (int): Size cap of the cache (0: unbounded).
+    """
+    path = _entry_path(cache_dir, key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp{TRANSFORM_EXT}"
+    sitk.WriteTransform(transform, tmp_path)
+    os.replace(tmp_path, path)
+    if max_bytes > 0:
+        evict(cache_dir, max_bytes)
+
+
+def evict(cache_dir: str, max_bytes: int) -> int:
+    """
+    Removes the least recently used transforms until the cache fits in max_bytes.
+
+    Eviction is serialized between processes with a lock file.
+
+    Returns:
+        int: Number of removed entries.
+    """
+    removed = 0
+    with open(os.path.join(cache_dir, '.lock'), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            entries = []
+            with os.scandir(cache_dir) as shards:
+                for shard in shards:
+                    if not shard.is_dir():
+                        continue
+                    with os.scandir(shard.path) as files:
+                        for entry in files:
+                            if entry.name.endswith(TRANSFORM_EXT) and '.tmp' not in entry.name:
+                                stat = entry.stat()
+                                entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+                removed += 1
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+    if removed:
+        logging.info(f"Evicted {removed} transforms from {cache_dir}")
+    return removed
@@ -0,0 +1,241 @@
+import csv
+import fcntl
+import hashlib
+import json
+import logging
+import os
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+COHORT_STORE_NAME = 'DLWMLS_Cohort_Store'
+# Arrays stored for every subject, in nibabel (x, y, z) voxel order
+STORE_ARRAYS = {'lesion': np.uint8, 'segmented': np.uint16}
+INDEX_NAME = 'index.csv'
+GRIDS_NAME = 'grids.json'
+LOCK_NAME = '.lock'
+
+
+def grid_key(shape: Tuple[int, ...], affine: np.ndarray) -> str:
+    """
+    Name of the image grid (shape and affine) a subject is stored on,
+    e.g. '182x218x182_1f0c3a9e'.
+    """
+    digest = hashlib.sha1(np.asarray(shape, dtype=np.int64).tobytes()
+                          + np.asarray(affine, dtype=np.float32).tobytes()).hexdigest()
+    return 'x'.join(str(n) for n in shape) + '_' + digest[:8]
+
+
+def array_path(store_dir: str, grid: str, name: str) -> str:
+    return os.path.join(store_dir, grid, f"{name}.{np.dtype(STORE_ARRAYS[name]).name}")
+
+
+def read_grids(store_dir: str) -> Dict[str, dict]:
+    """
+    Reads the grids of a store: 'shape', 'affine' and number of 'slots' of each.
+    """
+    path = os.path.join(store_dir, GRIDS_NAME)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        grids: Dict[str, dict] = json.load(f)
+    return grids
+
+
+def read_index(store_dir: str) -> Dict[str, Tuple[str, int]]:
+    """
+    Reads the subject index of a store.
+
+    Returns:
+        dict: (grid, slot) of every subject (the last row of a subject wins).
+    """
+    path = os.path.join(store_dir, INDEX_NAME)
+    if not os.path.exists(path):
+        return {}
+    with open(path, newline='') as f:
+        return {row['MRID']: (row['grid'], int(row['slot'])) for row in csv.DictReader(f)}
+
+
+def append_subject(store_dir: str,
+                   mrid: str,
+                   lesion: np.ndarray,
+                   segmented: np.ndarray,
+                   affine: np.ndarray) -> Tuple[str, int]:
+    """
+    Writes the lesion mask and the ROI-segmented map of one subject to the
+    cohort store.
+
+    Subjects are stored by grid: every grid has one uncompressed file per
+    array, holding one (x, y, z) volume per slot, that open_array maps as a
+    (slots, x, y, z) array. A new subject takes the next slot of its grid; a
+    subject that is stored again on the same grid keeps its slot. The store
+    is locked while writing, so parallel workers can append to it.
+
+    Args:
+        store_dir (str): Folder of the cohort store (created if missing).
+        mrid (str): The unique identifier of the subject.
+        lesion (np.ndarray): Lesion mask in T1 space (non-zero: lesion).
+        segmented (np.ndarray): Lesion mask labelled by ROI, on the same grid.
+        affine (np.ndarray): Affine of the grid.
+
+    Returns:
+        tuple: (grid, slot) of the subject.
+    """
+    if lesion.shape != segmented.shape:
+        raise ValueError(f"{mrid}: lesion mask {lesion.shape} and segmented map {segmented.shape} differ in shape")
+    arrays = {'lesion': lesion != 0, 'segmented': segmented}
+    grid = grid_key(lesion.shape, affine)
+    os.makedirs(os.path.join(store_dir, grid), exist_ok=True)
+    with open(os.path.join(store_dir, LOCK_NAME), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            grids = read_grids(store_dir)
+            info = grids.setdefault(grid, {'shape': list(lesion.shape),
+                                           'affine': np.asarray(affine).tolist(),
+                                           'slots': 0})
+            previous = read_index(store_dir).get(mrid)
+            if previous is not None and previous[0] == grid:
+                slot = previous[1]
+            else:
+                slot = info['slots']
+                info['slots'] += 1
+
+            # Volumes first, then the grids, then the index: an interrupted
+            # append leaves at most an unused slot behind
+            for name, dtype in STORE_ARRAYS.items():
+                data = np.ascontiguousarray(arrays[name], dtype=dtype)
+                path = array_path(store_dir, grid, name)
+                with open(path, 'r+b' if os.path.exists(path) else 'w+b') as f:
+                    f.seek(slot * data.nbytes)
+                    f.write(data.tobytes())
+            tmp_path = os.path.join(store_dir, f"{GRIDS_NAME}.{os.getpid()}.tmp")
+            with open(tmp_path, 'w') as f:
+                json.dump(grids, f)
+            os.replace(tmp_path, os.path.join(store_dir, GRIDS_NAME))
+            with open(os.path.join(store_dir, INDEX_NAME), 'a', newline='') as f:
+                writer = csv.writer(f)
+                if f.seek(0, os.SEEK_END) == 0:
+                    writer.writerow(['MRID', 'grid', 'slot'])
+                writer.writerow([mrid, grid, slot])
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+    return grid, slot
+
+
+def open_array(store_dir: str, grid: str, name: str) -> np.memmap:
+    """
+    Maps one array of a grid read-only.
+
+    Args:
+        store_dir (str): Folder of the cohort store.
+        grid (str): The grid (see read_grids).
+        name (str): 'lesion' or 'segmented'.
+
+    Returns:
+        np.memmap: The (slots, x, y, z) array; slot s holds the subject the
+                   index maps to (grid, s).
+    """
+    info = read_grids(store_dir)[grid]
+    return np.memmap(array_path(store_dir, grid, name), dtype=STORE_ARRAYS[name], mode='r',
+                     shape=(info['slots'], *info['shape']))
+
+
+def subject_volume(store_dir: str, mrid: str, name: str = 'segmented') -> np.ndarray:
+    """
+    The stored lesion mask or segmented map of one subject (a memory-mapped view).
+    """
+    grid, slot = read_index(store_dir)[mrid]
+    volume: np.ndarray = open_array(store_dir, grid, name)[slot]
+    return volume
+
+
+def _select_grid(store_dir: str, grid: Optional[str], mrids: Optional[List[str]]) -> Tuple[str, List[str]]:
+    index = read_index(store_dir)
+    selected = [m for m in (mrids if mrids is not None else index) if m in index]
+    if grid is None:
+        counts: Dict[str, int] = {}
+        for mrid in selected:
+            counts[index[mrid][0]] = counts.get(index[mrid][0], 0) + 1
+        if not counts:
+            raise ValueError(f"No subjects in the cohort store {store_dir}")
+        grid = max(counts, key=lambda g: counts[g])
+    others = [m for m in selected if index[m][0] != grid]
+    if others:
+        logging.info(f"{len(others)} subjects on other grids than {grid} are left out")
+    return grid, [m for m in selected if index[m][0] == grid]
+
+
+def iter_chunks(store_dir: str,
+                name: str = 'lesion',
+                grid: Optional[str] = None,
+                mrids: Optional[List[str]] = None,
+                max_bytes: int = 256 * 1024 * 1024) -> Iterator[Tuple[List[str], np.ndarray]]:
+    """
+    Streams the volumes of the subjects of one grid in chunks of subjects, so
+    a cohort-wide reduction holds at most max_bytes of them in memory.
+
+    Args:
+        store_dir (str): Folder of the cohort store.
+        name (str): 'lesion' or 'segmented'.
+        grid (str): The grid to read (Default: the one with the most selected subjects).
+        mrids (list): Subjects to read (Default: all in the index).
+        max_bytes (int): Memory cap of one chunk (at least one subject).
+
+    Yields:
+        tuple: (mrids, volumes): the subjects of the chunk and their (n, x, y, z) volumes.
+    """
+    grid, selected = _select_grid(store_dir, grid, mrids)
+    index = read_index(store_dir)
+    array = open_array(store_dir, grid, name)
+    # Slot order reads the file sequentially
+    selected.sort(key=lambda m: index[m][1])
+    per_chunk = max(1, max_bytes // max(1, array[0].nbytes)) if len(array) else 1
+    for start in range(0, len(selected), per_chunk):
+        chunk = selected[start:start + per_chunk]
+        yield chunk, np.asarray(array[[index[m][1] for m in chunk]])
+
+
+def lesion_frequency(store_dir: str,
+                     grid: Optional[str] = None,
+                     mrids: Optional[List[str]] = None,
+                     max_bytes: int = 256 * 1024 * 1024) -> Tuple[np.ndarray, np.ndarray, List[str]]:
+    """
+    Voxelwise lesion frequency: the fraction of subjects with a lesion at
+    every voxel, streamed over the store in bounded memory.
+
+    Args:
+        store_dir (str): Folder of the cohort store.
+        grid (str): The grid to reduce (Default: the one with the most selected subjects).
+        mrids (list): Subjects to include (Default: all in the index).
+        max_bytes (int): Memory cap of the lesion masks read at once.
+
+    Returns:
+        tuple: (frequency, affine, mrids): the float32 (x, y, z) map, the
+               affine of the grid and the subjects it covers.
+    """
+    grid, _ = _select_grid(store_dir, grid, mrids)
+    info = read_grids(store_dir)[grid]
+    counts = np.zeros(info['shape'], dtype=np.uint32)
+    covered: List[str] = []
+    for chunk, volumes in iter_chunks(store_dir, 'lesion', grid, mrids, max_bytes):
+        counts += volumes.sum(axis=0, dtype=np.uint32)
+        covered.extend(chunk)
+    frequency = counts.astype(np.float32) / max(1, len(covered))
+    return frequency, np.array(info['affine']), covered
+
+
+def merge_store(src_dir: str, dst_dir: str) -> int:
+    """
+    Appends every subject of one cohort store to another (e.g. the stores of shards).
+
+    Returns:
+        int: Number of subjects appended.
+    """
+    index = read_index(src_dir)
+    grids = read_grids(src_dir)
+    for mrid, (grid, slot) in index.items():
+        append_subject(dst_dir, mrid,
+                       open_array(src_dir, grid, 'lesion')[slot],
+                       open_array(src_dir, grid, 'segmented')[slot],
+                       np.array(grids[grid]['affine']))
+    return len(index)
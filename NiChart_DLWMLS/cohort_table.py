@@ -0,0 +1,141 @@
+import csv
+import fcntl
+import logging
+import os
+from typing import Dict, Iterable, List, Optional
+
+import pandas as pd
+
+# Single MUSE ROIs DLMUSE labels; the default column set of the cohort table
+DEFAULT_LABEL_LIST = os.path.join(os.path.dirname(__file__), 'data', 'MUSE_ROI_labels.csv')
+
+COHORT_TABLE_NAME = 'DLWMLS_DLMUSE_Segmented_Volumes'
+INDEX_COLUMN = 'MRID'
+
+
+def load_label_list(path: Optional[str] = None) -> List[int]:
+    """
+    Reads the ROI labels that make up the columns of the cohort table.
+
+    Args:
+        path (str): CSV whose first column holds the label indices (first row
+                    is a header). Defaults to the packaged MUSE ROI list.
+
+    Returns:
+        list: The labels, in column order.
+    """
+    df = pd.read_csv(path or DEFAULT_LABEL_LIST)
+    return [int(label) for label in df.iloc[:, 0]]
+
+
+def table_header(labels: List[int]) -> List[str]:
+    return [INDEX_COLUMN] + [str(label) for label in labels]
+
+
+def table_row(mrid: str, volume_results: Dict, labels: List[int]) -> List[str]:
+    """
+    Lays the ROI volumes of one subject out on the fixed label columns
+    (0 for absent labels).
+    """
+    volumes = {int(label): float(volume) for label, volume in volume_results.items()}
+    unknown = sorted(set(volumes) - set(labels))
+    if unknown:
+        logging.warning(f"{mrid}: labels {unknown} are not in the label list and are left out of the cohort table")
+    return [mrid] + [str(volumes.get(label, 0.0)) for label in labels]
+
+
+def append_row(table_path: str, mrid: str, volume_results: Dict, labels: List[int]) -> None:
+    """
+    Appends the ROI volumes of one subject to the cohort table.
+
+    The file is locked while the row is written, so parallel workers can
+    append to the same table; the header is written by the first writer.
+    A subject that is processed again gets a new row, and the last row of a
+    subject wins (see read_table).
+
+    Args:
+        table_path (str): Path of the cohort CSV.
+        mrid (str): The unique identifier of the subject.
+        volume_results (dict): Lesion volume (mm^3) of every ROI label.
+        labels (list): The label columns of the table.
+    """
+    with open(table_path, 'a', newline='') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            writer = csv.writer(f)
+            if f.seek(0, os.SEEK_END) == 0:
+                writer.writerow(table_header(labels))
+            writer.writerow(table_row(mrid, volume_results, labels))
+            f.flush()
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def read_table(table_path: str) -> pd.DataFrame:
+    """
+    Reads the cohort table with one row per subject (the last row written).
+
+    Returns:
+        pd.DataFrame: ROI volumes indexed by subject.
+    """
+    df = pd.read_csv(table_path, dtype={INDEX_COLUMN: str}, float_precision='round_trip')
+    df = df.drop_duplicates(subset=INDEX_COLUMN, keep='last').set_index(INDEX_COLUMN)
+    return df
+
+
+def finalize_table(table_path: str,
+                   labels: List[int],
+                   mrids: Iterable[str],
+                   subject_csv: Dict[str, str],
+                   parquet: bool = False) -> pd.DataFrame:
+    """
+    Rewrites the cohort table with a single row per finished subject, in the
+    order of mrids, and optionally writes it as Parquet next to the CSV.
+
+    Subjects without a row (e.g. finished before the table existed, and
+    skipped by an incremental run) are filled in from their own volume CSV.
+
+    Args:
+        table_path (str): Path of the cohort CSV.
+        labels (list): The label columns of the table.
+        mrids (list): Subjects of the run, in output order.
+        subject_csv (dict): Volume CSV of every subject.
+        parquet (bool): Also write <table>.parquet (needs pyarrow or fastparquet).
+
+    Returns:
+        pd.DataFrame: The cohort table.
+    """
+    columns = [str(label) for label in labels]
+    if os.path.exists(table_path) and os.path.getsize(table_path) > 0:
+        df = read_table(table_path)
+        if list(df.columns) != columns:
+            logging.warning(f"Label columns of {table_path} changed; rebuilding it from the subject CSVs")
+            df = pd.DataFrame(columns=columns, dtype=float)
+    else:
+        df = pd.DataFrame(columns=columns, dtype=float)
+
+    rows = []
+    for mrid in mrids:
+        if mrid in df.index:
+            rows.append(df.loc[mrid])
+        elif os.path.exists(subject_csv.get(mrid, '')):
+            subject = pd.read_csv(subject_csv[mrid], index_col=0, float_precision='round_trip').iloc[0]
+            volumes = {int(label): volume for label, volume in subject.items()}
+            rows.append(pd.Series([float(v) for v in table_row(mrid, volumes, labels)[1:]], index=columns, name=mrid))
+    df = pd.DataFrame(rows, columns=columns)
+    df.index = df.index.astype(str)
+    df.index.name = INDEX_COLUMN
+
+    tmp_path = f"{table_path}.{os.getpid()}.tmp"
+    df.to_csv(tmp_path)
+    os.replace(tmp_path, table_path)
+    logging.info(f"Cohort table with {len(df)} subjects written to {table_path}")
+
+    if parquet:
+        parquet_path = os.path.splitext(table_path)[0] + '.parquet'
+        try:
+            df.to_parquet(parquet_path)
+            logging.info(f"Cohort table written to {parquet_path}")
+        except ImportError as e:
+            logging.warning(f"Parquet output skipped: {e}")
+    return df
@@ -0,0 +1,188 @@
+import math
+import os
+from typing import Dict, List, Optional, Set, Tuple
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+# Lobes, hemispheres, deep GM, WM and ventricle roll-ups of the single MUSE ROIs,
+# and the periventricular vs deep WM split (indices 1001 to 1059)
+DEFAULT_COMPOSITE_LIST = os.path.join(os.path.dirname(__file__), 'data', 'MUSE_composite_ROIs.csv')
+# Index to name mapping of the composite columns, written to the output folder
+COMPOSITE_NAMES_NAME = 'DLWMLS_DLMUSE_Composite_ROIs'
+
+# Composites split by the distance to the lateral ventricles instead of by
+# label: the lesions of their members that lie within PERIVENTRICULAR_MM of the
+# VENTRICLES_NAME composite are periventricular, the others deep
+PERIVENTRICULAR_NAME = 'Periventricular_WM'
+DEEP_NAME = 'Deep_WM'
+VENTRICLES_NAME = 'Lateral_Ventricles'
+PERIVENTRICULAR_MM = 10.0
+
+
+def load_composites(path: Optional[str] = None) -> dict:
+    """
+    Reads a label to composite ROI mapping and builds its membership matrix.
+
+    The CSV has one row per member, with the columns Index, Name and Label.
+    A member is either a single label or the index of another composite, whose
+    labels are then all included (composites are resolved recursively).
+
+    The composites named PERIVENTRICULAR_NAME and DEEP_NAME are not sums of
+    their labels: their rows of the matrix are empty, and their lesions are
+    split by the distance to the VENTRICLES_NAME composite (see
+    periventricular_volumes).
+
+    Args:
+        path (str): The mapping CSV. Defaults to the packaged MUSE composites.
+
+    Returns:
+        dict: 'indices' and 'names' of the composites, in file order,
+              'matrix', a sparse (composites x labels) CSR matrix with a 1
+              where a label belongs to a composite, and 'split', the indices
+              and labels of the periventricular vs deep split (None if the
+              mapping has no such composites).
+    """
+    df = pd.read_csv(path or DEFAULT_COMPOSITE_LIST)
+    df = df.drop_duplicates(subset=['Index', 'Label'])
+    indices = [int(i) for i in dict.fromkeys(df['Index'])]
+    names = df.drop_duplicates(subset='Index').set_index('Index')['Name'].astype(str)
+    members: Dict[int, List[int]] = {i: [] for i in indices}
+    for index, label in zip(df['Index'], df['Label']):
+        members[int(index)].append(int(label))
+
+    def resolve(index: int, visiting: Set[int]) -> Set[int]:
+        if index in visiting:
+            raise ValueError(f"Composite ROI {index} includes itself")
+        labels: Set[int] = set()
+        for member in members[index]:
+            if member in members:
+                labels |= resolve(member, visiting | {index})
+            else:
+                labels.add(member)
+        return labels
+
+    by_name = {names[i]: i for i in indices}
+    split = None
+    if PERIVENTRICULAR_NAME in by_name or DEEP_NAME in by_name:
+        if VENTRICLES_NAME not in by_name:
+            raise ValueError(f"Composite ROIs {PERIVENTRICULAR_NAME} and {DEEP_NAME} "
+                             f"need a {VENTRICLES_NAME} composite")
+        split = {
+            'periventricular': by_name.get(PERIVENTRICULAR_NAME),
+            'deep': by_name.get(DEEP_NAME),
+            'labels': sorted(set().union(*[resolve(by_name[name], set()) for name in
+                                           (PERIVENTRICULAR_NAME, DEEP_NAME) if name in by_name])),
+            'ventricles': sorted(resolve(by_name[VENTRICLES_NAME], set())),
+        }
+
+    rows, cols = [], []
+    for row, index in enumerate(indices):
+        if split is not None and index in (split['periventricular'], split['deep']):
+            continue
+        labels = sorted(resolve(index, set()))
+        rows.extend([row] * len(labels))
+        cols.extend(labels)
+    width = max(cols) + 1 if cols else 1
+    matrix = sp.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(len(indices), width))
+    return {'indices': indices, 'names': [names[i] for i in indices], 'matrix': matrix, 'split': split}
+
+
+def composite_volumes(volume_results: Dict,
+                      composites: dict,
+                      split_volumes: Optional[Dict[int, float]] = None) -> Dict[int, float]:
+    """
+    Sums the single label volumes into the composite ROIs, with one sparse
+    matrix product (no pass over the voxels).
+
+    Args:
+        volume_results (dict): Lesion volume (mm^3) of every single label.
+        composites (dict): The composite ROIs (see load_composites).
+        split_volumes (dict): Volumes of the periventricular and deep composites
+                              (see periventricular_volumes); 0 if not given.
+
+    Returns:
+        dict: Lesion volume (mm^3) of every composite ROI.
+    """
+    matrix = composites['matrix']
+    volumes = np.zeros(matrix.shape[1])
+    for label, volume in volume_results.items():
+        if 0 <= int(label) < len(volumes):
+            volumes[int(label)] = volume
+    totals = matrix @ volumes
+    results = {index: float(total) for index, total in zip(composites['indices'], totals)}
+    if split_volumes:
+        results.update(split_volumes)
+    return results
+
+
+def periventricular_volumes(segmented_data: np.ndarray,
+                            label_map: np.ndarray,
+                            spacing: Tuple[float, ...],
+                            voxel_volume: float,
+                            split: dict,
+                            distance: float = PERIVENTRICULAR_MM,
+                            offset: Optional[Tuple[int, ...]] = None) -> Dict[int, float]:
+    """
+    Splits the lesions of the WM labels into periventricular and deep lesions,
+    by the distance of every lesion voxel to the nearest lateral ventricle voxel.
+
+    The distance map is only computed on the block of the lesions, widened by
+    the distance: every ventricle voxel within reach of a lesion lies in it.
+
+    Args:
+        segmented_data (np.ndarray): The label of every lesion voxel (0 elsewhere),
+                                     on the grid of label_map unless an offset is given.
+        label_map (np.ndarray): The multi-label map.
+        spacing (tuple): Voxel size (mm) along every axis.
+        voxel_volume (float): Volume of a single voxel in mm^3.
+        split (dict): The split of load_composites.
+        distance (float): Largest distance (mm) of a periventricular lesion voxel.
+        offset (tuple): Index of label_map where segmented_data starts.
+
+    Returns:
+        dict: Lesion volume (mm^3) of the periventricular and deep composites.
+    """
+    from scipy.ndimage import distance_transform_edt
+    spacing = tuple(float(s) for s in spacing[:label_map.ndim])
+    offset = tuple(offset) if offset is not None else (0,) * label_map.ndim
+    lesion = np.isin(segmented_data, split['labels'])
+    near = 0
+    total = int(np.count_nonzero(lesion))
+    if total:
+        # Bounding block of the lesions, and the window around it that the distance reaches
+        nonzero = np.nonzero(lesion)
+        start = [int(i.min()) for i in nonzero]
+        stop = [int(i.max()) + 1 for i in nonzero]
+        reach = [math.ceil(distance / s) for s in spacing]
+        window_start = [max(o + a - r, 0) for o, a, r in zip(offset, start, reach)]
+        window_stop = [min(o + b + r, n) for o, b, r, n in zip(offset, stop, reach, label_map.shape)]
+        ventricles = np.isin(label_map[tuple(slice(a, b) for a, b in zip(window_start, window_stop))],
+                             split['ventricles'])
+        if ventricles.any():
+            to_ventricles = distance_transform_edt(~ventricles, sampling=spacing)
+            block = tuple(slice(o + a - w, o + b - w) for o, a, b, w in zip(offset, start, stop, window_start))
+            lesion_block = lesion[tuple(slice(a, b) for a, b in zip(start, stop))]
+            near = int(np.count_nonzero(to_ventricles[block][lesion_block] <= distance))
+    volumes = {}
+    if split['periventricular'] is not None:
+        volumes[split['periventricular']] = near * voxel_volume
+    if split['deep'] is not None:
+        volumes[split['deep']] = (total - near) * voxel_volume
+    return volumes
+
+
+def write_composite_names(composites: dict, path: str) -> None:
+    """
+    Writes the name of every composite ROI column of the volume CSVs and the
+    cohort table (columns Index, Name), so the composite indices can be read.
+
+    Args:
+        composites (dict): The composite ROIs (see load_composites).
+        path (str): Output CSV path.
+    """
+    names = pd.DataFrame({'Index': composites['indices'], 'Name': composites['names']})
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    names.to_csv(tmp_path, index=False)
+    os.replace(tmp_path, path)
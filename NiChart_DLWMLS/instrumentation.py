@@ -0,0 +1,266 @@
+import cProfile
+import csv
+import glob
+import json
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional
+
+# Per-stage measurements of a run; set with configure() in every process
+_config: Dict[str, Any] = {}
+
+RECORD_FIELDS = ['mrid', 'stage', 'wall_s', 'cpu_s', 'peak_rss_mb', 'process_peak_rss_mb',
+                 'read_bytes', 'write_bytes', 'pid']
+SUMMARY_FIELDS = ['wall_s', 'cpu_s', 'peak_rss_mb', 'read_bytes', 'write_bytes', 'reg_time_s', 'reg_metric']
+PERCENTILES = [50, 90, 95, 99]
+
+# Stages measured in this process right now; the RSS high-water mark is only
+# reset when none is, so it never drops inside a running stage
+_active_stages = 0
+_active_lock = threading.Lock()
+# Peak RSS (MB) of this process before the last reset, which also resets ru_maxrss
+_peak_before_reset = 0.0
+
+
+def configure(records_dir: Optional[str] = None,
+              profile_stage: Optional[str] = None,
+              profile_dir: Optional[str] = None) -> None:
+    """
+    Enables (or disables, with no records_dir) the per-stage instrumentation
+    in the current process.
+
+    Args:
+        records_dir (str): Folder where every process appends its stage records.
+        profile_stage (str): Stage to run under cProfile, if any.
+        profile_dir (str): Folder for the cProfile outputs (<mrid>_<stage>.prof).
+    """
+    _config.clear()
+    if records_dir:
+        os.makedirs(records_dir, exist_ok=True)
+        _config['records_dir'] = records_dir
+    if profile_stage and profile_dir:
+        os.makedirs(profile_dir, exist_ok=True)
+        _config['profile_stage'] = profile_stage
+        _config['profile_dir'] = profile_dir
+
+
+def get_config() -> dict:
+    """
+    Returns the instrumentation settings, to configure() worker processes with.
+    """
+    return dict(_config)
+
+
+def _io_counters(children: bool = False) -> Dict[str, int]:
+    """
+    Bytes read/written so far (all I/O syscalls, Linux only) by the calling
+    thread, so that other threads of the process (e.g. prefetching) are not
+    counted, or with children by the whole process, which includes the
+    child processes it waited for.
+    """
+    counters = {'read_bytes': 0, 'write_bytes': 0}
+    path = '/proc/self/io' if children else f'/proc/self/task/{threading.get_native_id()}/io'
+    try:
+        with open(path) as f:
+            for line in f:
+                key, value = line.split(':')
+                if key == 'rchar':
+                    counters['read_bytes'] = int(value)
+                elif key == 'wchar':
+                    counters['write_bytes'] = int(value)
+    except (OSError, ValueError):
+        pass
+    return counters
+
+
+def _reset_rss_peak() -> None:
+    """
+    Resets the RSS high-water mark (VmHWM) of this process to its current RSS
+    (Linux only), keeping the peak so far for process_peak_rss_mb.
+    """
+    global _peak_before_reset
+    _peak_before_reset = max(_peak_before_reset, _rss_peak_mb() or 0.0)
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def _rss_peak_mb() -> Optional[float]:
+    """
+    RSS high-water mark (VmHWM) of this process in MB (None if unknown).
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.0
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+@contextmanager
+def stage(name: str, mrid: str, children: bool = False, **extra: Any) -> Iterator[Dict[str, Any]]:
+    """
+    Measures one stage of one subject: wall time, CPU time, peak RSS and
+    bytes read/written. Does nothing unless configure() enabled it.
+
+    peak_rss_mb is the highest RSS of the process during the stage (its
+    high-water mark is reset when no other stage is measured); when stages
+    of other threads overlap, it covers their memory too. process_peak_rss_mb
+    is the peak of the process so far. The bytes read/written are those of
+    the calling thread. The stage yields the dict of its extra fields, so
+    that the measured code can add results to the record (e.g. the
+    registration metric).
+
+    Args:
+        name (str): Stage name ('load', 'reorient', 'dlwmls', 'register', 'apply', 'segment').
+        mrid (str): The subject (or inference chunk) the stage runs on.
+        children (bool): Measure the child processes (e.g. DLWMLS) instead of
+                         this one. CPU time and bytes are then summed over the
+                         children that finished during the stage, and the peak
+                         RSS is that of the largest one (if it was larger than
+                         any child before, otherwise unknown).
+        extra: Additional fields stored with the record.
+    """
+    global _active_stages
+    fields = dict(extra)
+    if 'records_dir' not in _config:
+        yield fields
+        return
+
+    who = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+    usage_start = resource.getrusage(who)
+    io_start = _io_counters(children)
+    if not children:
+        with _active_lock:
+            if _active_stages == 0:
+                _reset_rss_peak()
+            _active_stages += 1
+    profiler = None
+    if _config.get('profile_stage') == name:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    wall_start = time.perf_counter()
+    try:
+        yield fields
+    finally:
+        wall_s = time.perf_counter() - wall_start
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(os.path.join(_config['profile_dir'], f"{mrid}_{name}.prof"))
+        usage_end = resource.getrusage(who)
+        io_end = _io_counters(children)
+        # ru_maxrss is in KB on Linux
+        if children:
+            # The largest of all children so far
+            peak_rss_mb = usage_end.ru_maxrss / 1024.0 if usage_end.ru_maxrss > usage_start.ru_maxrss else None
+            process_peak_rss_mb = usage_end.ru_maxrss / 1024.0
+        else:
+            peak_rss_mb = _rss_peak_mb()
+            process_peak_rss_mb = max(_peak_before_reset, peak_rss_mb or 0.0, usage_end.ru_maxrss / 1024.0)
+            with _active_lock:
+                _active_stages -= 1
+        record = {
+            'mrid': mrid,
+            'stage': name,
+            'wall_s': wall_s,
+            'cpu_s': (usage_end.ru_utime + usage_end.ru_stime) - (usage_start.ru_utime + usage_start.ru_stime),
+            'peak_rss_mb': peak_rss_mb,
+            'process_peak_rss_mb': process_peak_rss_mb,
+            'read_bytes': io_end['read_bytes'] - io_start['read_bytes'],
+            'write_bytes': io_end['write_bytes'] - io_start['write_bytes'],
+            'pid': os.getpid(),
+        }
+        record.update(fields)
+        # One file per process, so concurrent workers never share a file
+        path = os.path.join(_config['records_dir'], f"{os.getpid()}.jsonl")
+        with open(path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+
+def load_records(records_dir: str) -> List[dict]:
+    """
+    Reads the stage records every process wrote.
+    """
+    records: List[dict] = []
+    for path in sorted(glob.glob(os.path.join(records_dir, '*.jsonl'))):
+        with open(path) as f:
+            records.extend(json.loads(line) for line in f if line.strip())
+    return records
+
+
+def _percentile(values: List[float], q: float) -> float:
+    """
+    Linear-interpolated percentile of a non-empty list.
+    """
+    values = sorted(values)
+    position = (len(values) - 1) * q / 100.0
+    low = int(position)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (position - low)
+
+
+def summarize(records: List[dict]) -> dict:
+    """
+    Computes cohort-level statistics (count, total, mean, percentiles, max)
+    of every measurement, per stage.
+    """
+    summary: Dict[str, Any] = {}
+    for name in sorted({r['stage'] for r in records}):
+        stage_records = [r for r in records if r['stage'] == name]
+        stats: Dict[str, Any] = {'count': len(stage_records)}
+        for field in SUMMARY_FIELDS:
+            # Measurements that were unknown (None) are left out
+            values = [float(r[field]) for r in stage_records if r.get(field) is not None]
+            if not values:
+                continue
+            field_stats = {'total': sum(values), 'mean': sum(values) / len(values), 'max': max(values)}
+            for q in PERCENTILES:
+                field_stats[f'p{q}'] = _percentile(values, q)
+            stats[field] = field_stats
+        summary[name] = stats
+    return summary
+
+
+def write_report(records_dir: str, report_path: str, run_info: Optional[dict] = None) -> dict:
+    """
+    Writes the run report: <report_path>.json with the run info, the per-stage
+    summary and every record, and <report_path>.csv with one row per record.
+
+    Args:
+        records_dir (str): Folder with the stage records of the run.
+        report_path (str): Output path without extension.
+        run_info (dict): Run-level information stored in the JSON report.
+
+    Returns:
+        dict: The report.
+    """
+    records = load_records(records_dir)
+    report = {
+        'run': run_info or {},
+        'summary': summarize(records),
+        'records': records,
+    }
+    save_report(report, report_path)
+    return report
+
+
+def save_report(report: dict, report_path: str) -> None:
+    """
+    Saves a run report as <report_path>.json and its records as <report_path>.csv.
+    """
+    with open(report_path + '.json', 'w') as f:
+        json.dump(report, f, indent=2)
+
+    records = report.get('records', [])
+    extra_fields = sorted({k for r in records for k in r} - set(RECORD_FIELDS))
+    with open(report_path + '.csv', 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=RECORD_FIELDS + extra_fields)
+        writer.writeheader()
+        writer.writerows(records)
@@ -0,0 +1,275 @@
+import fcntl
+import hashlib
+import json
+import os
+from contextlib import contextmanager
+from typing import Dict, Iterator, List
+
+# Per-subject stages, in the order they run
+STAGES = ['reorient', 'dlwmls', 'register', 'apply', 'segment']
+
+# Stages that have to be rerun when an input changes: its reorientation and
+# the stages that use it (DLWMLS only reads the FLAIR image)
+INPUT_STAGES = {'t1': ['reorient', 'register', 'apply', 'segment'], 'fl': STAGES, 'dlmuse': ['segment']}
+# First stage that has to be rerun when a parameter changes (parameters not
+# listed here invalidate every stage)
+PARAM_STAGES = {'device': 'dlwmls', 'registration': 'register', 'dlmuse_suff': 'segment', 'composites': 'segment'}
+
+MANIFEST_DIR = 'manifest'
+LOCK_NAME = '.lock'
+
+# Folder and suffix of every input kind in the layout
+INPUT_KEYS = {'t1': ('t1_dir', 't1_suff'), 'fl': ('fl_dir', 'fl_suff'), 'dlmuse': ('dlmuse_dir', 'dlmuse_suff')}
+
+
+def fingerprint_file(path: str, use_hash: bool = False) -> dict:
+    """
+    Fingerprints an input file by path, size and modification time.
+
+    Args:
+        path (str): The file path to fingerprint.
+        use_hash (bool): Also store the sha256 of the file content, so that
+                         a touched but unchanged file is not recomputed.
+
+    Returns:
+        dict: The fingerprint ({} if the file does not exist).
+    """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return {}
+    fingerprint = {'path': os.path.abspath(path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    if use_hash:
+        fingerprint['sha256'] = hash_file(path)
+    return fingerprint
+
+
+def hash_file(path: str, block_size: int = 1 << 20) -> str:
+    """
+    Computes the sha256 of a file, reading it in blocks.
+    """
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def _same_file(old: dict, new: dict) -> bool:
+    if 'sha256' in old and 'sha256' in new:
+        return bool(old['sha256'] == new['sha256'])
+    return old == new
+
+
+def input_path(mrid: str, layout: dict, kind: str) -> str:
+    """
+    Path of the T1 ('t1'), FLAIR ('fl') or DLMUSE ('dlmuse') input of one subject.
+
+    The path is taken from the index of the input folders (layout['inputs'],
+    see preflight.index_dir) when the run has one; it is built from the folder
+    and suffix for a subject the index does not list.
+    """
+    path = layout.get('inputs', {}).get(kind, {}).get(mrid)
+    if path is not None:
+        return str(path)
+    folder, suffix = INPUT_KEYS[kind]
+    return os.path.join(str(layout[folder]), mrid + str(layout[suffix]))
+
+
+def subject_layout(layout: dict, mrid: str) -> dict:
+    """
+    The layout with the index of the input folders cut down to one subject,
+    so that a task sent to a worker process does not carry the whole index.
+    """
+    if 'inputs' not in layout:
+        return layout
+    inputs = {kind: {mrid: index[mrid]} if mrid in index else {} for kind, index in layout['inputs'].items()}
+    return dict(layout, inputs=inputs)
+
+
+def subject_inputs(mrid: str, layout: dict, use_hash: bool = False) -> dict:
+    """
+    Fingerprints the T1, FLAIR and DLMUSE inputs of one subject.
+    """
+    return {kind: fingerprint_file(input_path(mrid, layout, kind), use_hash) for kind in INPUT_KEYS}
+
+
+def stage_outputs(mrid: str, layout: dict, stage: str) -> list:
+    """
+    Lists the files a stage writes for one subject.
+    """
+    if stage == 'reorient':
+        return [os.path.join(layout['t1_lps_dir'], mrid + layout['t1_lps_suff']),
+                os.path.join(layout['flair_lps_dir'], mrid + layout['fl_suff'])]
+    if stage == 'dlwmls':
+        return [os.path.join(layout['dlwmls_dir'], mrid + layout['dlwmls_suff'])]
+    if stage == 'register':
+        return [os.path.join(layout['tfm_dir'], mrid + layout['fl_to_t1_xfm_suff'])]
+    if stage == 'apply':
+        return [os.path.join(layout['dlwmls_tfmed_dir'], mrid + layout['dlwmls_to_t1_reg_suff'])]
+    if stage == 'segment':
+        return [os.path.join(layout['segmented_dir'], mrid + layout['dlwmls_dlmuse_segmented_suff']),
+                os.path.join(layout['out_dir'], mrid + layout['dlwmls_roi_volume_csv_suff'])]
+    raise ValueError(f"Unknown stage: {stage}")
+
+
+def manifest_path(layout: dict, mrid: str) -> str:
+    return os.path.join(layout['out_dir'], MANIFEST_DIR, mrid + '.json')
+
+
+def load_manifest(layout: dict, mrid: str) -> dict:
+    """
+    Loads the manifest entry of one subject ({} if there is none).
+    """
+    path = manifest_path(layout, mrid)
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path) as f:
+            return dict(json.load(f))
+    except (OSError, ValueError):
+        return {}
+
+
+@contextmanager
+def locked_manifests(layout: dict) -> Iterator[None]:
+    """
+    Holds the lock of the manifest folder. A stage of a pool worker and the
+    main process (e.g. DLWMLS) may finish for the same subject at the same
+    time, so every read-modify-write of a manifest runs under it.
+    """
+    path = os.path.join(layout['out_dir'], MANIFEST_DIR, LOCK_NAME)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def save_manifest(layout: dict, mrid: str, entry: dict) -> None:
+    """
+    Writes the manifest entry of one subject atomically (readers never see a
+    partial file). Updates of an entry go through locked_manifests.
+    """
+    path = manifest_path(layout, mrid)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(entry, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def stage_inputs(mrid: str, layout: dict, stage: str) -> Dict[str, list]:
+    """
+    Lists the outputs of earlier stages that a stage reads, by the stage that writes them.
+
+    The segment stage splits the resampled mask in memory, so it reads
+    nothing itself: apply and segment always run together.
+    """
+    t1_lps = os.path.join(layout['t1_lps_dir'], mrid + layout['t1_lps_suff'])
+    flair_lps = os.path.join(layout['flair_lps_dir'], mrid + layout['fl_suff'])
+    if stage == 'reorient' or stage == 'segment':
+        return {}
+    if stage == 'dlwmls':
+        return {'reorient': [flair_lps]}
+    if stage == 'register':
+        return {'reorient': [t1_lps, flair_lps]}
+    if stage == 'apply':
+        return {'reorient': [t1_lps],
+                'dlwmls': stage_outputs(mrid, layout, 'dlwmls'),
+                'register': stage_outputs(mrid, layout, 'register')}
+    raise ValueError(f"Unknown stage: {stage}")
+
+
+def plan_stages(entry: dict, inputs: dict, params: dict, layout: dict, mrid: str) -> List[str]:
+    """
+    Finds the stages a subject has to (re)run.
+
+    A changed input invalidates the stages that use it (see INPUT_STAGES), a
+    changed parameter the first stage that depends on it and every later one.
+    An earlier stage only runs again if a stage that runs reads one of its
+    outputs and that output is missing (e.g. a removed intermediate); DLWMLS
+    inference is thus not repeated while its mask is kept and the FLAIR image
+    and the device did not change.
+
+    Args:
+        entry (dict): The manifest entry of the previous run.
+        inputs (dict): Current input fingerprints (see subject_inputs).
+        params (dict): Current run parameters.
+        layout (dict): Input/output folders and file suffixes of the run.
+        mrid (str): The unique identifier of the subject.
+
+    Returns:
+        list: The stages to run, in order ([] if the subject is up to date).
+    """
+    if not entry:
+        return list(STAGES)
+
+    invalid = set()
+    old_inputs = entry.get('inputs', {})
+    for key, fingerprint in inputs.items():
+        if not fingerprint or not _same_file(old_inputs.get(key, {}), fingerprint):
+            invalid.update(INPUT_STAGES.get(key, STAGES))
+    old_params = entry.get('params', {})
+    for key in set(params) | set(old_params):
+        if params.get(key) != old_params.get(key):
+            invalid.update(STAGES[STAGES.index(PARAM_STAGES.get(key, STAGES[0])):])
+
+    done = entry.get('stages', [])
+    # Final outputs present: intermediates may have been removed on purpose
+    if not invalid and STAGES[-1] in done and \
+            all(os.path.exists(p) for p in stage_outputs(mrid, layout, STAGES[-1])):
+        return []
+
+    needed = invalid | {'apply', 'segment'}
+    pending = list(needed)
+    while pending:
+        for producer, paths in stage_inputs(mrid, layout, pending.pop()).items():
+            if producer not in needed and \
+                    (producer not in done or not all(os.path.exists(p) for p in paths)):
+                needed.add(producer)
+                pending.append(producer)
+    return [s for s in STAGES if s in needed]
+
+
+def start_subject(layout: dict, mrid: str, inputs: dict, params: dict, stages: List[str]) -> None:
+    """
+    Records the current inputs and parameters of a subject that runs the
+    given stages (see plan_stages), forgetting those stages.
+    """
+    with locked_manifests(layout):
+        entry = load_manifest(layout, mrid)
+        entry = {
+            'mrid': mrid,
+            'inputs': inputs,
+            'params': params,
+            'stages': [s for s in entry.get('stages', []) if s not in stages],
+        }
+        save_manifest(layout, mrid, entry)
+
+
+def stage_done(layout: dict, mrid: str, stage: str) -> bool:
+    """
+    Checks whether a stage already finished for a subject and its outputs still exist.
+    """
+    if not layout.get('manifest'):
+        return False
+    entry = load_manifest(layout, mrid)
+    return stage in entry.get('stages', []) and \
+        all(os.path.exists(p) for p in stage_outputs(mrid, layout, stage))
+
+
+def mark_stage_done(layout: dict, mrid: str, stage: str) -> None:
+    """
+    Records that a stage finished for a subject.
+    """
+    if not layout.get('manifest'):
+        return
+    with locked_manifests(layout):
+        entry = load_manifest(layout, mrid)
+        stages = entry.setdefault('stages', [])
+        if stage not in stages:
+            stages.append(stage)
+        save_manifest(layout, mrid, entry)
@@ -0,0 +1,538 @@
+import logging
+import os
+import shutil
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from contextlib import nullcontext
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+import SimpleITK as sitk
+
+from . import cache
+from .instrumentation import configure, get_config, stage
+from .manifest import input_path, mark_stage_done, stage_done, stage_outputs, subject_layout
+from .prefetch import Prefetcher
+from .utils import (
+    load_label_map,
+    read_image_grid,
+    reorient_to_lps,
+    run_DLWMLS,
+    register_flair_to_t1,
+    register_and_segment_subject,
+    registration_record
+)
+
+# Thread pools a DLWMLS (torch) worker may start
+THREAD_ENV_VARS = ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'NUMEXPR_NUM_THREADS']
+
+
+def reorient_subject(mrid: str, layout: dict) -> None:
+    """
+    Reorients the T1 and FLAIR images of one subject to LPS.
+
+    Args:
+        mrid (str): The unique identifier of the subject.
+        layout (dict): Input/output folders and file suffixes of the run.
+    """
+    with stage('reorient', mrid):
+        # Reorient T1
+        reorient_to_lps(input_path=input_path(mrid, layout, 't1'),
+                        output_path=os.path.join(layout['t1_lps_dir'], mrid + layout['t1_lps_suff']),
+                        compresslevel=layout.get('compresslevel'))
+        # Reorient FLAIR
+        reorient_to_lps(input_path=input_path(mrid, layout, 'fl'),
+                        output_path=os.path.join(layout['flair_lps_dir'], mrid + layout['fl_suff']),
+                        compresslevel=layout.get('compresslevel'))
+    mark_stage_done(layout, mrid, 'reorient')
+
+
+def _stage_files(src_dir: str, fnames: List[str], dst_dir: str) -> None:
+    """
+    Links (or copies) files of one folder into a staging folder.
+    """
+    os.makedirs(dst_dir, exist_ok=True)
+    for fname in fnames:
+        src = os.path.abspath(os.path.join(src_dir, fname))
+        try:
+            os.symlink(src, os.path.join(dst_dir, fname))
+        except OSError:
+            shutil.copyfile(src, os.path.join(dst_dir, fname))
+
+
+def inference_env(num_threads: int) -> dict:
+    """
+    Builds the environment of a DLWMLS worker limited to a number of threads.
+
+    Args:
+        num_threads (int): Threads the worker may use (torch, OpenMP and BLAS pools).
+
+    Returns:
+        dict: A copy of the current environment with the thread caps set.
+    """
+    env = dict(os.environ)
+    for var in THREAD_ENV_VARS:
+        env[var] = str(num_threads)
+    return env
+
+
+def _run_inference_chunk(index: int,
+                         num_chunks: int,
+                         chunk: List[str],
+                         layout: dict,
+                         device: str,
+                         timeout: Optional[float],
+                         retries: int,
+                         env: Optional[dict]) -> Tuple[List[str], List[str]]:
+    """
+    Runs DLWMLS on one chunk of subjects in its own staging folder and moves
+    the masks into the DLWMLS folder after every successful call.
+
+    Returns:
+        tuple: (done, failed) subjects of the chunk.
+    """
+    chunk_dir = os.path.join(layout['out_dir'], 'DLWMLS_staging', f'chunk_{index:04d}')
+    remaining = list(chunk)
+    done: List[str] = []
+    for attempt in range(retries + 1):
+        if os.path.exists(chunk_dir):
+            shutil.rmtree(chunk_dir)
+        in_dir = os.path.join(chunk_dir, 'in')
+        out_dir = os.path.join(chunk_dir, 'out')
+        _stage_files(layout['flair_lps_dir'], [mrid + layout['fl_suff'] for mrid in remaining], in_dir)
+        logging.info(f"DLWMLS chunk {index + 1}/{num_chunks}: {len(remaining)} subjects (attempt {attempt + 1})")
+        try:
+            # Resource usage of the DLWMLS process; approximate when workers run concurrently
+            with stage('dlwmls', f'chunk_{index:04d}', children=True,
+                       subjects=len(remaining), attempt=attempt + 1):
+                run_DLWMLS(in_dir=in_dir, out_dir=out_dir, device=device, timeout=timeout, env=env)
+        except RuntimeError as e:
+            logging.error(f"DLWMLS chunk {index + 1}/{num_chunks} failed: {e}")
+            continue
+        # Keep every mask of a successful call, retry only the missing ones
+        for mrid in list(remaining):
+            mask = os.path.join(out_dir, mrid + layout['dlwmls_suff'])
+            if os.path.exists(mask):
+                os.replace(mask, os.path.join(layout['dlwmls_dir'], mrid + layout['dlwmls_suff']))
+                remaining.remove(mrid)
+                done.append(mrid)
+        if not remaining:
+            break
+        logging.error(f"DLWMLS chunk {index + 1}/{num_chunks}: no mask for {remaining}")
+    if os.path.exists(chunk_dir):
+        shutil.rmtree(chunk_dir)
+    return done, remaining
+
+
+def iter_inference_chunks(mrids: List[str],
+                          layout: dict,
+                          device: str,
+                          chunk_size: int = 0,
+                          timeout: Optional[float] = None,
+                          retries: int = 1,
+                          workers: int = 1,
+                          threads: int = 0) -> Iterator[Tuple[List[str], List[str]]]:
+    """
+    Runs DLWMLS over chunks of subjects and reports every chunk as it finishes.
+
+    Each chunk gets its own staging input/output folders. The masks of a chunk
+    are moved into the DLWMLS folder only after DLWMLS exited successfully, so
+    finished chunks are kept and a crash only loses the running chunk. Subjects
+    whose mask is missing are retried up to `retries` times.
+
+    With several workers, chunks run as concurrent DLWMLS processes, each with
+    a fixed thread budget, so CPU inference scales with the cores of a node.
+
+    Args:
+        mrids (list): Subjects to run inference on.
+        layout (dict): Input/output folders and file suffixes of the run.
+        device (str): Device to run segmentation on.
+        chunk_size (int): Number of subjects per DLWMLS call (0: split the
+                          subjects evenly between the workers).
+        timeout (float): Seconds after which a DLWMLS call is killed (None: no limit).
+        retries (int): Number of times a failed chunk is run again.
+        workers (int): Number of concurrent DLWMLS processes.
+        threads (int): Threads per DLWMLS process (0: the available cores
+                       split evenly between the workers; with one worker
+                       the thread count is left to DLWMLS).
+
+    Yields:
+        tuple: (done, failed) subjects of each chunk.
+    """
+    if not mrids:
+        logging.info("No subjects need DLWMLS inference")
+        return
+
+    workers = max(1, min(workers, len(mrids)))
+    if chunk_size > 0:
+        chunks = [mrids[i:i + chunk_size] for i in range(0, len(mrids), chunk_size)]
+    else:
+        # One shard per worker, balanced by number of subjects
+        chunks = [mrids[i::workers] for i in range(workers)]
+
+    env = None
+    if workers > 1 or threads > 0:
+        threads = threads if threads > 0 else threads_per_job(workers)
+        env = inference_env(threads)
+        logging.info(f"Running DLWMLS with {workers} workers ({threads} threads each)")
+
+    staging_root = os.path.join(layout['out_dir'], 'DLWMLS_staging')
+    args = (layout, device, timeout, retries, env)
+    if workers == 1:
+        for index, chunk in enumerate(chunks):
+            yield _run_inference_chunk(index, len(chunks), chunk, *args)
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(_run_inference_chunk, index, len(chunks), chunk, *args)
+                       for index, chunk in enumerate(chunks)]
+            for future in as_completed(futures):
+                yield future.result()
+    if os.path.exists(staging_root):
+        shutil.rmtree(staging_root)
+
+
+def infer_subjects(mrids: List[str], layout: dict, device: str, mark_done: bool = True, **options: Any) -> List[str]:
+    """
+    Runs DLWMLS on the LPS FLAIR images of the given subjects.
+
+    Args:
+        mrids (list): Subjects to run inference on.
+        layout (dict): Input/output folders and file suffixes of the run.
+        device (str): Device to run segmentation on.
+        mark_done (bool): Record the finished masks in the manifest. Callers
+                          that track the masks themselves pass False.
+        options: Chunking and supervision options of iter_inference_chunks.
+
+    Returns:
+        list: The subjects DLWMLS did not produce a mask for.
+    """
+    failed_mrids = []
+    for done, failed in iter_inference_chunks(mrids, layout, device, **options):
+        if failed:
+            logging.error(f"DLWMLS failed for {failed}")
+            failed_mrids.extend(failed)
+        if mark_done:
+            for mrid in done:
+                mark_stage_done(layout, mrid, 'dlwmls')
+    return failed_mrids
+
+
+def _transform_cache_key(mrid: str, layout: dict) -> Optional[str]:
+    """
+    Key of the subject's transform in the transform cache (None if there is no cache).
+    """
+    if not layout.get('tfm_cache_dir'):
+        return None
+    return cache.transform_key(input_path(mrid, layout, 't1'),
+                               input_path(mrid, layout, 'fl'),
+                               layout.get('registration'))
+
+
+def load_subject_images(mrid: str, layout: dict) -> dict:
+    """
+    Reads and decodes the inputs of postprocess_subject: the DLWMLS mask, the
+    DLMUSE map and, unless the subject is already registered, its mask is
+    empty or the transform cache holds its transform (no registration), the
+    LPS T1 and FLAIR images. Otherwise only the grid of the LPS T1 image is
+    read. The transform cache is looked up before the images are read; the
+    key and the cached transform (or None) are returned as 'cache_key' and
+    'transform'.
+
+    Args:
+        mrid (str): The unique identifier of the subject.
+        layout (dict): Input/output folders and file suffixes of the run.
+
+    Returns:
+        dict: The images, see utils.register_and_segment_subject.
+    """
+    with stage('load', mrid):
+        mask = sitk.ReadImage(os.path.join(layout['dlwmls_dir'], mrid + layout['dlwmls_suff']), sitk.sitkFloat32)
+        t1_path = os.path.join(layout['t1_lps_dir'], mrid + layout['t1_lps_suff'])
+        images: Dict[str, Any] = {'mask': mask}
+        register = not stage_done(layout, mrid, 'register') and bool(np.any(sitk.GetArrayViewFromImage(mask)))
+        cache_key = _transform_cache_key(mrid, layout) if register else None
+        if cache_key:
+            images['cache_key'] = cache_key
+            images['transform'] = cache.read_transform(layout['tfm_cache_dir'], cache_key)
+            register = images['transform'] is None
+        if register:
+            images['t1'] = sitk.ReadImage(t1_path, sitk.sitkFloat32)
+            images['flair'] = sitk.ReadImage(os.path.join(layout['flair_lps_dir'], mrid + layout['fl_suff']),
+                                             sitk.sitkFloat32)
+        else:
+            # Not registered here: resampling only needs the T1 grid
+            images['t1'] = read_image_grid(t1_path)
+        images['dlmuse'] = load_label_map(input_path(mrid, layout, 'dlmuse'))
+    return images
+
+
+def postprocess_subject(mrid: str, layout: dict, images: Optional[dict] = None) -> None:
+    """
+    Registers FLAIR to T1, moves the DLWMLS mask to T1 space and splits it by the DLMUSE ROIs.
+
+    The transform and the resampled mask stay in memory; the transform is
+    written to TFMs when layout['keep_transforms'] is set, the resampled mask
+    to DLWMLS_TFM_to_T1 only when layout['keep_intermediate'] is set.
+    A transform that already finished for this subject (see manifest), or
+    that the transform cache holds for the same images and settings, is reused.
+
+    Args:
+        mrid (str): The unique identifier of the subject.
+        layout (dict): Input/output folders and file suffixes of the run.
+        images (dict): Inputs already read by load_subject_images (prefetch).
+    """
+    keep_intermediate = layout.get('keep_intermediate', True)
+    keep_transforms = layout.get('keep_transforms', keep_intermediate)
+    transform_path = os.path.join(layout['tfm_dir'], mrid + layout['fl_to_t1_xfm_suff'])
+    registered_mask_path = os.path.join(layout['dlwmls_tfmed_dir'], mrid + layout['dlwmls_to_t1_reg_suff'])
+
+    images = images if images is not None else {}
+    transform = None
+    cache_key = None
+    if stage_done(layout, mrid, 'register'):
+        logging.info(f"Reading transform from {transform_path}...")
+        transform = sitk.ReadTransform(transform_path)
+    elif 'cache_key' in images:
+        # Already looked up by load_subject_images
+        cache_key, transform = images.pop('cache_key'), images.pop('transform')
+    else:
+        cache_key = _transform_cache_key(mrid, layout)
+        if cache_key:
+            transform = cache.read_transform(layout['tfm_cache_dir'], cache_key)
+    if cache_key and transform is not None:
+        logging.info(f"Reusing cached transform {cache_key}")
+        if keep_transforms:
+            sitk.WriteTransform(transform, transform_path)
+    registered = transform is None
+
+    transform = register_and_segment_subject(t1_image_path=os.path.join(layout['t1_lps_dir'], mrid + layout['t1_lps_suff']),
+                                             flair_image_path=os.path.join(layout['flair_lps_dir'], mrid + layout['fl_suff']),
+                                             dlwmls_mask_path=os.path.join(layout['dlwmls_dir'], mrid + layout['dlwmls_suff']),
+                                             dlmuse_mask_path=input_path(mrid, layout, 'dlmuse'),
+                                             output_path=os.path.join(layout['segmented_dir'], mrid + layout['dlwmls_dlmuse_segmented_suff']),
+                                             csv_path=os.path.join(layout['out_dir'], mrid + layout['dlwmls_roi_volume_csv_suff']),
+                                             mrid=mrid,
+                                             transform=transform,
+                                             transform_path=transform_path if keep_transforms and registered else '',
+                                             registered_mask_path=registered_mask_path if keep_intermediate else '',
+                                             registration=layout.get('registration'),
+                                             cohort_table=layout.get('cohort_table', ''),
+                                             labels=layout.get('labels'),
+                                             compresslevel=layout.get('compresslevel'),
+                                             images=images,
+                                             composites=layout.get('composites'),
+                                             cohort_store=layout.get('cohort_store', ''))
+    # No transform: the DLWMLS mask is empty and registration was skipped
+    if registered and cache_key and transform is not None:
+        cache.store(layout['tfm_cache_dir'], cache_key, transform, layout.get('tfm_cache_max_bytes', 0))
+    if keep_transforms and transform is not None:
+        mark_stage_done(layout, mrid, 'register')
+    if keep_intermediate:
+        mark_stage_done(layout, mrid, 'apply')
+    mark_stage_done(layout, mrid, 'segment')
+
+
+def register_subject(mrid: str, layout: dict) -> None:
+    """
+    Registers the LPS FLAIR image of one subject to its LPS T1 image and saves the transform.
+
+    A transform that the transform cache holds for the same images and
+    settings is copied instead, skipping registration.
+
+    Args:
+        mrid (str): The unique identifier of the subject.
+        layout (dict): Input/output folders and file suffixes of the run.
+    """
+    if stage_done(layout, mrid, 'register'):
+        return
+    transform_path = os.path.join(layout['tfm_dir'], mrid + layout['fl_to_t1_xfm_suff'])
+    cache_key = _transform_cache_key(mrid, layout)
+    if cache_key and cache.fetch(layout['tfm_cache_dir'], cache_key, transform_path):
+        logging.info(f"Reusing cached transform {cache_key}")
+    else:
+        with stage('register', mrid) as record:
+            report = register_flair_to_t1(t1_image_path=os.path.join(layout['t1_lps_dir'], mrid + layout['t1_lps_suff']),
+                                          flair_image_path=os.path.join(layout['flair_lps_dir'], mrid + layout['fl_suff']),
+                                          output_path=transform_path,
+                                          settings=layout.get('registration'))
+            record.update(registration_record(report))
+        if cache_key:
+            cache.store(layout['tfm_cache_dir'], cache_key, sitk.ReadTransform(transform_path),
+                        layout.get('tfm_cache_max_bytes', 0))
+    mark_stage_done(layout, mrid, 'register')
+
+
+def finish_subject(mrid: str, layout: dict) -> None:
+    """
+    Moves the DLWMLS mask of one subject to T1 space with its saved transform
+    and splits it by the DLMUSE ROIs.
+
+    Args:
+        mrid (str): The unique identifier of the subject.
+        layout (dict): Input/output folders and file suffixes of the run.
+    """
+    keep_intermediate = layout.get('keep_intermediate', True)
+    transform_path = os.path.join(layout['tfm_dir'], mrid + layout['fl_to_t1_xfm_suff'])
+    registered_mask_path = os.path.join(layout['dlwmls_tfmed_dir'], mrid + layout['dlwmls_to_t1_reg_suff'])
+
+    logging.info(f"Reading transform from {transform_path}...")
+    register_and_segment_subject(t1_image_path=os.path.join(layout['t1_lps_dir'], mrid + layout['t1_lps_suff']),
+                                 flair_image_path=os.path.join(layout['flair_lps_dir'], mrid + layout['fl_suff']),
+                                 dlwmls_mask_path=os.path.join(layout['dlwmls_dir'], mrid + layout['dlwmls_suff']),
+                                 dlmuse_mask_path=input_path(mrid, layout, 'dlmuse'),
+                                 output_path=os.path.join(layout['segmented_dir'], mrid + layout['dlwmls_dlmuse_segmented_suff']),
+                                 csv_path=os.path.join(layout['out_dir'], mrid + layout['dlwmls_roi_volume_csv_suff']),
+                                 mrid=mrid,
+                                 transform=sitk.ReadTransform(transform_path),
+                                 registered_mask_path=registered_mask_path if keep_intermediate else '',
+                                 cohort_table=layout.get('cohort_table', ''),
+                                 labels=layout.get('labels'),
+                                 compresslevel=layout.get('compresslevel'),
+                                 composites=layout.get('composites'),
+                                 cohort_store=layout.get('cohort_store', ''))
+    if keep_intermediate:
+        mark_stage_done(layout, mrid, 'apply')
+    mark_stage_done(layout, mrid, 'segment')
+
+
+def remove_subject_intermediates(mrid: str, layout: dict) -> None:
+    """
+    Removes the intermediate files of one subject that a rerun does not need,
+    keeping its final outputs.
+
+    The LPS T1 image, the DLWMLS mask and (with layout['keep_transforms'])
+    the transform are kept: a later run that only has to redo the stages
+    after them (e.g. for a new DLMUSE map) reuses them instead of running
+    DLWMLS and registration again.
+    """
+    paths = [os.path.join(layout['flair_lps_dir'], mrid + layout['fl_suff'])]
+    if not layout.get('keep_transforms', False):
+        paths += stage_outputs(mrid, layout, 'register')
+    paths += stage_outputs(mrid, layout, 'apply')
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def available_cpus() -> int:
+    """
+    Number of cores this process may run on (honours CPU affinity/cgroup sets).
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def threads_per_job(jobs: int) -> int:
+    """
+    Splits the available cores evenly between the workers of a pool.
+
+    Args:
+        jobs (int): Number of worker processes.
+
+    Returns:
+        int: Number of threads each worker may use (at least 1).
+    """
+    return max(1, available_cpus() // max(1, jobs))
+
+
+def init_worker(num_threads: int, instrumentation: Optional[dict] = None) -> None:
+    """
+    Caps the internal threads of SimpleITK in a pool worker so that the
+    workers together do not oversubscribe the cores.
+
+    Args:
+        num_threads (int): Number of threads SimpleITK filters may use.
+        instrumentation (dict): Instrumentation settings of the run (see instrumentation.get_config).
+    """
+    os.environ['ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS'] = str(num_threads)
+    sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(num_threads)
+    configure(**(instrumentation or {}))
+
+
+def subject_pool(jobs: int) -> ProcessPoolExecutor:
+    """
+    Creates the process pool of the per-subject stages, with the SimpleITK
+    threads of every worker capped (see init_worker).
+
+    Args:
+        jobs (int): Number of worker processes.
+
+    Returns:
+        ProcessPoolExecutor: The pool; the caller shuts it down.
+    """
+    num_threads = threads_per_job(jobs)
+    logging.info(f"Starting {jobs} workers ({num_threads} threads each)")
+    return ProcessPoolExecutor(max_workers=jobs,
+                               initializer=init_worker,
+                               initargs=(num_threads, get_config()))
+
+
+def run_subjects(func: Callable[..., Any],
+                 mrids: List[str],
+                 layout: dict,
+                 jobs: int = 1,
+                 isolate: bool = True,
+                 executor: Optional[Executor] = None,
+                 load: Optional[Callable[[str, dict], Any]] = None) -> List[str]:
+    """
+    Runs a per-subject stage for every subject, in a process pool when jobs > 1.
+
+    Args:
+        func (Callable): Stage function called as func(mrid, layout).
+                         Must be defined at module level so it can be pickled.
+        mrids (list): Subjects to process.
+        layout (dict): Input/output folders and file suffixes of the run.
+        jobs (int): Number of worker processes (1 runs in this process).
+        isolate (bool): If True, a failing subject is reported and excluded
+                        instead of stopping the run.
+        executor (Executor): Long-lived pool to run the subjects in (see
+                             subject_pool); jobs is then ignored and the
+                             pool is left running.
+        load (Callable): Reads the inputs of a subject, called as load(mrid, layout).
+                         Without a pool, the inputs of the next subjects are read
+                         in the background while a subject is processed (see
+                         layout['prefetch']), and func is called as
+                         func(mrid, layout, inputs).
+
+    Returns:
+        list: The subjects that failed (only when isolate is True).
+    """
+    failed = []
+    if executor is None and jobs <= 1:
+        prefetch = layout.get('prefetch')
+        prefetcher = None
+        if load is not None and prefetch and prefetch.get('depth', 0) > 0:
+            prefetcher = Prefetcher(lambda mrid: load(mrid, layout), mrids,
+                                    depth=prefetch['depth'], max_bytes=prefetch.get('max_bytes', 0))
+        try:
+            for mrid in mrids:
+                try:
+                    if prefetcher is not None:
+                        func(mrid, layout, prefetcher.get(mrid))
+                    else:
+                        func(mrid, layout)
+                except Exception as e:
+                    if not isolate:
+                        raise
+                    print(f"{mrid} excluded due to {e}")
+                    failed.append(mrid)
+        finally:
+            if prefetcher is not None:
+                prefetcher.close()
+        return failed
+
+    logging.info(f"Running {func.__name__} on {len(mrids)} subjects")
+    with subject_pool(jobs) if executor is None else nullcontext(executor) as executor:
+        futures = {executor.submit(func, mrid, subject_layout(layout, mrid)): mrid for mrid in mrids}
+        for future in as_completed(futures):
+            mrid = futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                if not isolate:
+                    for pending in futures:
+                        pending.cancel()
+                    raise
+                print(f"{mrid} excluded due to {e}")
+                failed.append(mrid)
+    return failed
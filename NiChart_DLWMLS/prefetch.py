@@ -0,0 +1,131 @@
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+import SimpleITK as sitk
+
+
+def loaded_bytes(value: Any) -> int:
+    """
+    Memory held by decoded images: numpy arrays and SimpleITK images, also
+    inside dicts, lists and tuples (anything else counts as 0).
+    """
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, sitk.Image):
+        return int(value.GetNumberOfPixels() * value.GetNumberOfComponentsPerPixel() * value.GetSizeOfPixelComponent())
+    if isinstance(value, dict):
+        return sum(loaded_bytes(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(loaded_bytes(v) for v in value)
+    return 0
+
+
+class Prefetcher:
+    """
+    Reads and decodes the inputs of the next subjects in background threads
+    while the current subject is processed.
+
+    Subjects are loaded in the order of mrids, at most depth of them ahead of
+    the one being processed. No new load starts while the loaded subjects that
+    were not taken yet hold max_bytes or more, so the cap can only be exceeded
+    by the loads already running.
+    """
+
+    def __init__(self,
+                 load: Callable[[str], Any],
+                 mrids: List[str],
+                 depth: int = 1,
+                 max_bytes: int = 0,
+                 workers: Optional[int] = None) -> None:
+        """
+        Args:
+            load (Callable): Reads the inputs of one subject, called as load(mrid).
+            mrids (list): Subjects, in the order they are taken.
+            depth (int): Number of subjects loaded ahead.
+            max_bytes (int): Memory cap of the loaded subjects (0: no cap).
+            workers (int): Loading threads (Default: depth).
+        """
+        self.load = load
+        self.mrids = list(mrids)
+        self.depth = max(1, depth)
+        self.max_bytes = max_bytes
+        self._next = 0
+        self._futures: Dict[str, Future] = {}
+        self._sizes: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers or self.depth, thread_name_prefix='prefetch')
+        self._fill()
+
+    def _held_bytes(self) -> int:
+        with self._lock:
+            return sum(self._sizes.values())
+
+    def _loaded(self, mrid: str, future: Future) -> None:
+        if not future.cancelled() and future.exception() is None:
+            with self._lock:
+                if mrid in self._futures:
+                    self._sizes[mrid] = loaded_bytes(future.result())
+
+    def _submit(self, mrid: str) -> Future:
+        future = self._executor.submit(self.load, mrid)
+        self._futures[mrid] = future
+        future.add_done_callback(partial(self._loaded, mrid))
+        return future
+
+    def _fill(self) -> None:
+        while self._next < len(self.mrids) and len(self._futures) < self.depth:
+            if self.max_bytes and self._futures and self._held_bytes() >= self.max_bytes:
+                break
+            mrid = self.mrids[self._next]
+            self._next += 1
+            self._submit(mrid)
+
+    def get(self, mrid: str) -> Any:
+        """
+        Waits for the inputs of a subject and starts loading the next ones.
+
+        A subject whose load did not start yet (held back by the memory cap,
+        or taken out of order) is loaded now, skipping ahead to it.
+
+        Returns:
+            The result of load(mrid), or None if loading failed or mrid is
+            not in mrids or was already taken (the stage then reads, and
+            reports, the inputs itself).
+        """
+        future = self._futures.get(mrid)
+        if future is None and mrid in self.mrids[self._next:]:
+            self._next = self.mrids.index(mrid, self._next) + 1
+            future = self._submit(mrid)
+        try:
+            if future is None:
+                return None
+            try:
+                return future.result()
+            except Exception as e:
+                logging.info(f"{mrid}: prefetching the inputs failed ({e})")
+                return None
+        finally:
+            with self._lock:
+                self._futures.pop(mrid, None)
+                self._sizes.pop(mrid, None)
+            self._fill()
+
+    def close(self) -> None:
+        """
+        Drops the loads that did not start and waits for the running ones.
+        """
+        for future in self._futures.values():
+            future.cancel()
+        self._executor.shutdown(wait=True)
+        self._futures.clear()
+        self._sizes.clear()
+
+    def __enter__(self) -> "Prefetcher":
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        self.close()
@@ -0,0 +1,112 @@
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple, cast
+
+import nibabel as nib
+import numpy as np
+
+from .utils import GRID_TOLERANCE
+
+
+def index_dir(path: str, suffix: str) -> Dict[str, str]:
+    """
+    Indexes the files of a folder by subject, with a single directory scan.
+
+    Args:
+        path (str): The folder to index.
+        suffix (str): File suffix; the rest of the file name is the MRID.
+
+    Returns:
+        dict: Path of every file ending with suffix, by MRID.
+    """
+    index: Dict[str, str] = {}
+    if not path or not os.path.isdir(path):
+        return index
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.name.endswith(suffix) and len(entry.name) > len(suffix) and not entry.is_dir():
+                index[entry.name[:-len(suffix)]] = entry.path
+    return index
+
+
+def _check_header(kind: str, img: nib.Nifti1Image) -> Optional[str]:
+    """
+    Sanity checks of one image header (None if it passes).
+    """
+    shape = img.shape
+    if len(shape) < 3 or len(shape) > 4 or (len(shape) == 4 and shape[3] != 1):
+        return f"{kind} image is not 3D (shape {shape})"
+    if min(shape[:3]) < 2:
+        return f"{kind} image has a degenerate shape {shape}"
+    affine = img.affine
+    if not np.all(np.isfinite(affine)) or abs(np.linalg.det(affine[:3, :3])) < 1e-6:
+        return f"{kind} image has an invalid affine"
+    return None
+
+
+def lps_grid(img: nib.Nifti1Image) -> Tuple[Tuple[int, ...], np.ndarray]:
+    """
+    Shape and affine an image gets from reorient_to_lps, computed from its header.
+    """
+    shape = img.shape[:3]
+    start = nib.orientations.axcodes2ornt(nib.aff2axcodes(img.affine))
+    transform = nib.orientations.ornt_transform(start, nib.orientations.axcodes2ornt(('L', 'P', 'S')))
+    affine = img.affine @ nib.orientations.inv_ornt_aff(transform, shape)
+    lps_shape = tuple(int(shape[int(axis)]) for axis in np.argsort(transform[:, 0]))
+    return lps_shape, affine
+
+
+def check_subject(paths: Dict[str, Optional[str]]) -> Optional[str]:
+    """
+    Checks the inputs of one subject from their headers only (no voxel data is read).
+
+    Args:
+        paths (dict): Input paths by kind ('fl', 't1', 'dlmuse'); None if missing.
+
+    Returns:
+        str or None: The reason the subject would fail, or None if it passes.
+    """
+    names = {'fl': 'FLAIR', 't1': 'T1', 'dlmuse': 'DLMUSE'}
+    images = {}
+    for kind, path in paths.items():
+        if not path:
+            return f"missing {names[kind]} image"
+        try:
+            images[kind] = cast(nib.Nifti1Image, nib.load(path))
+        except Exception as e:
+            return f"unreadable {names[kind]} image ({e})"
+        error = _check_header(names[kind], images[kind])
+        if error:
+            return error
+
+    if 't1' in images and 'dlmuse' in images:
+        t1_shape, t1_affine = lps_grid(images['t1'])
+        dlmuse = images['dlmuse']
+        if t1_shape != dlmuse.shape[:3]:
+            return f"DLMUSE shape {dlmuse.shape[:3]} does not match the LPS T1 shape {t1_shape}"
+        if not np.allclose(t1_affine, dlmuse.affine, atol=GRID_TOLERANCE):
+            return "DLMUSE affine does not match the LPS T1 affine"
+    return None
+
+
+def preflight(mrids: List[str], inputs: Dict[str, Dict[str, str]], workers: int = 8) -> Dict[str, str]:
+    """
+    Checks the inputs of every subject before any heavy work starts.
+
+    Args:
+        mrids (list): Subjects to check.
+        inputs (dict): Index of every input kind ('fl', 't1', 'dlmuse'), see index_dir.
+        workers (int): Threads reading the headers.
+
+    Returns:
+        dict: The reason of every subject that would fail, by MRID.
+    """
+    def check(mrid: str) -> Optional[str]:
+        return check_subject({kind: index.get(mrid) for kind, index in inputs.items()})
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        errors = list(executor.map(check, mrids))
+    failed = {mrid: error for mrid, error in zip(mrids, errors) if error}
+    logging.info(f"Preflight: {len(mrids) - len(failed)} of {len(mrids)} subjects passed")
+    return failed
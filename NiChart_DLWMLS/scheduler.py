@@ -0,0 +1,167 @@
+import logging
+import queue
+import threading
+from concurrent.futures import FIRST_COMPLETED, Executor, Future, wait
+from contextlib import nullcontext
+from typing import Dict, List, Optional, Set, Tuple
+
+from .manifest import mark_stage_done, subject_layout
+from .pipeline import (
+    finish_subject,
+    iter_inference_chunks,
+    register_subject,
+    reorient_subject,
+    subject_pool
+)
+
+
+class _InferenceThread(threading.Thread):
+    """
+    Runs DLWMLS in the background on the batches of subjects it is handed,
+    one batch after the other and chunk by chunk, and posts every finished
+    chunk, as (done, failed) subjects, to a queue. A None batch ends it.
+    """
+
+    def __init__(self, layout: dict, inference: dict) -> None:
+        super().__init__(daemon=True)
+        self.layout = layout
+        self.inference = inference
+        self.batches: "queue.Queue[Optional[List[str]]]" = queue.Queue()
+        self.events: "queue.Queue[Tuple[List[str], List[str]]]" = queue.Queue()
+        self.error: Optional[Exception] = None
+
+    def run(self) -> None:
+        while True:
+            batch = self.batches.get()
+            if batch is None:
+                return
+            try:
+                for done, failed in iter_inference_chunks(batch, self.layout, **self.inference):
+                    self.events.put((done, failed))
+            except Exception as e:
+                logging.error(f"DLWMLS failed on {batch}: {e}")
+                self.error = e
+                self.events.put(([], batch))
+
+
+def run_overlapped(plans: Dict[str, List[str]],
+                   layout: dict,
+                   inference: dict,
+                   jobs: int = 1,
+                   poll_interval: float = 1.0,
+                   executor: Optional[Executor] = None) -> List[str]:
+    """
+    Runs the pipeline as a per-subject stage graph instead of stage barriers.
+
+    Registration of a subject starts as soon as its LPS images exist, while
+    DLWMLS inference runs chunk by chunk in the background; the transform is
+    applied and the ROIs are split as soon as the chunk holding the subject's
+    DLWMLS mask finishes. CPU-bound registration thus overlaps inference.
+
+    With a chunk size, inference starts as soon as enough LPS FLAIR images
+    for a chunk on every inference worker exist, so it also overlaps
+    reorientation; without one, all subjects go to DLWMLS in one batch.
+
+    Args:
+        plans (dict): Stages every subject runs (see manifest.plan_stages).
+        layout (dict): Input/output folders and file suffixes of the run.
+        inference (dict): Device and chunking options of iter_inference_chunks.
+        jobs (int): Number of worker processes for the per-subject stages.
+        poll_interval (float): Seconds between checks for finished inference chunks.
+        executor (Executor): Long-lived pool to run the stages in (see
+                             pipeline.subject_pool); jobs is then ignored.
+
+    Returns:
+        list: The subjects that failed.
+    """
+    failed = []
+    # Subjects still waiting for each dependency
+    reorienting = {m for m, s in plans.items() if 'reorient' in s}
+    needs_inference = [m for m, s in plans.items() if 'dlwmls' in s]
+    waiting_mask = set(needs_inference)
+    # Subjects whose LPS FLAIR exists, not yet handed to DLWMLS
+    ready = [m for m in needs_inference if m not in reorienting]
+    batch_size = inference.get('chunk_size', 0) * max(1, inference.get('workers', 1))
+    registered: Set[str] = set()
+    finishing: Set[str] = set()
+    inference_thread = _InferenceThread(layout, inference)
+    inference_thread.start()
+    inference_closed = False
+
+    def exclude(mrid: str, error: object) -> None:
+        print(f"{mrid} excluded due to {error}")
+        failed.append(mrid)
+        waiting_mask.discard(mrid)
+
+    logging.info(f"Running the stage graph on {len(plans)} subjects")
+    with subject_pool(jobs) if executor is None else nullcontext(executor) as executor:
+        futures: Dict[Future, Tuple[str, str]] = {}
+
+        def submit(stage: str, mrid: str) -> None:
+            func = {'reorient': reorient_subject, 'register': register_subject, 'finish': finish_subject}[stage]
+            futures[executor.submit(func, mrid, subject_layout(layout, mrid))] = (stage, mrid)
+
+        for mrid, stages in plans.items():
+            submit('reorient' if 'reorient' in stages else 'register', mrid)
+
+        while True:
+            # Hand the subjects whose LPS FLAIR exists to DLWMLS, a full batch at a
+            # time, and the rest once no subject that needs inference is reorienting
+            if not inference_closed:
+                while batch_size and len(ready) >= batch_size:
+                    logging.info(f"Processing DLWMLS on {batch_size} FLAIR images")
+                    inference_thread.batches.put(ready[:batch_size])
+                    del ready[:batch_size]
+                if not reorienting & waiting_mask:
+                    if ready:
+                        logging.info(f"Processing DLWMLS on {len(ready)} FLAIR images")
+                        inference_thread.batches.put(ready)
+                        ready = []
+                    inference_thread.batches.put(None)
+                    inference_closed = True
+
+            # Pick up the masks of the chunks DLWMLS has finished so far
+            inference_running = inference_thread.is_alive()
+            while not inference_thread.events.empty():
+                done, failed_chunk = inference_thread.events.get()
+                for mrid in done:
+                    if mrid in waiting_mask:
+                        waiting_mask.discard(mrid)
+                        mark_stage_done(layout, mrid, 'dlwmls')
+                for mrid in failed_chunk:
+                    if mrid in waiting_mask:
+                        exclude(mrid, "DLWMLS failed")
+            if not inference_running:
+                for mrid in sorted(waiting_mask):
+                    exclude(mrid, inference_thread.error or "missing DLWMLS mask")
+
+            # Apply/segment once both the transform and the mask exist
+            for mrid in sorted(registered - waiting_mask - finishing - set(failed)):
+                finishing.add(mrid)
+                submit('finish', mrid)
+
+            if not futures and not inference_running:
+                break
+
+            if not futures:
+                inference_thread.join(poll_interval)
+                continue
+            done_futures, _ = wait(list(futures), timeout=poll_interval, return_when=FIRST_COMPLETED)
+            for future in done_futures:
+                stage, mrid = futures.pop(future)
+                try:
+                    future.result()
+                except Exception as e:
+                    if stage == 'reorient':
+                        reorienting.discard(mrid)
+                    exclude(mrid, e)
+                    continue
+                if stage == 'reorient':
+                    reorienting.discard(mrid)
+                    if mrid in waiting_mask:
+                        ready.append(mrid)
+                    submit('register', mrid)
+                elif stage == 'register':
+                    registered.add(mrid)
+
+    return failed
@@ -0,0 +1,175 @@
+import glob
+import heapq
+import json
+import logging
+import os
+import shutil
+from typing import Dict, List, Optional, Tuple
+
+import pandas as pd
+
+from .cohort_store import COHORT_STORE_NAME, merge_store
+from .cohort_table import COHORT_TABLE_NAME, INDEX_COLUMN, read_table
+from .instrumentation import save_report, summarize
+
+SHARDS_DIR = 'shards'
+REPORT_NAME = 'run_report'
+
+
+def parse_shard(value: str) -> Tuple[int, int]:
+    """
+    Parses a shard specification 'i/N' (0 <= i < N).
+
+    Returns:
+        tuple: (index, count).
+    """
+    try:
+        index, count = (int(v) for v in value.split('/'))
+    except ValueError:
+        raise ValueError(f"Invalid shard {value!r}, expected i/N (e.g. 0/10)") from None
+    if count < 1 or not 0 <= index < count:
+        raise ValueError(f"Invalid shard {value!r}, expected 0 <= i < N")
+    return index, count
+
+
+def shard_dir(out_dir: str, index: int, count: int) -> str:
+    """
+    Output sub-tree of one shard.
+    """
+    return os.path.join(out_dir, SHARDS_DIR, f'shard_{index:04d}_of_{count:04d}')
+
+
+def partition(mrids: List[str], inputs: Dict[str, Dict[str, str]], count: int) -> List[List[str]]:
+    """
+    Splits the subjects into count shards of balanced total input size.
+
+    Subjects are assigned largest first to the shard with the smallest total
+    (longest-processing-time rule). The result only depends on the subjects
+    and their input sizes, so every array task computes the same partition.
+
+    Args:
+        mrids (list): All subjects of the cohort.
+        inputs (dict): Index of every input kind, see preflight.index_dir.
+        count (int): Number of shards.
+
+    Returns:
+        list: The subjects of every shard, each in the order of mrids.
+    """
+    def size(mrid: str) -> int:
+        total = 0
+        for index in inputs.values():
+            try:
+                total += os.stat(index[mrid]).st_size
+            except (KeyError, OSError):
+                pass
+        return total
+
+    order = {mrid: k for k, mrid in enumerate(mrids)}
+    heap = [(0, shard) for shard in range(count)]
+    assigned: List[List[str]] = [[] for _ in range(count)]
+    for mrid in sorted(mrids, key=lambda m: (-size(m), m)):
+        total, shard = heapq.heappop(heap)
+        assigned[shard].append(mrid)
+        heapq.heappush(heap, (total + size(mrid), shard))
+    return [sorted(shard, key=order.__getitem__) for shard in assigned]
+
+
+def _move_tree(src: str, dst: str, keep: bool) -> int:
+    """
+    Moves (or copies, with keep) every file of src into the same place under dst.
+
+    Returns:
+        int: Number of files merged.
+    """
+    merged = 0
+    for root, _, files in os.walk(src):
+        target_dir = os.path.join(dst, os.path.relpath(root, src))
+        os.makedirs(target_dir, exist_ok=True)
+        for name in files:
+            target = os.path.join(target_dir, name)
+            if os.path.exists(target):
+                logging.warning(f"Overwriting {target} with the file of {src}")
+            if keep:
+                shutil.copy2(os.path.join(root, name), target)
+            else:
+                os.replace(os.path.join(root, name), target)
+            merged += 1
+    return merged
+
+
+def merge_shards(out_dir: str, keep_shards: bool = False, mrids: Optional[List[str]] = None) -> dict:
+    """
+    Combines the shard sub-trees of out_dir into the standard output layout.
+
+    Subject outputs (segmented masks, volume CSVs, manifests and any kept
+    intermediates) are moved into out_dir. The cohort tables are concatenated,
+    the cohort stores appended to one store, and the run reports are merged,
+    with the summary recomputed over all records.
+
+    Args:
+        out_dir (str): The --out_dir the shards were run with.
+        keep_shards (bool): Copy instead of move, and keep the shard folders.
+        mrids (list): Row order of the cohort table (default: sorted MRIDs).
+
+    Returns:
+        dict: Number of shards, merged files and cohort rows.
+    """
+    shards = sorted(glob.glob(os.path.join(out_dir, SHARDS_DIR, 'shard_*')))
+    if not shards:
+        raise ValueError(f"No shards found in {os.path.join(out_dir, SHARDS_DIR)}")
+
+    tables = []
+    records: List[dict] = []
+    runs = []
+    merged = 0
+    for shard in shards:
+        table_path = os.path.join(shard, COHORT_TABLE_NAME + '.csv')
+        if os.path.exists(table_path):
+            tables.append(read_table(table_path))
+        report_path = os.path.join(shard, REPORT_NAME + '.json')
+        if os.path.exists(report_path):
+            with open(report_path) as f:
+                report = json.load(f)
+            records.extend(report.get('records', []))
+            runs.append(dict(report.get('run', {}), shard=os.path.basename(shard)))
+        for name in os.listdir(shard):
+            path = os.path.join(shard, name)
+            if name.startswith(COHORT_TABLE_NAME + '.') or name.startswith(REPORT_NAME + '.'):
+                continue
+            if name == COHORT_STORE_NAME:
+                merge_store(path, os.path.join(out_dir, COHORT_STORE_NAME))
+                continue
+            if os.path.isdir(path):
+                merged += _move_tree(path, os.path.join(out_dir, name), keep_shards)
+            else:
+                target = os.path.join(out_dir, name)
+                if keep_shards:
+                    shutil.copy2(path, target)
+                else:
+                    os.replace(path, target)
+                merged += 1
+
+    rows = 0
+    if tables:
+        columns = list(dict.fromkeys(c for table in tables for c in table.columns))
+        cohort = pd.concat([t.reindex(columns=columns, fill_value=0.0) for t in tables])
+        cohort = cohort[~cohort.index.duplicated(keep='last')]
+        order = mrids if mrids is not None else sorted(cohort.index)
+        cohort = cohort.reindex([m for m in order if m in cohort.index])
+        cohort.index.name = INDEX_COLUMN
+        cohort.to_csv(os.path.join(out_dir, COHORT_TABLE_NAME + '.csv'))
+        rows = len(cohort)
+        if any(os.path.exists(os.path.join(shard, COHORT_TABLE_NAME + '.parquet')) for shard in shards):
+            try:
+                cohort.to_parquet(os.path.join(out_dir, COHORT_TABLE_NAME + '.parquet'))
+            except ImportError as e:
+                logging.warning(f"Parquet output skipped: {e}")
+
+    if runs:
+        save_report({'run': {'shards': runs}, 'summary': summarize(records), 'records': records},
+                    os.path.join(out_dir, REPORT_NAME))
+
+    if not keep_shards:
+        shutil.rmtree(os.path.join(out_dir, SHARDS_DIR))
+    logging.info(f"Merged {len(shards)} shards: {merged} files, {rows} subjects in the cohort table")
+    return {'shards': len(shards), 'files': merged, 'subjects': rows}
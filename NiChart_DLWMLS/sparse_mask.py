@@ -0,0 +1,181 @@
+import io
+import logging
+import os
+from typing import List, Tuple, cast
+
+import nibabel as nib
+import numpy as np
+
+# Extension of the compact (sparse) segmented masks
+SPARSE_EXT = '.npz'
+NIFTI_EXT = '.nii.gz'
+SPARSE_FORMAT_VERSION = 1
+
+
+def encode_runs(data: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Run-length encodes the non-zero voxels of a label image.
+
+    Voxels are taken in NIfTI (Fortran) order, so a run follows the first
+    axis. A run is a span of consecutive voxels with the same label.
+
+    Args:
+        data (np.ndarray): The label image.
+
+    Returns:
+        tuple: (starts, lengths, values): linear index of the first voxel,
+               number of voxels and label of every run.
+    """
+    flat = data.ravel(order='F')
+    index = np.flatnonzero(flat)
+    if index.size == 0:
+        return np.zeros(0, np.int64), np.zeros(0, np.uint32), np.zeros(0, flat.dtype)
+    values = flat[index]
+    # A run ends where the next voxel is not adjacent or has another label
+    breaks = np.flatnonzero((np.diff(index) != 1) | (values[1:] != values[:-1])) + 1
+    first = np.concatenate(([0], breaks))
+    lengths = np.diff(np.concatenate((first, [index.size])))
+    return index[first].astype(np.int64), lengths.astype(np.uint32), values[first]
+
+
+def decode_runs(starts: np.ndarray,
+                lengths: np.ndarray,
+                values: np.ndarray,
+                shape: Tuple[int, ...],
+                dtype: np.dtype) -> np.ndarray:
+    """
+    Rebuilds the dense label image of encode_runs.
+    """
+    flat = np.zeros(int(np.prod(shape)), dtype=dtype)
+    lengths = lengths.astype(np.int64)
+    total = int(lengths.sum())
+    if total:
+        # Linear index of every voxel: its run start plus its offset in the run
+        run_offsets = np.repeat(np.cumsum(lengths) - lengths, lengths)
+        index = np.repeat(starts, lengths) + (np.arange(total) - run_offsets)
+        flat[index] = np.repeat(values, lengths)
+    return flat.reshape(shape, order='F')
+
+
+def save_sparse(img: nib.Nifti1Image, output_path: str) -> None:
+    """
+    Saves a label image as its lesion voxels only: the run-length encoded
+    labels with the shape, affine and full NIfTI header (.npz).
+
+    load_sparse rebuilds the image exactly, so saving it as NIfTI again gives
+    the same file as saving img.
+
+    Args:
+        img (nib.Nifti1Image): The label image (integer voxels, no scaling).
+        output_path (str): Output path (.npz).
+    """
+    data = np.asanyarray(img.dataobj)
+    starts, lengths, values = encode_runs(data)
+    header = io.BytesIO()
+    # Written as nibabel would write it for this data (with the extensions)
+    img.update_header()
+    img.header.write_to(header)
+    tmp_path = f"{output_path}.{os.getpid()}.tmp.npz"
+    np.savez_compressed(tmp_path,
+                        version=np.array(SPARSE_FORMAT_VERSION),
+                        shape=np.array(data.shape, dtype=np.int64),
+                        affine=img.affine,
+                        header=np.frombuffer(header.getvalue(), dtype=np.uint8),
+                        starts=starts,
+                        lengths=lengths,
+                        values=values)
+    os.replace(tmp_path, output_path)
+
+
+def load_sparse(path: str) -> nib.Nifti1Image:
+    """
+    Rebuilds the dense NIfTI image of a compact segmented mask.
+
+    Args:
+        path (str): The .npz file written by save_sparse.
+
+    Returns:
+        nib.Nifti1Image: The image, with its original affine and header.
+    """
+    with np.load(path) as f:
+        if int(f['version']) > SPARSE_FORMAT_VERSION:
+            raise ValueError(f"{path}: unsupported sparse format version {int(f['version'])}")
+        header = nib.Nifti1Header.from_fileobj(io.BytesIO(f['header'].tobytes()))
+        data = decode_runs(f['starts'], f['lengths'], f['values'],
+                           tuple(int(n) for n in f['shape']), header.get_data_dtype())
+        affine = f['affine']
+    return nib.Nifti1Image(data, affine, header)
+
+
+def load_segmentation(path: str) -> nib.Nifti1Image:
+    """
+    Reads a segmented mask in either output format (.nii.gz or .npz).
+    """
+    if path.endswith(SPARSE_EXT):
+        return load_sparse(path)
+    return cast(nib.Nifti1Image, nib.load(path))
+
+
+def save_segmentation(img: nib.Nifti1Image, output_path: str) -> None:
+    """
+    Saves a segmented mask in the format given by the extension of output_path.
+    """
+    if output_path.endswith(SPARSE_EXT):
+        save_sparse(img, output_path)
+    else:
+        nib.save(img, output_path)
+
+
+def converted_path(path: str, to: str) -> str:
+    """
+    Path of a segmented mask in the other format ('sparse' or 'nifti').
+    """
+    if to == 'sparse':
+        for ext in ('.nii.gz', '.nii'):
+            if path.endswith(ext):
+                return path[:-len(ext)] + SPARSE_EXT
+        return path
+    if path.endswith(SPARSE_EXT):
+        return path[:-len(SPARSE_EXT)] + NIFTI_EXT
+    return path
+
+
+def convert_folder(folder: str, to: str, keep_source: bool = False) -> List[str]:
+    """
+    Converts the segmented masks of a folder to the compact or the NIfTI format.
+
+    Every converted file is read back and compared with its source (voxels
+    and affine) before the source is removed.
+
+    Args:
+        folder (str): Folder of the segmented masks (e.g. <out_dir>/DLWMLS_DLMUSE_Segmented).
+        to (str): 'sparse' (.npz) or 'nifti' (.nii.gz).
+        keep_source (bool): Keep the files in the old format.
+
+    Returns:
+        list: The files written.
+    """
+    if to not in ('sparse', 'nifti'):
+        raise ValueError(f"Unknown segmented mask format {to!r}")
+    written = []
+    for name in sorted(os.listdir(folder)):
+        src = os.path.join(folder, name)
+        dst = converted_path(src, to)
+        if dst == src or not os.path.isfile(src):
+            continue
+        img = load_segmentation(src)
+        if to == 'sparse':
+            save_sparse(img, dst)
+        else:
+            nib.save(img, dst)
+        copy = load_segmentation(dst)
+        if not (np.array_equal(np.asanyarray(copy.dataobj), np.asanyarray(img.dataobj))
+                and np.array_equal(copy.affine, img.affine)):
+            os.remove(dst)
+            raise RuntimeError(f"{src}: the converted mask differs from the source; source kept")
+        if not keep_source:
+            os.remove(src)
+        written.append(dst)
+        logging.info(f"{src} -> {dst}")
+    logging.info(f"{len(written)} segmented masks converted to {to} in {folder}")
+    return written
@@ -1,21 +1,82 @@
+from __future__ import annotations
+
 import glob
 import os
+import shlex
 import shutil
-from typing import Any
+import subprocess
+import time
+from contextlib import nullcontext
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Sequence, Tuple, Union, cast
 import logging
 
 import numpy as np
-import pandas as pd
-
-import SimpleITK as sitk
 
-import nibabel as nib
+from .instrumentation import stage
+# SimpleITK, nibabel, pandas and the output modules are imported in the
+# functions that use them, so that importing utils (e.g. for the settings
+# or the suffix helpers) stays cheap
+if TYPE_CHECKING:
+    import nibabel as nib
+    import SimpleITK as sitk
 # from nibabel.orientations import axcodes2ornt, ornt_transform
 
 os.environ['CURL_CA_BUNDLE'] = ''
 
 
-def reorient_to_lps(input_path: str, output_path: str):
+def _same_nifti_format(path_a: str, path_b: str) -> bool:
+    return path_a.endswith('.gz') == path_b.endswith('.gz')
+
+
+def nifti_suffix(suffix: str, ext: str) -> str:
+    """
+    Replaces the NIfTI extension of a file suffix (e.g. '_T1.nii.gz', '.nii' -> '_T1.nii').
+    """
+    for old_ext in ('.nii.gz', '.nii'):
+        if suffix.endswith(old_ext):
+            return suffix[:-len(old_ext)] + ext
+    return suffix + ext
+
+
+def save_nifti(img: nib.Nifti1Image, output_path: str, compresslevel: Optional[int] = None) -> None:
+    """
+    Saves a NIfTI image, gzipped at the given level if the path ends with .gz.
+
+    Args:
+        img (nib.Nifti1Image): The image to save.
+        output_path (str): Output path (.nii or .nii.gz).
+        compresslevel (int): gzip level, 1 (fastest) to 9 (smallest). None uses the nibabel default.
+    """
+    import nibabel as nib
+    from nibabel.openers import Opener
+    if compresslevel is None or not output_path.endswith('.gz'):
+        nib.save(img, output_path)
+        return
+    with Opener(output_path, 'wb', compresslevel=compresslevel) as f:
+        f.write(img.to_bytes())
+
+
+def write_image(image: sitk.Image, output_path: str, compresslevel: Optional[int] = None) -> None:
+    """
+    Saves a SimpleITK image. ITK ignores the gzip level of NIfTI files, so a
+    gzipped image with an explicit level is written through nibabel.
+
+    Args:
+        image (sitk.Image): The image to save.
+        output_path (str): Output path (.nii or .nii.gz).
+        compresslevel (int): gzip level, 1 (fastest) to 9 (smallest). None uses the ITK default.
+    """
+    import SimpleITK as sitk
+    import nibabel as nib
+    if compresslevel is None or not output_path.endswith('.gz'):
+        sitk.WriteImage(image, output_path)
+        return
+    # sitk arrays are (z, y, x); the transpose is a view in nibabel (x, y, z) order
+    img = nib.Nifti1Image(sitk.GetArrayViewFromImage(image).T, sitk_image_affine(image))
+    save_nifti(img, output_path, compresslevel)
+
+
+def reorient_to_lps(input_path: str, output_path: str, compresslevel: Optional[int] = None) -> None:
     """
     Reorients a NIfTI image to LPS (Left-Posterior-Superior) orientation.
 
@@ -23,13 +84,25 @@ def reorient_to_lps(input_path: str, output_path: str):
     to reorient it to LPS, applies the transformation to the image data,
     updates the affine matrix, and saves the new image.
 
+    The voxel data keeps its on-disk dtype and scaling, and the axis flips and
+    transposes are applied as views. An image that is already LPS is linked
+    (or byte-copied) to the output instead of being re-encoded. An uncompressed
+    input is memory-mapped rather than read into memory.
+
     Args:
         input_path (str): The file path for the input NIfTI image.
-        output_path (str): The file path where the reoriented NIfTI image will be saved.
+        output_path (str): The file path where the reoriented NIfTI image will be
+                           saved; '.nii' writes it uncompressed.
+        compresslevel (int): gzip level of a '.nii.gz' output (None: nibabel default).
     """
+    import nibabel as nib
     logging.info(f"Loading image: {input_path}")
-    # Load the nifti image
-    img = nib.load(input_path)
+    # Load the nifti image (header only, data is read on demand)
+    img = cast('nib.Nifti1Image', nib.load(input_path, mmap=True))
+
+    # Never write through an existing output, it may be a link to an input
+    if os.path.lexists(output_path):
+        os.remove(output_path)
 
     # Get the original orientation from the affine
     original_orientation = nib.aff2axcodes(img.affine)
@@ -41,9 +114,14 @@ def reorient_to_lps(input_path: str, output_path: str):
 
     if original_orientation == target_orientation:
         logging.info("Image is already in the target LPS orientation. No changes needed.")
-        # If you still want to save a copy, uncomment the line below
-        nib.save(img, output_path)
-        return
+        if _same_nifti_format(input_path, output_path):
+            try:
+                os.link(input_path, output_path)
+            except OSError:
+                shutil.copyfile(input_path, output_path)
+            return
+        # Different compression: the raw data is re-encoded below, with an
+        # identity orientation transform
 
     # Determine the transformation needed to go from original to target orientation
     # axcodes2ornt gives an orientation array, which is a tuple of axis numbers and directions
@@ -53,20 +131,24 @@ def reorient_to_lps(input_path: str, output_path: str):
     # ornt_transform finds the transformation between two orientation arrays
     transform = nib.orientations.ornt_transform(start_ornt, end_ornt)
 
-    # Apply the orientation transform to the image data
+    # Apply the orientation transform to the raw (unscaled, on-disk dtype) data;
+    # apply_orientation only returns flipped/transposed views of it
     logging.info("Applying orientation transform to image data...")
-    reoriented_data = nib.orientations.apply_orientation(img.get_fdata(), transform)
+    proxy: Any = img.dataobj
+    reoriented_data = nib.orientations.apply_orientation(proxy.get_unscaled(), transform)
 
     # The affine matrix needs to be updated to reflect the new data orientation.
     # inv_ornt_aff corrects the affine.
     new_affine = img.affine @ nib.orientations.inv_ornt_aff(transform, img.shape)
 
-    # Create the new NIfTI image object with the reoriented data and new affine
+    # Create the new NIfTI image object with the reoriented data and new affine,
+    # keeping the original scaling so the raw values are written as they are
     new_img = nib.Nifti1Image(reoriented_data, new_affine, img.header)
+    new_img.header.set_slope_inter(proxy.slope, proxy.inter)
 
     # Save the reoriented image
     logging.info(f"Saving reoriented image to: {output_path}")
-    nib.save(new_img, output_path)
+    save_nifti(new_img, output_path, compresslevel)
 
     # # --- Verification (optional) ---
     # # Load the newly saved image and check its orientation
@@ -83,25 +165,270 @@ def run_DLWMLS(in_dir: str,
                out_dir: str,
             #    out_suff: str,
                device: str,
-               extra_args: str = "",) -> None:
+               extra_args: str = "",
+               timeout: Optional[float] = None,
+               env: Optional[dict] = None) -> None:
+    """
+    Runs DLWMLS on a folder of FLAIR images as a supervised subprocess.
+
+    Args:
+        in_dir (str): Folder with the input FLAIR images.
+        out_dir (str): Folder where DLWMLS writes the lesion masks.
+        device (str): Device to run segmentation on.
+        extra_args (str): Additional command line arguments for DLWMLS.
+        timeout (float): Seconds after which DLWMLS is killed (None: no limit).
+        env (dict): Environment of the DLWMLS process (None: inherit).
+
+    Raises:
+        RuntimeError: If DLWMLS fails, cannot be started or times out.
+    """
     if not os.path.exists(out_dir):
         os.mkdir(out_dir)
-    os.system(f"DLWMLS -i {in_dir} -o {out_dir} -device {device} " + extra_args)
+    cmd = ["DLWMLS", "-i", in_dir, "-o", out_dir, "-device", device] + shlex.split(extra_args)
+    logging.info(f"Running: {' '.join(cmd)}")
+    try:
+        result = subprocess.run(cmd, timeout=timeout, env=env)
+    except subprocess.TimeoutExpired:
+        raise RuntimeError(f"DLWMLS timed out after {timeout} seconds on {in_dir}") from None
+    except OSError as e:
+        raise RuntimeError(f"DLWMLS could not be started: {e}") from e
+    if result.returncode != 0:
+        raise RuntimeError(f"DLWMLS exited with status {result.returncode} on {in_dir}")
     
     # for fname in glob.glob(os.path.join(out_dir, "DLMUSE_mask_*.nii.gz")):
     #     new_fname = fname.replace("DLMUSE_mask_", "", 1).replace(in_suff, out_suff)
     #     # os.rename(fname, new_fname)
     #     shutil.copyfile(fname, new_fname)
 
-def register_flair_to_t1(t1_image_path='', 
-                         flair_image_path='', 
-                         output_path='',
-                         data_dir='',
-                         mrid='', 
-                         t1_image_suffix='_T1_LPS.nii.gz', 
-                         fl_image_suffix='_FL_LPS.nii.gz', 
-                         output_dir='',
-                         ):
+
+# Largest tolerated difference (mm) between the affines of images on the same
+# grid (the LPS T1 and the DLMUSE map); preflight checks the inputs with it
+GRID_TOLERANCE = 1e-3
+
+
+def load_label_map(path: str) -> Tuple[nib.Nifti1Image, np.ndarray]:
+    """
+    Reads a label map (e.g. DLMUSE) as a 3D image and its voxels. A single
+    volume 4D image (x, y, z, 1), which preflight accepts, is squeezed to 3D.
+    """
+    import nibabel as nib
+    img = cast('nib.Nifti1Image', nib.load(path))
+    if img.ndim == 4 and img.shape[3] == 1:
+        img = img.slicer[..., 0]
+    return img, np.asanyarray(img.dataobj)
+
+
+# FLAIR -> T1 registration settings. 'default' is the original registration:
+# a single full-resolution affine stage with 100 gradient-descent iterations.
+REGISTRATION_PRESETS: Dict[str, Dict[str, Any]] = {
+    'default': {
+        'shrink_factors': [1],
+        'smoothing_sigmas': [0],
+        'rigid_init': False,
+        'sampling_percentage': 0.01,
+        'iterations': 100,
+        'histogram_bins': 50,
+        'learning_rate': 1.0,
+        'metric_interpolator': 'nearest',
+        'threads': 0,
+        'seed': None,
+    },
+    'fast': {
+        'shrink_factors': [4, 2],
+        'smoothing_sigmas': [2, 1],
+        'rigid_init': False,
+        'sampling_percentage': 0.01,
+        'iterations': 50,
+        'histogram_bins': 32,
+        'learning_rate': 1.0,
+        'metric_interpolator': 'linear',
+        'threads': 0,
+        'seed': None,
+    },
+    'accurate': {
+        'shrink_factors': [4, 2, 1],
+        'smoothing_sigmas': [2, 1, 0],
+        'rigid_init': True,
+        'sampling_percentage': 0.05,
+        'iterations': 200,
+        'histogram_bins': 50,
+        'learning_rate': 1.0,
+        'metric_interpolator': 'linear',
+        'threads': 0,
+        'seed': None,
+    },
+}
+
+# Registration settings that change the run time but not the transform
+RUNTIME_SETTINGS = ('threads',)
+
+# Metric interpolators, by SimpleITK interpolator name
+_INTERPOLATORS = {'nearest': 'sitkNearestNeighbor', 'linear': 'sitkLinear'}
+
+
+def registration_settings(preset: str = 'default', **overrides: Any) -> dict:
+    """
+    Returns the registration settings of a preset, with some values overridden.
+
+    Args:
+        preset (str): 'default', 'fast' or 'accurate'.
+        overrides: Settings to change; None values are ignored.
+
+    Returns:
+        dict: The registration settings.
+    """
+    if preset not in REGISTRATION_PRESETS:
+        raise ValueError(f"Unknown registration preset {preset!r}. "
+                         f"Choose from {list(REGISTRATION_PRESETS)}")
+    settings = dict(REGISTRATION_PRESETS[preset])
+    for key, value in overrides.items():
+        if key not in settings:
+            raise ValueError(f"Unknown registration setting {key!r}")
+        if value is not None:
+            settings[key] = value
+    return settings
+
+
+def result_settings(settings: Optional[dict]) -> Optional[dict]:
+    """
+    The registration settings that determine the transform (RUNTIME_SETTINGS
+    left out), e.g. to fingerprint or cache a registration result.
+    """
+    if settings is None:
+        return None
+    return {key: value for key, value in settings.items() if key not in RUNTIME_SETTINGS}
+
+
+def _registration_method(settings: dict, iterations: int) -> sitk.ImageRegistrationMethod:
+    """
+    Sets up a Mattes mutual information / gradient descent registration.
+    """
+    import SimpleITK as sitk
+    registration_method = sitk.ImageRegistrationMethod()
+
+    # Similarity metric
+    registration_method.SetMetricAsMattesMutualInformation(numberOfHistogramBins=settings['histogram_bins'])
+    registration_method.SetMetricSamplingStrategy(registration_method.RANDOM)
+    if settings['seed'] is None:
+        registration_method.SetMetricSamplingPercentage(settings['sampling_percentage'])
+    else:
+        registration_method.SetMetricSamplingPercentage(settings['sampling_percentage'], int(settings['seed']))
+
+    # Interpolator
+    registration_method.SetInterpolator(getattr(sitk, _INTERPOLATORS[settings['metric_interpolator']]))
+
+    # Optimizer
+    registration_method.SetOptimizerAsGradientDescent(learningRate=settings['learning_rate'],
+                                                      numberOfIterations=iterations,
+                                                      convergenceMinimumValue=1e-6,
+                                                      convergenceWindowSize=10)
+    registration_method.SetOptimizerScalesFromPhysicalShift()
+
+    # Multi-resolution pyramid (a single full-resolution level by default)
+    if list(settings['shrink_factors']) != [1] or list(settings['smoothing_sigmas']) != [0]:
+        registration_method.SetShrinkFactorsPerLevel(shrinkFactors=list(settings['shrink_factors']))
+        registration_method.SetSmoothingSigmasPerLevel(smoothingSigmas=list(settings['smoothing_sigmas']))
+        registration_method.SmoothingSigmasAreSpecifiedInPhysicalUnitsOn()
+
+    if settings['threads'] > 0:
+        registration_method.SetNumberOfThreads(int(settings['threads']))
+
+    return registration_method
+
+
+def register_images(fixed_image: sitk.Image,
+                    moving_image: sitk.Image,
+                    settings: Optional[dict] = None) -> Tuple[sitk.Transform, dict]:
+    """
+    Computes the affine transform that aligns an in-memory moving image to a fixed image.
+
+    Args:
+        fixed_image (sitk.Image): The reference image (T1).
+        moving_image (sitk.Image): The image to align (FLAIR).
+        settings (dict): Registration settings (see registration_settings);
+                         the 'default' preset when None.
+
+    Returns:
+        tuple: (transform, report). The transform maps fixed image points to
+               moving image points; the report holds the time taken (seconds),
+               the final metric value, the optimizer iterations and stopping condition.
+    """
+    import SimpleITK as sitk
+    settings = settings if settings is not None else REGISTRATION_PRESETS['default']
+    start_time = time.perf_counter()
+    fixed_image = sitk.Cast(fixed_image, sitk.sitkFloat32)
+    moving_image = sitk.Cast(moving_image, sitk.sitkFloat32)
+
+    # Initial transform: Use AffineTransform for affine registration
+    initial_transform = sitk.CenteredTransformInitializer(fixed_image,
+                                                          moving_image,
+                                                          sitk.AffineTransform(3),
+                                                          sitk.CenteredTransformInitializerFilter.GEOMETRY)
+
+    # Optional rigid stage, its result initializes the affine stage
+    if settings['rigid_init']:
+        logging.info("Starting rigid initialization...")
+        rigid_method = _registration_method(settings, max(1, settings['iterations'] // 2))
+        rigid_initial = sitk.CenteredTransformInitializer(fixed_image,
+                                                          moving_image,
+                                                          sitk.Euler3DTransform(),
+                                                          sitk.CenteredTransformInitializerFilter.GEOMETRY)
+        rigid_method.SetInitialTransform(rigid_initial, inPlace=True)
+        rigid_method.Execute(fixed_image, moving_image)
+        initial_transform = sitk.AffineTransform(3)
+        initial_transform.SetCenter(rigid_initial.GetCenter())
+        initial_transform.SetMatrix(rigid_initial.GetMatrix())
+        initial_transform.SetTranslation(rigid_initial.GetTranslation())
+
+    registration_method = _registration_method(settings, settings['iterations'])
+    registration_method.SetInitialTransform(initial_transform, inPlace=False)
+
+    # # Connect an observer to monitor the registration process
+    # def command_iteration(method) :
+    #     print(f"{method.GetOptimizerIteration():3} = {method.GetMetricValue():10.5f} : {method.GetOptimizerPosition()}")
+
+    # registration_method.AddCommand(sitk.sitkIterationEvent, lambda: command_iteration(registration_method))
+
+    # Execute the registration
+    logging.info("Starting registration...")
+    final_transform = registration_method.Execute(fixed_image, moving_image)
+
+    report = {
+        'time_s': time.perf_counter() - start_time,
+        'metric': registration_method.GetMetricValue(),
+        'iterations': registration_method.GetOptimizerIteration(),
+        'stop_condition': registration_method.GetOptimizerStopConditionDescription(),
+    }
+
+    # Post-registration analysis
+    logging.info("Registration complete.")
+    logging.info(f"Optimizer's stopping condition: {report['stop_condition']}")
+    logging.info(f"Final metric value: {report['metric']}")
+    logging.info(f"Registration time: {report['time_s']:.2f} s")
+
+    return final_transform, report
+
+
+def registration_record(report: Optional[dict]) -> dict:
+    """
+    Fields of a registration report (see register_images) that are stored
+    with the 'register' stage record of the run report (none without a report).
+    """
+    if report is None:
+        return {}
+    return {'reg_time_s': report['time_s'], 'reg_metric': report['metric'], 'reg_iterations': report['iterations']}
+
+
+def register_flair_to_t1(t1_image_path: str = '',
+                         flair_image_path: str = '',
+                         output_path: str = '',
+                         data_dir: str = '',
+                         mrid: str = '',
+                         t1_image_suffix: str = '_T1_LPS.nii.gz',
+                         fl_image_suffix: str = '_FL_LPS.nii.gz',
+                         output_dir: str = '',
+                         settings: Optional[dict] = None,
+                         ) -> Optional[dict]:
     """
     Registers a FLAIR image to a T1 image using SimpleITK.
 
@@ -109,8 +436,12 @@ def register_flair_to_t1(t1_image_path='',
     to the T1 (fixed) image. 
     
     The final transformation are saved to the specified output directory.
+    The registration settings (see registration_settings) default to the
+    'default' preset; the registration report of register_images is returned
+    (None for an invalid combination of arguments).
     """
 
+    import SimpleITK as sitk
     # Args:
     # *Option 1: entire directory mode
     # t1_image_path (str): The file path for the T1-weighted image (fixed image).
@@ -133,8 +464,8 @@ def register_flair_to_t1(t1_image_path='',
         # output_registered_image_path = os.path.join(data_dir, mrid + "FL_rT1.nii.gz")
         output_transform_path = os.path.join(output_transform_dir, mrid + "_FL_to_T1.tfm")
     else:
-        logging.warning(f"Invalid input arg combination")
-        return
+        logging.warning("Invalid input arg combination")
+        return None
 
 
     # Read the images
@@ -142,45 +473,7 @@ def register_flair_to_t1(t1_image_path='',
     fixed_image = sitk.ReadImage(t1_image_path, sitk.sitkFloat32)
     moving_image = sitk.ReadImage(flair_image_path, sitk.sitkFloat32)
 
-    # Set up the registration method
-    registration_method = sitk.ImageRegistrationMethod()
-
-    # Similarity metric
-    registration_method.SetMetricAsMattesMutualInformation(numberOfHistogramBins=50)
-    registration_method.SetMetricSamplingStrategy(registration_method.RANDOM)
-    registration_method.SetMetricSamplingPercentage(0.01)
-
-    # Interpolator
-    registration_method.SetInterpolator(sitk.sitkNearestNeighbor)
-
-    # Optimizer
-    registration_method.SetOptimizerAsGradientDescent(learningRate=1.0, numberOfIterations=100,
-                                                      convergenceMinimumValue=1e-6,
-                                                      convergenceWindowSize=10)
-    registration_method.SetOptimizerScalesFromPhysicalShift()
-
-    # Initial transform: Use AffineTransform for affine registration
-    initial_transform = sitk.CenteredTransformInitializer(fixed_image,
-                                                          moving_image,
-                                                          sitk.AffineTransform(3),
-                                                          sitk.CenteredTransformInitializerFilter.GEOMETRY)
-    registration_method.SetInitialTransform(initial_transform, inPlace=False)
-
-    # # Connect an observer to monitor the registration process
-    # def command_iteration(method) :
-    #     print(f"{method.GetOptimizerIteration():3} = {method.GetMetricValue():10.5f} : {method.GetOptimizerPosition()}")
-
-    # registration_method.AddCommand(sitk.sitkIterationEvent, lambda: command_iteration(registration_method))
-
-    # Execute the registration
-    logging.info("Starting registration...")
-    final_transform = registration_method.Execute(sitk.Cast(fixed_image, sitk.sitkFloat32),
-                                                   sitk.Cast(moving_image, sitk.sitkFloat32))
-
-    # Post-registration analysis
-    logging.info("Registration complete.")
-    logging.info(f"Optimizer's stopping condition: {registration_method.GetOptimizerStopConditionDescription()}")
-    logging.info(f"Final metric value: {registration_method.GetMetricValue()}")
+    final_transform, report = register_images(fixed_image, moving_image, settings)
 
     # Resample the moving image using the final transform
     resampler = sitk.ResampleImageFilter()
@@ -198,8 +491,156 @@ def register_flair_to_t1(t1_image_path='',
     # print(f"Saving registered image to: {output_registered_image_path}")
     # sitk.WriteImage(resampled_moving_image, output_registered_image_path)
 
+    return report
+
+
+def resample_mask(fixed_image: sitk.Image, moving_image: sitk.Image, transform: sitk.Transform) -> sitk.Image:
+    """
+    Resamples an in-memory mask onto the grid of the fixed image.
+
+    Args:
+        fixed_image (sitk.Image): Reference image. The output image will have the
+                                  same size, spacing, and origin as this image.
+        moving_image (sitk.Image): The mask that needs to be transformed.
+        transform (sitk.Transform): Transform mapping fixed image points to moving image points.
+
+    Returns:
+        sitk.Image: The resampled mask.
+    """
+    import SimpleITK as sitk
+    # Create a resampler
+    resampler = sitk.ResampleImageFilter()
+
+    # --- Configure the resampler ---
+    # 1. Set the reference image: This defines the output image's grid (size, spacing, etc.)
+    resampler.SetReferenceImage(fixed_image)
+
+    # 2. Set the interpolator
+    # Use sitk.sitkLinear for intensity images (like T1, FLAIR)
+    # Use sitk.sitkNearestNeighbor for label/mask images to preserve labels
+    resampler.SetInterpolator(sitk.sitkNearestNeighbor)
+
+    # 3. Set the default pixel value for areas outside the moving image
+    resampler.SetDefaultPixelValue(0)  # Use 0 for black background
+
+    # 4. Set the transformation
+    resampler.SetTransform(transform)
+
+    # Execute the resampling
+    logging.info("Applying transform and resampling image...")
+    resampled_image: sitk.Image = resampler.Execute(moving_image)
+
+    return resampled_image
+
+
+def lesion_region(fixed_image: Union[sitk.Image, ImageGrid],
+                  mask_image: sitk.Image,
+                  transform: sitk.Transform,
+                  margin: int = 1) -> Optional[Tuple[List[int], List[int]]]:
+    """
+    Finds the block of the fixed grid that the lesions of a mask can be resampled to.
+
+    The bounding box of the non-zero mask voxels (widened by half a voxel, the
+    reach of nearest neighbour interpolation) is mapped to the fixed image
+    through the inverse of the transform. Every fixed voxel whose resampled
+    value can be non-zero lies in the returned block.
+
+    Args:
+        fixed_image (sitk.Image or ImageGrid): Reference image of the output grid.
+        mask_image (sitk.Image): The mask in moving image space.
+        transform (sitk.Transform): Transform mapping fixed image points to moving image points.
+        margin (int): Extra voxels on every side of the block.
+
+    Returns:
+        tuple or None: (start index, size) of the block in (x, y, z) order, the
+                       whole fixed grid if the transform cannot be inverted, or
+                       None if no lesion lands on the fixed grid.
+    """
+    import SimpleITK as sitk
+    # sitk arrays are (z, y, x)
+    nonzero = sitk.GetArrayViewFromImage(mask_image) != 0
+    bounds = []
+    for axes in ((0, 1), (0, 2), (1, 2)):
+        indices = np.flatnonzero(nonzero.any(axis=axes))
+        if indices.size == 0:
+            return None
+        bounds.append((indices[0] - 0.5, indices[-1] + 0.5))
+    del nonzero
+
+    fixed_size = list(fixed_image.GetSize())
+    try:
+        inverse = transform.GetInverse()
+    except RuntimeError:
+        logging.info("Transform is not invertible; resampling the whole mask")
+        return [0, 0, 0], fixed_size
+
+    points = []
+    for x in bounds[0]:
+        for y in bounds[1]:
+            for z in bounds[2]:
+                point = mask_image.TransformContinuousIndexToPhysicalPoint((float(x), float(y), float(z)))
+                points.append(fixed_image.TransformPhysicalPointToContinuousIndex(inverse.TransformPoint(point)))
+    corners = np.array(points)
+    start = np.maximum(np.floor(corners.min(axis=0)).astype(int) - margin, 0)
+    stop = np.minimum(np.ceil(corners.max(axis=0)).astype(int) + margin + 1, fixed_size)
+    if np.any(stop <= start):
+        return None
+    return [int(v) for v in start], [int(v) for v in stop - start]
 
-def apply_saved_transform(fixed_image_path, moving_image_path, transform_path, output_image_path):
+
+def resample_mask_region(fixed_image: Union[sitk.Image, ImageGrid],
+                         mask_image: sitk.Image,
+                         transform: sitk.Transform,
+                         region: Tuple[List[int], List[int]]) -> sitk.Image:
+    """
+    Resamples the lesions (non-zero voxels) of a mask onto one block of the
+    fixed grid, as a uint8 image.
+
+    Args:
+        fixed_image (sitk.Image or ImageGrid): Reference image of the output grid.
+        mask_image (sitk.Image): The mask in moving image space.
+        transform (sitk.Transform): Transform mapping fixed image points to moving image points.
+        region (tuple): (start index, size) of the block, see lesion_region.
+
+    Returns:
+        sitk.Image: The binary resampled block, placed in the fixed image space.
+    """
+    import SimpleITK as sitk
+    start, size = region
+    resampler = sitk.ResampleImageFilter()
+    resampler.SetOutputOrigin(fixed_image.TransformIndexToPhysicalPoint(start))
+    resampler.SetOutputSpacing(fixed_image.GetSpacing())
+    resampler.SetOutputDirection(fixed_image.GetDirection())
+    resampler.SetSize(size)
+    resampler.SetInterpolator(sitk.sitkNearestNeighbor)
+    resampler.SetDefaultPixelValue(0)
+    resampler.SetTransform(transform)
+    logging.info(f"Applying transform and resampling the lesion block {size} at {start}...")
+    region_image: sitk.Image = resampler.Execute(sitk.Cast(mask_image != 0, sitk.sitkUInt8))
+    return region_image
+
+
+def paste_region(fixed_image: Union[sitk.Image, ImageGrid],
+                 region_image: Optional[sitk.Image],
+                 region: Optional[Tuple[List[int], List[int]]],
+                 pixel_type: Optional[int] = None) -> sitk.Image:
+    """
+    Builds the full size resampled mask on the fixed grid from a resampled
+    block (all zero when there is no block), as pixel_type (Default: Float32).
+    """
+    import SimpleITK as sitk
+    pixel_type = sitk.sitkFloat32 if pixel_type is None else pixel_type
+    image = sitk.Image(fixed_image.GetSize(), pixel_type)
+    image.SetOrigin(fixed_image.GetOrigin())
+    image.SetSpacing(fixed_image.GetSpacing())
+    image.SetDirection(fixed_image.GetDirection())
+    if region_image is not None and region is not None:
+        image = sitk.Paste(image, sitk.Cast(region_image, pixel_type),
+                           region_image.GetSize(), [0, 0, 0], region[0])
+    return image
+
+
+def apply_saved_transform(fixed_image_path: str, moving_image_path: str, transform_path: str, output_image_path: str) -> None:
     """
     Applies a saved SimpleITK transformation to an image.
 
@@ -210,6 +651,7 @@ def apply_saved_transform(fixed_image_path, moving_image_path, transform_path, o
         transform_path (str): Path to the .tfm file containing the transformation.
         output_image_path (str): Path to save the resulting resampled image.
     """
+    import SimpleITK as sitk
     # Read the fixed and moving images
     logging.info("Reading images...")
     fixed_image = sitk.ReadImage(fixed_image_path, sitk.sitkFloat32)
@@ -223,32 +665,149 @@ def apply_saved_transform(fixed_image_path, moving_image_path, transform_path, o
         logging.error(f"Error reading transform file: {e}")
         return
 
-    # Create a resampler
-    resampler = sitk.ResampleImageFilter()
+    region = lesion_region(fixed_image, moving_image, loaded_transform)
+    region_image = None
+    if region is not None:
+        region_image = resample_mask_region(fixed_image, moving_image, loaded_transform, region)
+    resampled_image = paste_region(fixed_image, region_image, region)
 
-    # --- Configure the resampler ---
-    # 1. Set the reference image: This defines the output image's grid (size, spacing, etc.)
-    resampler.SetReferenceImage(fixed_image)
+    # Save the output image
+    logging.info(f"Saving resampled image to: {output_image_path}")
+    sitk.WriteImage(resampled_image, output_image_path)
+    logging.info("Done.")
 
-    # 2. Set the interpolator
-    # Use sitk.sitkLinear for intensity images (like T1, FLAIR)
-    # Use sitk.sitkNearestNeighbor for label/mask images to preserve labels
-    resampler.SetInterpolator(sitk.sitkNearestNeighbor)
 
-    # 3. Set the default pixel value for areas outside the moving image
-    resampler.SetDefaultPixelValue(0) # Use 0 for black background
+def segment_lesions_by_labels(lesion_mask: np.ndarray,
+                              label_map: np.ndarray,
+                              voxel_volume: float = 1.0,
+                              offset: Optional[Tuple[int, ...]] = None) -> tuple:
+    """
+    Segments a binary lesion mask by a multi-label map in a single pass.
 
-    # 4. Set the transformation
-    resampler.SetTransform(loaded_transform)
+    Lesion voxels are counted per label with one bincount over the label values
+    under the lesion mask, so the cost does not grow with the number of labels.
+    Works directly on in-memory arrays of any integer or float dtype.
 
-    # Execute the resampling
-    logging.info("Applying transform and resampling image...")
-    resampled_image = resampler.Execute(moving_image)
+    With an offset, lesion_mask only covers the block of label_map starting
+    there (no lesion outside of it); the intersection is computed on that
+    block alone.
 
-    # Save the output image
-    logging.info(f"Saving resampled image to: {output_image_path}")
-    sitk.WriteImage(resampled_image, output_image_path)
-    logging.info("Done.")
+    Args:
+        lesion_mask (np.ndarray): Binary lesion mask (non-zero voxels are lesion).
+        label_map (np.ndarray): Multi-label mask (values 0 to N), same shape as
+                                lesion_mask unless an offset is given.
+        voxel_volume (float): Volume of a single voxel in mm^3.
+        offset (tuple): Index of label_map where lesion_mask starts.
+
+    Returns:
+        tuple: (segmented_data, volume_results). segmented_data is a uint16 array
+               holding the label of every lesion voxel and 0 elsewhere.
+               volume_results maps every non-zero label present in label_map
+               to its lesion volume in mm^3 (0 for labels without lesion).
+    """
+    if offset is None:
+        if lesion_mask.shape != label_map.shape:
+            raise ValueError("Error: Input masks have different dimensions. "
+                             f"Mask A: {lesion_mask.shape}, Mask B: {label_map.shape}")
+        block = (slice(None),) * label_map.ndim
+    else:
+        block = tuple(slice(o, o + n) for o, n in zip(offset, lesion_mask.shape))
+        if lesion_mask.ndim != label_map.ndim or \
+                any(s.stop > n for s, n in zip(block, label_map.shape)):
+            raise ValueError(f"Error: Mask A block {lesion_mask.shape} at {tuple(offset)} "
+                             f"is outside of Mask B {label_map.shape}")
+
+    data_a = lesion_mask.astype(bool, copy=False)
+    data_b = label_map.astype(np.uint16, copy=False)
+
+    # All non-zero labels in the map are reported, even those without lesion
+    labels_in_b = np.flatnonzero(np.bincount(data_b.ravel()))
+    labels_in_b = labels_in_b[labels_in_b > 0].astype(np.uint16)
+    logging.info(f"Found {len(labels_in_b)} non-zero labels in Mask B: {labels_in_b}")
+
+    # Lesion voxel count of every label in one pass
+    minlength = int(labels_in_b[-1]) + 1 if labels_in_b.size else 1
+    block_b = data_b[block]
+    lesion_counts = np.bincount(block_b[data_a], minlength=minlength)
+    volume_results = {label: lesion_counts[label] * voxel_volume for label in labels_in_b}
+
+    # Keep the label where the lesion mask is set, 0 elsewhere
+    if offset is None:
+        segmented_data = data_b * data_a
+    else:
+        segmented_data = np.zeros(data_b.shape, dtype=np.uint16)
+        segmented_data[block] = block_b * data_a
+
+    return segmented_data, volume_results
+
+
+def save_segmentation_results(final_segmented_data: np.ndarray,
+                              volume_results: dict,
+                              voxel_volume: float,
+                              affine: np.ndarray,
+                              header: Any,
+                              output_path: str,
+                              save_as_csv: bool,
+                              csv_path: str,
+                              mrid: str,
+                              cohort_table: str = '',
+                              labels: Optional[List[int]] = None,
+                              composites: Optional[dict] = None,
+                              split_volumes: Optional[dict] = None) -> None:
+    """
+    Logs the ROI lesion volumes and saves the segmented mask (and the volumes as CSV).
+
+    Args:
+        final_segmented_data (np.ndarray): Lesion mask labelled by ROI.
+        volume_results (dict): Lesion volume (mm^3) of every ROI label.
+        voxel_volume (float): Volume of a single voxel in mm^3.
+        affine (np.ndarray): Affine of the output image.
+        header (nib.Nifti1Header): Header of the output image.
+        output_path (str): File path of the output mask: NIfTI, or the compact
+                           lesion voxel format if it ends with .npz (see sparse_mask).
+        save_as_csv (bool): Also save the volumes as a one-row CSV.
+        csv_path (str): File path of the CSV.
+        mrid (str): The unique identifier of the subject (CSV index).
+        cohort_table (str): If given, the volumes are also appended as a row of
+                            this cohort CSV, on the fixed `labels` columns.
+        labels (list): Label columns of the cohort table.
+        composites (dict): If given, the volumes of these composite ROIs (see
+                           composite_rois.load_composites) are added after the
+                           single label volumes in the CSV and the cohort table.
+        split_volumes (dict): Volumes of the periventricular and deep WM composites
+                              (see composite_rois.periventricular_volumes).
+    """
+    import nibabel as nib
+    import pandas as pd
+    from .cohort_table import append_row
+    from .composite_rois import composite_volumes
+    from .sparse_mask import save_segmentation
+    # --- Print the Results ---
+    logging.info("\n--- Volume Results ---")
+    logging.info(f"Volume of a single voxel: {voxel_volume:.4f} mm^3")
+    logging.info("-" * 25)
+    if not volume_results:
+        logging.warning("No overlap found between Mask A and any labels in Mask B.")
+    else:
+        for label, volume in volume_results.items():
+            logging.info(f"Label {label:>3}: {volume:>10.4f} mm^3")
+    logging.info("------------------------")
+
+    # --- Save the Resulting Multi-Label Mask ---
+    output_img = nib.Nifti1Image(final_segmented_data, affine, header)
+
+    logging.info(f"\nSaving final multi-label segmented mask to: {output_path}")
+    save_segmentation(output_img, output_path)
+
+    if composites:
+        volume_results = {**volume_results, **composite_volumes(volume_results, composites, split_volumes)}
+
+    # --- Save the Resulting Multi-Label Mask Volumes as CSV ---
+    if save_as_csv:
+        df_csv = pd.DataFrame(volume_results, index=[mrid])
+        df_csv.to_csv(csv_path)
+    if cohort_table:
+        append_row(cohort_table, mrid, volume_results, labels or [])
 
 
 def segment_multilabel_mask_and_calculate_volumes(mask_a_path: str, 
@@ -256,7 +815,8 @@ def segment_multilabel_mask_and_calculate_volumes(mask_a_path: str,
                                                   output_path: str,
                                                   save_as_csv: bool,
                                                   csv_path: str,
-                                                  mrid: str) -> None:
+                                                  mrid: str,
+                                                  composites: Optional[dict] = None) -> None:
     """
     Segments a binary mask (A) by a multi-label mask (B), saves the result,
     and calculates the volume for each label in the intersection.
@@ -265,77 +825,260 @@ def segment_multilabel_mask_and_calculate_volumes(mask_a_path: str,
         mask_a_path (str): File path for the binary input mask (Mask A, values 0 or 1).
         mask_b_path (str): File path for the multi-label input mask (Mask B, values 0 to N).
         output_dir (str): Directory where the output mask will be saved.
+        composites (dict): Composite ROIs added to the CSV (see composite_rois.load_composites).
     """
+    import nibabel as nib
+    from .composite_rois import periventricular_volumes
     logging.info("--- Starting Multi-Label Segmentation and Volume Calculation ---")
 
     # Load the NIfTI images
     logging.info(f"Loading Mask A: {mask_a_path}")
-    img_a = nib.load(mask_a_path)
+    img_a = cast('nib.Nifti1Image', nib.load(mask_a_path, mmap=True))
     logging.info(f"Loading Mask B: {mask_b_path}")
-    img_b = nib.load(mask_b_path)
+    img_b, data_b = load_label_map(mask_b_path)
 
     # --- Sanity Checks ---
     if img_a.shape != img_b.shape:
         raise ValueError("Error: Input masks have different dimensions. "
                          f"Mask A: {img_a.shape}, Mask B: {img_b.shape}")
-    if not np.allclose(img_a.affine, img_b.affine):
+    if not np.allclose(img_a.affine, img_b.affine, atol=GRID_TOLERANCE):
         raise ValueError("Error: Input masks have different affine transformations. "
                          "They are not in the same space.")
     logging.info("Masks have compatible dimensions and affines.")
 
-    # Get image data as numpy arrays
-    data_a = img_a.get_fdata().astype(bool) # Mask A is binary
-    data_b = img_b.get_fdata().astype(np.uint16) # Mask B is multi-label
-
-    # Find all unique non-zero labels in Mask B
-    labels_in_b = np.unique(data_b[data_b > 0])
-    logging.info(f"Found {len(labels_in_b)} non-zero labels in Mask B: {labels_in_b}")
-
-    # --- Initialize containers for results ---
-    volume_results = {}
-    final_segmented_data = np.zeros_like(data_b, dtype=data_b.dtype)
-    
     # Calculate voxel volume once
     voxel_volume = np.abs(np.linalg.det(img_a.affine[:3, :3]))
 
-    # --- Iterate over each label, perform segmentation, and calculate volume ---
-    for label in labels_in_b:
-        # Create a temporary binary mask for the current label
-        mask_for_label_b = (data_b == label)
-        
-        # Perform the intersection: where Mask A is true AND Mask B has the current label
-        intersection_data = data_a & mask_for_label_b
-        
-        # Add the segmented region to our final output mask, preserving the label
-        final_segmented_data[intersection_data] = label
-        
-        # Calculate volume for this specific intersection
-        non_zero_voxel_count = np.sum(intersection_data)
-        total_volume_mm3 = non_zero_voxel_count * voxel_volume
-        
-        # Store the result
-        volume_results[label] = total_volume_mm3
+    # Get image data in its stored dtype (no float64 upcast)
+    final_segmented_data, volume_results = segment_lesions_by_labels(np.asanyarray(img_a.dataobj),
+                                                                     data_b,
+                                                                     voxel_volume)
 
-    # --- Print the Results ---
-    logging.info("\n--- Volume Results ---")
-    logging.info(f"Volume of a single voxel: {voxel_volume:.4f} mm^3")
-    logging.info("-" * 25)
-    if not volume_results:
-        logging.warning("No overlap found between Mask A and any labels in Mask B.")
-    else:
-        for label, volume in volume_results.items():
-            logging.info(f"Label {label:>3}: {volume:>10.4f} mm^3")
-    logging.info("------------------------")
-    
-    # --- Save the Resulting Multi-Label Mask ---
-    output_img = nib.Nifti1Image(final_segmented_data, img_a.affine, img_a.header)
-    
-    logging.info(f"\nSaving final multi-label segmented mask to: {output_path}")
-    nib.save(output_img, output_path)
-    
-    # --- Save the Resulting Multi-Label Mask Volumes as CSV ---
-    if save_as_csv:
-        df_csv = pd.DataFrame(volume_results, index=[mrid])
-        df_csv.to_csv(csv_path)
+    split_volumes = None
+    if composites and composites.get('split'):
+        split_volumes = periventricular_volumes(final_segmented_data, data_b, img_b.header.get_zooms(),
+                                                voxel_volume, composites['split'])
+
+    save_segmentation_results(final_segmented_data, volume_results, voxel_volume,
+                              img_a.affine, img_a.header, output_path,
+                              save_as_csv, csv_path, mrid, composites=composites,
+                              split_volumes=split_volumes)
+
+    logging.info("\nProcess finished successfully.")
+
+
+def sitk_image_affine(image: Union[sitk.Image, ImageGrid]) -> np.ndarray:
+    """
+    Computes the NIfTI (RAS) voxel-to-world affine of a SimpleITK (LPS) image,
+    as it would be stored in the header when the image is written.
+
+    Args:
+        image (sitk.Image or ImageGrid): The image or its grid.
+
+    Returns:
+        np.ndarray: The 4x4 affine.
+    """
+    direction = np.array(image.GetDirection()).reshape(3, 3)
+    affine = np.eye(4)
+    affine[:3, :3] = direction * np.array(image.GetSpacing())
+    affine[:3, 3] = image.GetOrigin()
+    # LPS -> RAS, rounded to the single precision of the NIfTI sform
+    affine = np.diag([-1.0, -1.0, 1.0, 1.0]) @ affine
+    return affine.astype(np.float32).astype(np.float64)
+
+
+class ImageGrid:
+    """
+    The grid (size, origin, spacing, direction) of an image without its voxels:
+    a resampling reference read from the header alone. Points and indices are
+    mapped by a 1-voxel image on the same grid, which holds everything but the size.
+    """
+
+    def __init__(self, size: Tuple[int, ...], reference: sitk.Image) -> None:
+        self.size = tuple(int(n) for n in size)
+        self.reference = reference
+
+    def GetSize(self) -> Tuple[int, ...]:
+        return self.size
+
+    def GetOrigin(self) -> Tuple[float, ...]:
+        return tuple(self.reference.GetOrigin())
+
+    def GetSpacing(self) -> Tuple[float, ...]:
+        return tuple(self.reference.GetSpacing())
+
+    def GetDirection(self) -> Tuple[float, ...]:
+        return tuple(self.reference.GetDirection())
+
+    def TransformIndexToPhysicalPoint(self, index: Sequence[int]) -> Tuple[float, ...]:
+        return tuple(self.reference.TransformIndexToPhysicalPoint([int(i) for i in index]))
+
+    def TransformPhysicalPointToContinuousIndex(self, point: Sequence[float]) -> Tuple[float, ...]:
+        return tuple(self.reference.TransformPhysicalPointToContinuousIndex(point))
+
+
+def read_image_grid(path: str) -> ImageGrid:
+    """
+    Reads only the header of an image and returns its grid (size, origin,
+    spacing, direction): a resampling reference that skips decoding the voxels
+    and allocates no image of the full size.
+    """
+    import SimpleITK as sitk
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(path)
+    reader.ReadImageInformation()
+    reference = sitk.Image([1] * reader.GetDimension(), sitk.sitkUInt8)
+    reference.SetOrigin(reader.GetOrigin())
+    reference.SetSpacing(reader.GetSpacing())
+    reference.SetDirection(reader.GetDirection())
+    return ImageGrid(reader.GetSize(), reference)
+
+
+def register_and_segment_subject(t1_image_path: str,
+                                 flair_image_path: str,
+                                 dlwmls_mask_path: str,
+                                 dlmuse_mask_path: str,
+                                 output_path: str,
+                                 csv_path: str,
+                                 mrid: str,
+                                 transform: Optional[sitk.Transform] = None,
+                                 transform_path: str = '',
+                                 registered_mask_path: str = '',
+                                 registration: Optional[dict] = None,
+                                 cohort_table: str = '',
+                                 labels: Optional[List[int]] = None,
+                                 compresslevel: Optional[int] = None,
+                                 images: Optional[dict] = None,
+                                 composites: Optional[dict] = None,
+                                 cohort_store: str = '') -> Optional[sitk.Transform]:
+    """
+    Registers FLAIR to T1, moves the DLWMLS mask to T1 space and splits it by the
+    DLMUSE ROIs, keeping the T1 image, the transform and the resampled mask in memory.
+
+    The T1 image is read once, and only its header when the subject is not
+    registered here (the T1 grid is all that resampling needs); the transform
+    and the resampled mask are only written when a path is given for them. Only the block of the T1 grid
+    that the lesions map to is resampled and intersected with the ROIs; a
+    subject without lesions is not registered at all.
+
+    Args:
+        t1_image_path (str): File path of the LPS T1 image (fixed image).
+        flair_image_path (str): File path of the LPS FLAIR image (moving image).
+        dlwmls_mask_path (str): File path of the DLWMLS mask in FLAIR space.
+        dlmuse_mask_path (str): File path of the DLMUSE mask in T1 space.
+        output_path (str): File path of the segmented output mask.
+        csv_path (str): File path of the ROI volumes CSV.
+        mrid (str): The unique identifier of the subject.
+        transform (sitk.Transform): Previously computed FLAIR to T1 transform;
+                                    registration is skipped when given.
+        transform_path (str): If given, the transform is saved to this path.
+        registered_mask_path (str): If given, the resampled DLWMLS mask is saved to this path.
+        registration (dict): Registration settings (see registration_settings).
+        cohort_table (str): If given, the volumes are also appended to this cohort CSV.
+        labels (list): Label columns of the cohort table.
+        compresslevel (int): gzip level of a gzipped resampled mask (None: ITK default).
+        images (dict): Inputs that were already read (see pipeline.load_subject_images):
+                       't1', 'flair' and 'mask' as Float32 sitk images (or 't1' as
+                       the ImageGrid of read_image_grid), 'dlmuse' as (nib image, data). They are taken out of the dict when used;
+                       missing ones are read from their path.
+        composites (dict): Composite ROIs added to the volumes (see composite_rois.load_composites).
+        cohort_store (str): If given, the lesion mask in T1 space and the segmented
+                            map are also appended to this cohort store (see cohort_store).
+
+    Returns:
+        sitk.Transform: The FLAIR to T1 transform (None if registration was
+                        skipped for an empty mask).
+    """
+    import SimpleITK as sitk
+    from .cohort_store import append_subject
+    from .composite_rois import periventricular_volumes
+    images = images if images is not None else {}
+
+    def read_image(kind: str, path: str) -> sitk.Image:
+        image = images.pop(kind, None)
+        return image if image is not None else sitk.ReadImage(path, sitk.sitkFloat32)
+
+    # Inputs that were not prefetched (which measures them itself)
+    with stage('load', mrid) if 'mask' not in images or 'dlmuse' not in images else nullcontext():
+        mask_image = read_image('mask', dlwmls_mask_path)
+        has_lesions = bool(np.any(sitk.GetArrayViewFromImage(mask_image)))
+        img_b, data_b = images.pop('dlmuse', (None, None))
+        if img_b is None:
+            logging.info(f"Loading Mask B: {dlmuse_mask_path}")
+            img_b, data_b = load_label_map(dlmuse_mask_path)
+
+    fixed_image: Optional[Union[sitk.Image, ImageGrid]] = None
+    if transform is None and not has_lesions:
+        logging.info("The DLWMLS mask is empty; skipping registration")
+    elif transform is None:
+        with stage('register', mrid) as record:
+            logging.info("Reading images...")
+            fixed_image = read_image('t1', t1_image_path)
+            moving_image = read_image('flair', flair_image_path)
+            transform, report = register_images(fixed_image, moving_image, registration)
+            record.update(registration_record(report))
+            del moving_image
+            if transform_path:
+                logging.info(f"Saving transform to: {transform_path}")
+                sitk.WriteTransform(transform, transform_path)
+
+    with stage('apply', mrid):
+        if fixed_image is None:
+            fixed_image = images.pop('t1', None)
+            if fixed_image is None:
+                logging.info("Reading the T1 grid...")
+                fixed_image = read_image_grid(t1_image_path)
+        # Only the block of the T1 grid the lesions map to is resampled
+        region, region_image = None, None
+        if has_lesions and transform is not None:
+            region = lesion_region(fixed_image, mask_image, transform)
+            if region is not None:
+                region_image = resample_mask_region(fixed_image, mask_image, transform, region)
+        del mask_image
+        if registered_mask_path:
+            logging.info(f"Saving resampled image to: {registered_mask_path}")
+            write_image(paste_region(fixed_image, region_image, region), registered_mask_path, compresslevel)
+
+    with stage('segment', mrid):
+        shape_a = fixed_image.GetSize()
+        affine_a = sitk_image_affine(fixed_image)
+
+        # --- Sanity Checks ---
+        if shape_a != img_b.shape:
+            raise ValueError("Error: Input masks have different dimensions. "
+                             f"Mask A: {shape_a}, Mask B: {img_b.shape}")
+        if not np.allclose(affine_a, img_b.affine, atol=GRID_TOLERANCE):
+            raise ValueError("Error: Input masks have different affine transformations. "
+                             "They are not in the same space.")
+        logging.info("Masks have compatible dimensions and affines.")
+
+        offset: Tuple[int, ...]
+        if region_image is None or region is None:
+            data_a, offset = np.zeros((0, 0, 0), dtype=np.uint8), (0, 0, 0)
+        else:
+            # sitk arrays are (z, y, x); the transpose is a view in nibabel (x, y, z) order
+            data_a, offset = sitk.GetArrayViewFromImage(region_image).T, tuple(region[0])
+        voxel_volume = np.abs(np.linalg.det(affine_a[:3, :3]))
+        final_segmented_data, volume_results = segment_lesions_by_labels(data_a,
+                                                                         data_b,
+                                                                         voxel_volume,
+                                                                         offset)
+
+        block = tuple(slice(o, o + n) for o, n in zip(offset, data_a.shape))
+        split_volumes = None
+        if composites and composites.get('split'):
+            split_volumes = periventricular_volumes(final_segmented_data[block], data_b, img_b.header.get_zooms(),
+                                                    voxel_volume, composites['split'], offset=offset)
+
+        header = img_b.header.copy()
+        header.set_data_dtype(np.uint16)
+        save_segmentation_results(final_segmented_data, volume_results, voxel_volume,
+                                  img_b.affine, header, output_path,
+                                  True, csv_path, mrid, cohort_table, labels, composites, split_volumes)
+        if cohort_store:
+            lesion = np.zeros(img_b.shape, dtype=np.uint8)
+            lesion[block] = data_a
+            append_subject(cohort_store, mrid, lesion, final_segmented_data, img_b.affine)
 
     logging.info("\nProcess finished successfully.")
+    return transform
@@ -0,0 +1,109 @@
+import logging
+import os
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+# A subject's inputs: (size, mtime) of every input file, by kind
+Signature = Tuple[Tuple[str, int, int], ...]
+
+
+def input_signature(mrid: str, inputs: Dict[str, Dict[str, str]]) -> Optional[Signature]:
+    """
+    Size and modification time of every input of a subject.
+
+    Args:
+        mrid (str): The unique identifier of the subject.
+        inputs (dict): Index of every input kind, see preflight.index_dir.
+
+    Returns:
+        tuple or None: The signature, or None while an input is missing.
+    """
+    signature = []
+    for kind in sorted(inputs):
+        try:
+            stat = os.stat(inputs[kind][mrid])
+        except (KeyError, OSError):
+            return None
+        signature.append((kind, stat.st_size, stat.st_mtime_ns))
+    return tuple(signature)
+
+
+def ready_subjects(mrids: List[str],
+                   inputs: Dict[str, Dict[str, str]],
+                   seen: Dict[str, Tuple[Signature, int]],
+                   handled: Dict[str, Signature],
+                   settle: float) -> List[str]:
+    """
+    Finds the subjects whose inputs are complete and no longer being written.
+
+    A subject is ready when all its inputs exist and were not modified for
+    settle seconds (by their modification time, or by our own clock since
+    they were first seen unchanged), and it was not already handled with
+    exactly these inputs.
+
+    Args:
+        mrids (list): Candidate subjects.
+        inputs (dict): Index of every input kind, see preflight.index_dir.
+        seen (dict): Signature of every subject and the time (ns) it was
+                     first seen with it; updated.
+        handled (dict): Signature every subject was last processed with.
+        settle (float): Seconds after which an unchanged input counts as complete.
+
+    Returns:
+        list: The ready subjects, in the order of mrids.
+    """
+    ready = []
+    now = time.time_ns()
+    for mrid in mrids:
+        signature = input_signature(mrid, inputs)
+        if signature is None:
+            seen.pop(mrid, None)
+            continue
+        if mrid not in seen or seen[mrid][0] != signature:
+            seen[mrid] = (signature, now)
+        if handled.get(mrid) == signature:
+            continue
+        quiet = now - max(mtime for _, _, mtime in signature)
+        unchanged = now - seen[mrid][1]
+        if max(quiet, unchanged) >= settle * 1e9:
+            ready.append(mrid)
+    return ready
+
+
+def watch(scan: Callable[[], Tuple[List[str], Dict[str, Dict[str, str]]]],
+          process: Callable[[List[str]], None],
+          interval: float = 10.0,
+          stop: Optional[threading.Event] = None) -> int:
+    """
+    Polls the inputs and processes the subjects as they become ready, until stopped.
+
+    Args:
+        scan (Callable): Returns the candidate subjects and the input index;
+                         called at every poll.
+        process (Callable): Processes a batch of ready subjects.
+        interval (float): Seconds between polls, and the settle time of new inputs.
+        stop (threading.Event): Ends the loop after the current batch once set.
+
+    Returns:
+        int: Number of subjects handed to process.
+    """
+    stop = stop or threading.Event()
+    seen: Dict[str, Tuple[Signature, int]] = {}
+    handled: Dict[str, Signature] = {}
+    total = 0
+    logging.info(f"Watching for new subjects every {interval} s")
+    while not stop.is_set():
+        mrids, inputs = scan()
+        ready = ready_subjects(mrids, inputs, seen, handled, interval)
+        if ready:
+            logging.info(f"{len(ready)} new or changed subjects ready")
+            process(ready)
+            for mrid in ready:
+                handled[mrid] = seen[mrid][0]
+            total += len(ready)
+            # Inputs that arrived during the batch are picked up right away
+            continue
+        stop.wait(interval)
+    logging.info(f"Stopped watching after {total} subjects")
+    return total
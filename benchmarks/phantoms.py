@@ -0,0 +1,279 @@
+"""
+Synthetic NIfTI phantoms for the benchmarks.
+
+A phantom is defined analytically in world (RAS, mm) coordinates: an
+ellipsoidal brain with grey/white matter and ventricles, and spherical
+lesion blobs around the ventricles. Every image of a subject samples that
+same anatomy on its own grid, so the T1 and FLAIR images can have different
+resolutions, orientations and a small misalignment (which registration has
+to recover), while the DLMUSE-like label map is written on the LPS grid of
+the T1 image, exactly as the pipeline expects it.
+"""
+import os
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import nibabel as nib
+import numpy as np
+from nibabel.orientations import axcodes2ornt, inv_ornt_aff, io_orientation, ornt_transform
+from scipy.spatial import cKDTree
+
+# Field of view of the phantom head (mm)
+FOV = (192.0, 240.0, 176.0)
+
+# Brain and ventricle ellipsoid radii (mm)
+BRAIN_RADII = (70.0, 90.0, 65.0)
+VENTRICLE_RADII = (14.0, 30.0, 12.0)
+
+# T1 voxel size of every benchmark size; FLAIR slices are three times thicker
+SIZES = {
+    'small': (4.0, 4.0, 4.0),
+    'medium': (2.0, 2.0, 2.0),
+    'large': (1.0, 1.0, 1.0),
+}
+
+# Single MUSE ROI indices (ventricles first), as in NiChart_DLWMLS/data/MUSE_ROI_labels.csv
+MUSE_LABELS = [4, 11, 23, 30, 31, 32, 35, 36, 37, 38, 39, 40, 41, 47, 48, 49, 50, 51, 52,
+               55, 56, 57, 58, 59, 60, 61, 62, 69, 71, 72, 73, 75, 76] + \
+    [label for label in range(81, 208) if label not in (96, 97, 98, 99, 110, 111, 126, 127, 130, 131, 158, 159, 188, 189)]
+
+# Tissue intensities of the (T1, FLAIR) images
+INTENSITIES = {
+    'csf': (200.0, 80.0),
+    'gm': (600.0, 500.0),
+    'wm': (900.0, 400.0),
+    'lesion': (700.0, 1000.0),
+}
+
+
+def grid_affine(shape: Sequence[int],
+                spacing: Sequence[float],
+                axcodes: str = 'RAS',
+                rotation_deg: float = 0.0,
+                shift: Sequence[float] = (0.0, 0.0, 0.0)) -> Tuple[np.ndarray, Tuple[int, ...]]:
+    """
+    Builds the affine of a grid centred on the world origin.
+
+    Args:
+        shape (tuple): Grid size in RAS axis order (x, y, z).
+        spacing (tuple): Voxel size in RAS axis order (mm).
+        axcodes (str): Orientation of the stored array (e.g. 'LAS', 'PIR').
+        rotation_deg (float): Rotation about the superior axis (degrees).
+        shift (tuple): Translation added in world coordinates (mm).
+
+    Returns:
+        tuple: (affine, shape of the stored array).
+    """
+    shape = tuple(int(s) for s in shape)
+    affine = np.diag(list(spacing) + [1.0])
+    affine[:3, 3] = -np.asarray(spacing) * (np.asarray(shape) - 1) / 2.0
+    ornt = ornt_transform(axcodes2ornt('RAS'), axcodes2ornt(tuple(axcodes)))
+    affine = affine @ inv_ornt_aff(ornt, shape)
+    stored_shape = tuple(shape[int(axis)] for axis in np.argsort(ornt[:, 0]))
+
+    angle = np.deg2rad(rotation_deg)
+    rotation = np.eye(4)
+    rotation[:2, :2] = [[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]]
+    rotation[:3, 3] = shift
+    return rotation @ affine, stored_shape
+
+
+def grid_shape(spacing: Sequence[float]) -> Tuple[int, ...]:
+    """
+    Number of voxels covering the phantom field of view in RAS axis order.
+    """
+    return tuple(int(round(f / s)) for f, s in zip(FOV, spacing))
+
+
+def _world_slices(affine: np.ndarray, shape: Sequence[int]):
+    """
+    Yields (k, world coordinates (3, nx, ny)) for every slice of the last axis.
+    """
+    i, j = np.meshgrid(np.arange(shape[0]), np.arange(shape[1]), indexing='ij')
+    for k in range(shape[2]):
+        voxels = np.stack([i, j, np.full_like(i, k), np.ones_like(i)]).reshape(4, -1)
+        yield k, (affine @ voxels)[:3].reshape(3, shape[0], shape[1])
+
+
+def _ellipsoid(world: np.ndarray, radii: Sequence[float], centre: Sequence[float] = (0.0, 0.0, 0.0)) -> np.ndarray:
+    """
+    Normalised ellipsoidal radius of world coordinates (< 1 inside).
+    """
+    return np.sqrt(sum(((world[a] - centre[a]) / radii[a]) ** 2 for a in range(3)))
+
+
+def random_lesions(num_lesions: int, rng: np.random.Generator) -> List[Tuple[np.ndarray, float]]:
+    """
+    Draws periventricular lesion blobs as (centre, radius) in world mm.
+    """
+    lesions = []
+    for _ in range(num_lesions):
+        direction = rng.normal(size=3)
+        direction /= np.linalg.norm(direction)
+        # Just outside the ventricles, inside the white matter
+        centre = direction * np.asarray(VENTRICLE_RADII) * rng.uniform(1.2, 2.0)
+        lesions.append((centre, float(rng.uniform(2.0, 8.0))))
+    return lesions
+
+
+def tissue_image(affine: np.ndarray,
+                 shape: Sequence[int],
+                 modality: int,
+                 lesions: List[Tuple[np.ndarray, float]],
+                 rng: np.random.Generator,
+                 noise: float = 20.0) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Samples the phantom on a grid.
+
+    Args:
+        affine (np.ndarray): Voxel to world affine of the grid.
+        shape (tuple): Array shape of the grid.
+        modality (int): 0 for T1, 1 for FLAIR intensities.
+        lesions (list): Lesion blobs (see random_lesions).
+        rng (np.random.Generator): Random generator of the noise.
+        noise (float): Standard deviation of the Gaussian noise.
+
+    Returns:
+        tuple: (int16 image, uint8 lesion mask).
+    """
+    image = np.zeros(shape, dtype=np.float32)
+    lesion_mask = np.zeros(shape, dtype=np.uint8)
+    for k, world in _world_slices(affine, shape):
+        brain = _ellipsoid(world, BRAIN_RADII)
+        value = np.where(brain < 1.0, INTENSITIES['gm'][modality], 0.0)
+        value = np.where(brain < 0.7, INTENSITIES['wm'][modality], value)
+        value = np.where(_ellipsoid(world, VENTRICLE_RADII) < 1.0, INTENSITIES['csf'][modality], value)
+        in_lesion = np.zeros(value.shape, dtype=bool)
+        for centre, radius in lesions:
+            in_lesion |= _ellipsoid(world, (radius, radius, radius), centre) < 1.0
+        value = np.where(in_lesion, INTENSITIES['lesion'][modality], value)
+        image[..., k] = value
+        lesion_mask[..., k] = in_lesion
+    image += rng.normal(0.0, noise, size=image.shape).astype(np.float32)
+    return np.clip(image, 0, None).astype(np.int16), lesion_mask
+
+
+def label_map(affine: np.ndarray, shape: Sequence[int], num_labels: int, rng: np.random.Generator) -> np.ndarray:
+    """
+    Samples a MUSE-like label map: the ventricles get the first label and the
+    rest of the brain is split into Voronoi regions of random seeds.
+
+    Args:
+        affine (np.ndarray): Voxel to world affine of the grid.
+        shape (tuple): Array shape of the grid.
+        num_labels (int): Number of labels (at most len(MUSE_LABELS)).
+        rng (np.random.Generator): Random generator of the seeds.
+
+    Returns:
+        np.ndarray: uint16 label map.
+    """
+    labels = np.asarray(MUSE_LABELS[:max(1, min(num_labels, len(MUSE_LABELS)))], dtype=np.uint16)
+    seeds = rng.uniform(-1.0, 1.0, size=(4 * len(labels), 3)) * np.asarray(BRAIN_RADII)
+    seeds = seeds[_ellipsoid(seeds.T, BRAIN_RADII) < 1.0][:max(1, len(labels) - 1)]
+    tree = cKDTree(seeds)
+
+    out = np.zeros(shape, dtype=np.uint16)
+    for k, world in _world_slices(affine, shape):
+        brain = _ellipsoid(world, BRAIN_RADII) < 1.0
+        ventricles = _ellipsoid(world, VENTRICLE_RADII) < 1.0
+        layer = np.zeros(brain.shape, dtype=np.uint16)
+        tissue = brain & ~ventricles
+        if tissue.any():
+            _, nearest = tree.query(world[:, tissue].T)
+            layer[tissue] = labels[1:][nearest % max(1, len(labels) - 1)] if len(labels) > 1 else labels[0]
+        layer[ventricles] = labels[0]
+        out[..., k] = layer
+    return out
+
+
+def to_lps(image: nib.Nifti1Image) -> nib.Nifti1Image:
+    """
+    Reorients an image to LPS (the grid reorient_to_lps writes).
+    """
+    ornt = ornt_transform(io_orientation(image.affine), axcodes2ornt(('L', 'P', 'S')))
+    return image.as_reoriented(ornt)
+
+
+def make_subject(mrid: str,
+                 out_dir: str,
+                 size: str = 'small',
+                 num_labels: int = len(MUSE_LABELS),
+                 num_lesions: int = 12,
+                 t1_axcodes: str = 'LAS',
+                 fl_axcodes: str = 'RAS',
+                 fl_rotation_deg: float = 4.0,
+                 fl_shift: Sequence[float] = (3.0, -2.0, 4.0),
+                 seed: Optional[int] = None) -> Dict[str, str]:
+    """
+    Writes the inputs of one phantom subject.
+
+    Files (under out_dir):
+        T1/<mrid>_T1.nii.gz                     T1 image
+        FL/<mrid>_FL_LPS.nii.gz                 FLAIR image (thick slices, misaligned)
+        DLMUSE/<mrid>_T1_LPS_DLMUSE.nii.gz      label map on the LPS T1 grid
+        LESIONS/<mrid>_FL_LESIONS.nii.gz        true lesion mask on the FLAIR grid
+
+    Args:
+        mrid (str): The unique identifier of the subject.
+        out_dir (str): Root folder of the phantom inputs.
+        size (str): Resolution, one of SIZES.
+        num_labels (int): Number of DLMUSE labels.
+        num_lesions (int): Number of lesion blobs.
+        t1_axcodes (str): Orientation of the stored T1 array.
+        fl_axcodes (str): Orientation of the stored FLAIR array.
+        fl_rotation_deg (float): Rotation of the FLAIR grid (degrees).
+        fl_shift (tuple): Translation of the FLAIR grid (mm).
+        seed (int): Seed of the subject (None: derived from mrid).
+
+    Returns:
+        dict: Paths of the written files by kind ('t1', 'fl', 'dlmuse', 'lesions').
+    """
+    if seed is None:
+        seed = sum(ord(c) for c in mrid)
+    rng = np.random.default_rng(seed)
+    lesions = random_lesions(num_lesions, rng)
+
+    t1_spacing = SIZES[size]
+    fl_spacing = (t1_spacing[0], t1_spacing[1], 3 * t1_spacing[2])
+
+    paths = {
+        't1': os.path.join(out_dir, 'T1', mrid + '_T1.nii.gz'),
+        'fl': os.path.join(out_dir, 'FL', mrid + '_FL_LPS.nii.gz'),
+        'dlmuse': os.path.join(out_dir, 'DLMUSE', mrid + '_T1_LPS_DLMUSE.nii.gz'),
+        'lesions': os.path.join(out_dir, 'LESIONS', mrid + '_FL_LESIONS.nii.gz'),
+    }
+    for path in paths.values():
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    t1_affine, t1_shape = grid_affine(grid_shape(t1_spacing), t1_spacing, t1_axcodes)
+    t1, _ = tissue_image(t1_affine, t1_shape, 0, lesions, rng)
+    t1_img = nib.Nifti1Image(t1, t1_affine)
+    t1_img.set_qform(t1_affine, code=1)
+    nib.save(t1_img, paths['t1'])
+
+    fl_affine, fl_shape = grid_affine(grid_shape(fl_spacing), fl_spacing, fl_axcodes, fl_rotation_deg, fl_shift)
+    fl, fl_lesions = tissue_image(fl_affine, fl_shape, 1, lesions, rng)
+    fl_img = nib.Nifti1Image(fl, fl_affine)
+    fl_img.set_qform(fl_affine, code=1)
+    nib.save(fl_img, paths['fl'])
+    nib.save(nib.Nifti1Image(fl_lesions, fl_affine), paths['lesions'])
+
+    lps = to_lps(t1_img)
+    labels = label_map(lps.affine, lps.shape, num_labels, rng)
+    nib.save(nib.Nifti1Image(labels, lps.affine), paths['dlmuse'])
+    return paths
+
+
+def make_cohort(out_dir: str, num_subjects: int, size: str = 'small', **options) -> List[str]:
+    """
+    Writes num_subjects phantom subjects and their list.csv.
+
+    Returns:
+        list: The subject identifiers.
+    """
+    mrids = [f'sub{k:04d}' for k in range(num_subjects)]
+    for k, mrid in enumerate(mrids):
+        make_subject(mrid, out_dir, size, seed=k, **options)
+    with open(os.path.join(out_dir, 'list.csv'), 'w') as f:
+        f.write('MRID\n')
+        f.writelines(mrid + '\n' for mrid in mrids)
+    return mrids
@@ -0,0 +1,264 @@
+"""
+Benchmarks every stage of the pipeline, and the end-to-end CLI, on synthetic phantoms.
+
+Runs on a CPU-only machine without network access: DLWMLS is replaced by
+stub_dlwmls.py. Results are written as JSON; pass a previous result with
+--compare to flag regressions.
+
+    python benchmarks/run_benchmarks.py --sizes small medium --jobs 1 2 4 \
+        --output benchmarks/results.json
+    python benchmarks/run_benchmarks.py --compare benchmarks/results.json
+"""
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+
+import nibabel as nib  # noqa: E402
+import numpy as np  # noqa: E402
+import SimpleITK as sitk  # noqa: E402
+
+import phantoms  # noqa: E402
+import startup  # noqa: E402
+from NiChart_DLWMLS.utils import (  # noqa: E402
+    apply_saved_transform,
+    register_and_segment_subject,
+    register_flair_to_t1,
+    registration_settings,
+    reorient_to_lps,
+    segment_multilabel_mask_and_calculate_volumes
+)
+
+
+def time_call(func: Callable[[], object], repeats: int) -> Dict[str, float]:
+    """
+    Times repeated calls of func (seconds).
+    """
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return {
+        'min': min(times),
+        'median': statistics.median(times),
+        'mean': statistics.mean(times),
+        'repeats': repeats,
+    }
+
+
+def bench_stages(work_dir: str, size: str, repeats: int, num_labels: int, reg_preset: str) -> Dict[str, dict]:
+    """
+    Times the stage functions of utils on one phantom subject.
+    """
+    paths = phantoms.make_subject('bench', os.path.join(work_dir, 'inputs'), size, num_labels=num_labels, seed=0)
+    out = os.path.join(work_dir, 'outputs')
+    os.makedirs(out, exist_ok=True)
+    t1_lps = os.path.join(out, 'bench_T1_LPS.nii.gz')
+    fl_lps = os.path.join(out, 'bench_FL_LPS.nii.gz')
+    mask_lps = os.path.join(out, 'bench_FL_LPS_DLWMLS.nii.gz')
+    tfm = os.path.join(out, 'bench_FL_to_T1.tfm')
+    registered = os.path.join(out, 'bench_DLWMLS_REG_to_T1.nii.gz')
+    segmented = os.path.join(out, 'bench_DLWMLS_DLMUSE_Segmented.nii.gz')
+    csv = os.path.join(out, 'bench_DLWMLS_DLMUSE_Segmented_Volumes.csv')
+    settings = registration_settings(reg_preset, seed=1)
+
+    results = {}
+    results['reorient'] = time_call(lambda: (reorient_to_lps(paths['t1'], t1_lps),
+                                             reorient_to_lps(paths['fl'], fl_lps)), repeats)
+    reorient_to_lps(paths['lesions'], mask_lps)
+    results['register'] = time_call(lambda: register_flair_to_t1(t1_image_path=t1_lps,
+                                                                 flair_image_path=fl_lps,
+                                                                 output_path=tfm,
+                                                                 settings=settings), repeats)
+    results['apply'] = time_call(lambda: apply_saved_transform(t1_lps, mask_lps, tfm, registered), repeats)
+    results['segment'] = time_call(lambda: segment_multilabel_mask_and_calculate_volumes(registered, paths['dlmuse'],
+                                                                                          segmented, True, csv,
+                                                                                          'bench'), repeats)
+    results['postprocess'] = time_call(lambda: register_and_segment_subject(t1_lps, fl_lps, mask_lps, paths['dlmuse'],
+                                                                            segmented, csv, 'bench',
+                                                                            registration=settings), repeats)
+
+    # Accuracy of the phantom registration, so faster settings can be judged too
+    truth = nib.load(paths['lesions'])
+    found = np.asanyarray(nib.load(registered).dataobj) > 0
+    results['quality'] = {
+        'lesion_voxels_t1': int(found.sum()),
+        'lesion_volume_fl_mm3': float(np.asanyarray(truth.dataobj).sum() * abs(np.linalg.det(truth.affine[:3, :3]))),
+        'lesion_volume_t1_mm3': float(found.sum() * abs(np.linalg.det(nib.load(registered).affine[:3, :3]))),
+    }
+    return results
+
+
+def stub_path(bin_dir: str) -> str:
+    """
+    Installs the stub as an executable named DLWMLS in bin_dir.
+    """
+    os.makedirs(bin_dir, exist_ok=True)
+    path = os.path.join(bin_dir, 'DLWMLS')
+    with open(os.path.join(BENCH_DIR, 'stub_dlwmls.py')) as f:
+        source = f.read()
+    with open(path, 'w') as f:
+        f.write(f'#!{sys.executable}\n' + source)
+    os.chmod(path, 0o755)
+    return bin_dir
+
+
+def bench_cli(work_dir: str, size: str, num_subjects: int, jobs: List[int], repeats: int,
+              num_labels: int, extra_args: List[str], stub_delay: float) -> Dict[str, dict]:
+    """
+    Times the end-to-end CLI with the stub DLWMLS for every worker count.
+    """
+    inputs = os.path.join(work_dir, 'cohort')
+    phantoms.make_cohort(inputs, num_subjects, size, num_labels=num_labels)
+    env = dict(os.environ)
+    env['PATH'] = stub_path(os.path.join(work_dir, 'bin')) + os.pathsep + env.get('PATH', '')
+    env['PYTHONPATH'] = REPO_DIR + os.pathsep + env.get('PYTHONPATH', '')
+    env['BENCH_STUB_DELAY'] = str(stub_delay)
+
+    results = {}
+    for num_jobs in jobs:
+        out_dir = os.path.join(work_dir, f'out_j{num_jobs}')
+        command = [sys.executable, '-m', 'NiChart_DLWMLS',
+                   '--list', os.path.join(inputs, 'list.csv'),
+                   '--fl_dir', os.path.join(inputs, 'FL'), '--fl_suff', '_FL_LPS.nii.gz',
+                   '--t1_dir', os.path.join(inputs, 'T1'), '--t1_suff', '_T1.nii.gz',
+                   '--dlmuse_dir', os.path.join(inputs, 'DLMUSE'), '--dlmuse_suff', '_T1_LPS_DLMUSE.nii.gz',
+                   '--out_dir', out_dir, '--device', 'cpu', '--reg_seed', '1',
+                   '--jobs', str(num_jobs)] + extra_args
+
+        def run() -> None:
+            completed = subprocess.run(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+            if completed.returncode != 0:
+                raise RuntimeError(f"CLI failed: {completed.stderr[-2000:]}")
+
+        result = time_call(run, repeats)
+        result['subjects'] = num_subjects
+        result['per_subject'] = result['median'] / num_subjects
+        finished = [f for f in os.listdir(out_dir) if f.endswith('_Volumes.csv')]
+        result['finished'] = len(finished)
+        results[f'jobs={num_jobs}'] = result
+    return results
+
+
+def environment() -> dict:
+    """
+    Describes the machine and library versions of a benchmark run.
+    """
+    return {
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'numpy': np.__version__,
+        'nibabel': nib.__version__,
+        'SimpleITK': sitk.Version.VersionString(),
+    }
+
+
+def flatten_timings(results: dict, prefix: str = '') -> Dict[str, float]:
+    """
+    Maps 'section/size/name' to the median time of every timing in a result.
+    """
+    flat = {}
+    for key, value in results.items():
+        if not isinstance(value, dict):
+            continue
+        if 'median' in value:
+            flat[prefix + key] = value['median']
+        else:
+            flat.update(flatten_timings(value, prefix + key + '/'))
+    return flat
+
+
+def compare(current: dict, baseline: dict, tolerance: float) -> bool:
+    """
+    Prints the median time ratios of current vs baseline.
+
+    Returns:
+        bool: True if no timing is slower than the baseline by more than tolerance.
+    """
+    now = flatten_timings({k: current[k] for k in ('startup', 'stages', 'cli') if k in current})
+    before = flatten_timings({k: baseline[k] for k in ('startup', 'stages', 'cli') if k in baseline})
+    ok = True
+    print(f"{'benchmark':<45} {'baseline':>10} {'current':>10} {'ratio':>7}")
+    for name in sorted(set(now) & set(before)):
+        ratio = now[name] / before[name] if before[name] > 0 else float('inf')
+        flag = ''
+        if ratio > 1.0 + tolerance:
+            flag = '  REGRESSION'
+            ok = False
+        print(f"{name:<45} {before[name]:>10.3f} {now[name]:>10.3f} {ratio:>7.2f}{flag}")
+    return ok
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="NiChart_DLWMLS stage and end-to-end benchmarks on synthetic phantoms")
+    parser.add_argument('--sizes', nargs='+', default=['small'], choices=list(phantoms.SIZES), help="Phantom resolutions (Default: small)")
+    parser.add_argument('--labels', type=int, default=len(phantoms.MUSE_LABELS), help="Number of DLMUSE labels (Default: all)")
+    parser.add_argument('--repeats', type=int, default=3, help="Repetitions of every timing (Default: 3)")
+    parser.add_argument('--reg_preset', type=str, default='default', help="Registration preset of the stage timings (Default: default)")
+    parser.add_argument('--subjects', type=int, default=4, help="Subjects of the end-to-end runs (Default: 4)")
+    parser.add_argument('--jobs', type=int, nargs='+', default=[1, 2], help="Worker counts of the end-to-end runs (Default: 1 2)")
+    parser.add_argument('--cli_args', type=str, default='', help="Extra CLI arguments of the end-to-end runs, e.g. '--overlap True'")
+    parser.add_argument('--stub_delay', type=float, default=0.0, help="Seconds the stub DLWMLS spends per image (Default: 0)")
+    parser.add_argument('--skip_stages', action='store_true', help="Skip the stage timings")
+    parser.add_argument('--skip_cli', action='store_true', help="Skip the end-to-end runs")
+    parser.add_argument('--skip_startup', action='store_true', help="Skip the CLI startup timings")
+    parser.add_argument('--output', type=str, default='', help="Write the results to this JSON file")
+    parser.add_argument('--compare', type=str, default='', help="Baseline JSON to compare the results with")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="Allowed slowdown vs the baseline (Default: 0.2)")
+    parser.add_argument('--work_dir', type=str, default='', help="Folder for the phantoms and outputs (Default: a temporary folder)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='dlwmls_bench_')
+    results: dict = {'environment': environment(), 'settings': vars(args), 'stages': {}, 'cli': {}}
+    if not args.skip_startup:
+        print("CLI startup timings")
+        results['startup'] = startup.bench_startup(args.repeats)
+    try:
+        for size in args.sizes:
+            if not args.skip_stages:
+                print(f"Stage timings: {size}")
+                results['stages'][size] = bench_stages(os.path.join(work_dir, size, 'stages'), size,
+                                                       args.repeats, args.labels, args.reg_preset)
+            if not args.skip_cli:
+                print(f"End-to-end timings: {size}, {args.subjects} subjects, jobs {args.jobs}")
+                results['cli'][size] = bench_cli(os.path.join(work_dir, size, 'cli'), size, args.subjects,
+                                                 args.jobs, args.repeats, args.labels,
+                                                 args.cli_args.split(), args.stub_delay)
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    timings = {k: results[k] for k in ('startup', 'stages', 'cli') if k in results}
+    for name, median in sorted(flatten_timings(timings).items()):
+        print(f"  {name:<45} {median:.3f} s")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.output}")
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if not compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+"""
+Startup time of the NiChart_DLWMLS command line.
+
+Times `--version` and `--help`, measures the import time of the CLI module
+with `python -X importtime`, and checks that importing it loads none of the
+heavy libraries. Exits with 1 when the import budget is exceeded or a heavy
+library is imported, so it can guard CI:
+
+    python benchmarks/startup.py --budget_ms 200
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from typing import Dict, List
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+
+CLI_MODULE = 'NiChart_DLWMLS.__main__'
+# Libraries that only the processing stages may import
+HEAVY_MODULES = ['numpy', 'pandas', 'scipy', 'nibabel', 'SimpleITK', 'torch']
+
+
+def _env() -> dict:
+    env = dict(os.environ)
+    env['PYTHONPATH'] = REPO_DIR + os.pathsep + env.get('PYTHONPATH', '')
+    return env
+
+
+def _timing(times: List[float]) -> Dict[str, float]:
+    return {
+        'min': min(times),
+        'median': statistics.median(times),
+        'mean': statistics.mean(times),
+        'repeats': len(times),
+    }
+
+
+def import_times(module: str = CLI_MODULE) -> Dict[str, int]:
+    """
+    Cumulative import time (us) of every module imported by `import module`
+    in a fresh interpreter, from `python -X importtime`.
+    """
+    completed = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                               cwd=REPO_DIR, env=_env(), stdout=subprocess.DEVNULL,
+                               stderr=subprocess.PIPE, text=True)
+    if completed.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed: {completed.stderr[-2000:]}")
+    times = {}
+    for line in completed.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def bench_startup(repeats: int) -> dict:
+    """
+    Times the CLI startup: `--version`, `--help` and the import of the CLI module.
+    """
+    results = {}
+    for flag in ('--version', '--help'):
+        times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, '-m', 'NiChart_DLWMLS', flag], cwd=REPO_DIR, env=_env(),
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+            times.append(time.perf_counter() - start)
+        results[flag.lstrip('-')] = _timing(times)
+
+    imports = [import_times() for _ in range(repeats)]
+    results['import'] = _timing([t[CLI_MODULE] / 1e6 for t in imports])
+    results['heavy_modules'] = sorted({m for t in imports for m in t if m in HEAVY_MODULES})
+    return results
+
+
+def check(results: dict, budget_ms: float) -> bool:
+    """
+    Prints the startup timings.
+
+    Returns:
+        bool: True if the CLI module imports within budget_ms and loads no heavy library.
+    """
+    for name in ('version', 'help', 'import'):
+        print(f"  {name:<10} {results[name]['median'] * 1000:>8.1f} ms")
+    ok = True
+    if results['import']['median'] * 1000 > budget_ms:
+        print(f"Importing {CLI_MODULE} takes more than the budget of {budget_ms} ms")
+        ok = False
+    if results['heavy_modules']:
+        print(f"Importing {CLI_MODULE} loads {', '.join(results['heavy_modules'])}")
+        ok = False
+    return ok
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="NiChart_DLWMLS CLI startup time and import budget")
+    parser.add_argument('--repeats', type=int, default=5, help="Repetitions of every timing (Default: 5)")
+    parser.add_argument('--budget_ms', type=float, default=200, help="Import time budget of the CLI module (Default: 200)")
+    parser.add_argument('--output', type=str, default='', help="Write the results to this JSON file")
+    args = parser.parse_args()
+
+    results = bench_startup(args.repeats)
+    ok = check(results, args.budget_ms)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.output}")
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
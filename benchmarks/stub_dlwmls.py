@@ -0,0 +1,35 @@
+"""
+Stand-in for the DLWMLS executable, for benchmarking on CPU-only machines.
+
+Accepts the arguments the pipeline passes to DLWMLS (-i, -o, -device, ...)
+and writes, for every <name>.nii.gz input, <name>_DLWMLS.nii.gz with the
+voxels brighter than 75% of the image maximum (the phantom lesions).
+
+BENCH_STUB_DELAY (seconds per image) emulates the cost of the real network.
+"""
+import glob
+import os
+import sys
+import time
+
+import nibabel as nib
+import numpy as np
+
+
+def main(argv: list) -> int:
+    in_dir = argv[argv.index('-i') + 1]
+    out_dir = argv[argv.index('-o') + 1]
+    delay = float(os.environ.get('BENCH_STUB_DELAY', '0'))
+    os.makedirs(out_dir, exist_ok=True)
+    for path in sorted(glob.glob(os.path.join(in_dir, '*.nii.gz'))):
+        image = nib.load(path)
+        data = np.asanyarray(image.dataobj)
+        mask = (data > 0.75 * data.max()).astype(np.uint8)
+        time.sleep(delay)
+        name = os.path.basename(path)[:-len('.nii.gz')]
+        nib.save(nib.Nifti1Image(mask, image.affine), os.path.join(out_dir, name + '_DLWMLS.nii.gz'))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,131 @@
+import os
+import stat
+import subprocess
+import sys
+from typing import List
+
+import nibabel as nib
+import numpy as np
+import pytest
+from nibabel.orientations import apply_orientation, axcodes2ornt, inv_ornt_aff, ornt_transform
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Stand-in for the DLWMLS command: thresholds every FLAIR image of the input
+# folder and logs the call, so tests can count the inference runs. Failures
+# are set through the environment: DLWMLS_STUB_FAIL=n makes the first n calls
+# exit with status 3, DLWMLS_STUB_DELAY=s sleeps s seconds before writing the
+# masks, DLWMLS_STUB_SKIP=name writes no mask for that FLAIR image
+DLWMLS_STUB = '''#!{python}
+import glob, os, sys, time
+import nibabel as nib
+import numpy as np
+args = sys.argv
+in_dir, out_dir = args[args.index('-i') + 1], args[args.index('-o') + 1]
+os.makedirs(out_dir, exist_ok=True)
+names = sorted(os.path.basename(f) for f in glob.glob(os.path.join(in_dir, '*.nii.gz')))
+with open(os.environ['DLWMLS_STUB_LOG'], 'a') as log:
+    log.write(' '.join(names) + '\\n')
+with open(os.environ['DLWMLS_STUB_LOG']) as log:
+    calls = len(log.read().splitlines())
+if calls <= int(os.environ.get('DLWMLS_STUB_FAIL', 0)):
+    sys.exit(3)
+time.sleep(float(os.environ.get('DLWMLS_STUB_DELAY', 0)))
+for name in names:
+    if name == os.environ.get('DLWMLS_STUB_SKIP'):
+        continue
+    img = nib.load(os.path.join(in_dir, name))
+    data = np.asanyarray(img.dataobj)
+    mask = (data > np.percentile(data, 97)).astype(np.uint8)
+    nib.save(nib.Nifti1Image(mask, img.affine), os.path.join(out_dir, name[:-len('.nii.gz')] + '_DLWMLS.nii.gz'))
+'''
+
+SHAPE = (32, 36, 28)
+
+
+def make_subject(root: str, mrid: str, seed: int = 0) -> None:
+    """
+    Writes a phantom FLAIR, T1 and DLMUSE map (8 labels, LPS) of one subject.
+    """
+    rng = np.random.default_rng(seed)
+    x, y, z = np.meshgrid(*[np.linspace(-1, 1, n) for n in SHAPE], indexing='ij')
+    brain = (x ** 2 + y ** 2 + z ** 2) < 0.8
+    affine = np.diag([2.0, 2.0, 2.0, 1.0])
+    t1 = brain * (500 + 100 * z) + rng.normal(0, 5, SHAPE)
+    flair = brain * (300 + 50 * x) + rng.normal(0, 5, SHAPE)
+    flair[(x - 0.2) ** 2 + y ** 2 + z ** 2 < 0.03] += 400
+    for kind in ('fl', 't1', 'dlmuse'):
+        os.makedirs(os.path.join(root, kind), exist_ok=True)
+    nib.save(nib.Nifti1Image(t1.astype(np.int16), affine), os.path.join(root, 't1', mrid + '_T1.nii.gz'))
+    nib.save(nib.Nifti1Image(flair.astype(np.int16), affine), os.path.join(root, 'fl', mrid + '_FL_LPS.nii.gz'))
+    write_dlmuse(root, mrid, [81, 82, 83, 84, 85, 86, 87, 88])
+
+
+def write_dlmuse(root: str, mrid: str, labels: List[int]) -> None:
+    """
+    Writes the DLMUSE map of a phantom subject, one label per octant, on the LPS T1 grid.
+    """
+    x, y, z = np.meshgrid(*[np.linspace(-1, 1, n) for n in SHAPE], indexing='ij')
+    brain = (x ** 2 + y ** 2 + z ** 2) < 0.8
+    octant = (x > 0) + 2 * (y > 0) + 4 * (z > 0)
+    data = np.where(brain, np.array(labels)[octant], 0).astype(np.int16)
+    affine = np.diag([2.0, 2.0, 2.0, 1.0])
+    to_lps = ornt_transform(axcodes2ornt(nib.aff2axcodes(affine)), axcodes2ornt(('L', 'P', 'S')))
+    nib.save(nib.Nifti1Image(apply_orientation(data, to_lps), affine @ inv_ornt_aff(to_lps, SHAPE)),
+             os.path.join(root, 'dlmuse', mrid + '_T1_LPS_DLMUSE.nii.gz'))
+
+
+@pytest.fixture
+def cohort(tmp_path):
+    """
+    Input folders of two phantom subjects.
+    """
+    root = str(tmp_path / 'inputs')
+    for index, mrid in enumerate(['sub000', 'sub001']):
+        make_subject(root, mrid, seed=index)
+    return root
+
+
+@pytest.fixture
+def dlwmls_stub(tmp_path):
+    """
+    Puts the DLWMLS stand-in first on the PATH; returns its call log.
+    """
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    stub = bin_dir / 'DLWMLS'
+    stub.write_text(DLWMLS_STUB.format(python=sys.executable))
+    stub.chmod(stub.stat().st_mode | stat.S_IEXEC)
+    log = tmp_path / 'dlwmls_calls.log'
+    log.write_text('')
+    return {'path': str(bin_dir), 'log': str(log)}
+
+
+def dlwmls_calls(stub: dict) -> List[List[str]]:
+    """
+    FLAIR images of every DLWMLS call so far.
+    """
+    with open(stub['log']) as f:
+        return [line.split() for line in f.read().splitlines()]
+
+
+def run_pipeline(inputs: str, out_dir: str, stub: dict, *args: str) -> subprocess.CompletedProcess:
+    """
+    Runs the NiChart_DLWMLS command on the phantom inputs with the DLWMLS stand-in.
+    """
+    env = dict(os.environ)
+    env['PATH'] = stub['path'] + os.pathsep + env.get('PATH', '')
+    env['PYTHONPATH'] = REPO_DIR + os.pathsep + env.get('PYTHONPATH', '')
+    env['DLWMLS_STUB_LOG'] = stub['log']
+    cmd = [sys.executable, '-m', 'NiChart_DLWMLS',
+           '--fl_dir', os.path.join(inputs, 'fl'),
+           '--t1_dir', os.path.join(inputs, 't1'),
+           '--dlmuse_dir', os.path.join(inputs, 'dlmuse'),
+           '--out_dir', out_dir,
+           '--fl_suff', '_FL_LPS.nii.gz',
+           '--device', 'cpu',
+           '--reg_seed', '1'] + list(args)
+    completed = subprocess.run(cmd, cwd=REPO_DIR, env=env, stdout=subprocess.PIPE,
+                               stderr=subprocess.STDOUT, text=True)
+    assert completed.returncode == 0, completed.stdout[-3000:]
+    return completed
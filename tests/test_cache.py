@@ -0,0 +1,108 @@
+import os
+
+import nibabel as nib
+import numpy as np
+import SimpleITK as sitk
+
+from NiChart_DLWMLS import cache
+from NiChart_DLWMLS.pipeline import load_subject_images
+from NiChart_DLWMLS.utils import registration_settings
+
+
+def entry_path(cache_dir: str, key: str) -> str:
+    return os.path.join(cache_dir, key[:2], key + cache.TRANSFORM_EXT)
+
+
+def store_entries(cache_dir: str, keys) -> int:
+    """
+    Stores one transform per key, each older than the next; returns the entry size.
+    """
+    for age, key in enumerate(keys):
+        cache.store(cache_dir, key, sitk.TranslationTransform(3, (1.0, 2.0, 3.0)))
+        os.utime(entry_path(cache_dir, key), ns=(age * 10 ** 9, age * 10 ** 9))
+    return os.path.getsize(entry_path(cache_dir, keys[0]))
+
+
+def cached(cache_dir: str, key: str) -> bool:
+    return os.path.exists(entry_path(cache_dir, key))
+
+
+def test_evict_removes_the_least_recently_used_entries(tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    keys = ['aa01', 'ab02', 'bb03', 'cc04']
+    size = store_entries(cache_dir, keys)
+    # A hit makes the oldest entry the most recently used
+    assert cache.read_transform(cache_dir, 'aa01') is not None
+
+    assert cache.evict(cache_dir, 2 * size) == 2
+    assert [cached(cache_dir, k) for k in keys] == [True, False, False, True]
+    assert cache.evict(cache_dir, 2 * size) == 0
+
+
+def test_store_keeps_the_cache_under_its_cap(tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    size = store_entries(cache_dir, ['aa01', 'ab02'])
+    cache.store(cache_dir, 'cc03', sitk.TranslationTransform(3, (0.0, 0.0, 1.0)), max_bytes=2 * size)
+    assert [cached(cache_dir, k) for k in ['aa01', 'ab02', 'cc03']] == [False, True, True]
+
+
+def test_fetch_copies_a_hit_and_misses_an_unknown_key(tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    store_entries(cache_dir, ['aa01'])
+    output = str(tmp_path / 'sub000_FL_to_T1.tfm')
+    assert cache.fetch(cache_dir, 'aa01', output)
+    assert sitk.ReadTransform(output).GetParameters() == (1.0, 2.0, 3.0)
+    assert not cache.fetch(cache_dir, 'ff99', output)
+
+
+def test_registering_over_a_fetched_transform_keeps_the_entry(tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    store_entries(cache_dir, ['aa01'])
+    output = str(tmp_path / 'sub000_FL_to_T1.tfm')
+    assert cache.fetch(cache_dir, 'aa01', output)
+
+    # Re-registration under other settings (another key) writes the same path
+    transform = sitk.TranslationTransform(3, (4.0, 5.0, 6.0))
+    sitk.WriteTransform(transform, output)
+    cache.store(cache_dir, 'bb02', transform)
+
+    assert cache.read_transform(cache_dir, 'aa01').GetParameters() == (1.0, 2.0, 3.0)
+    assert cache.read_transform(cache_dir, 'bb02').GetParameters() == (4.0, 5.0, 6.0)
+
+
+def test_transform_key_ignores_the_thread_count(tmp_path):
+    t1, flair = tmp_path / 't1.nii.gz', tmp_path / 'fl.nii.gz'
+    t1.write_bytes(b't1')
+    flair.write_bytes(b'flair')
+
+    def key(**settings) -> str:
+        return cache.transform_key(str(t1), str(flair), registration_settings('default', **settings))
+
+    assert key(threads=1) == key(threads=8)
+    assert key(iterations=50) != key()
+    before = key()
+    flair.write_bytes(b'other flair')
+    assert key() != before
+
+
+def test_prefetch_reads_only_the_t1_grid_of_a_cached_subject(tmp_path):
+    layout = {'t1_suff': '_T1.nii.gz', 'fl_suff': '_FL.nii.gz', 'dlwmls_suff': '_FL_DLWMLS.nii.gz',
+              'dlmuse_suff': '_DLMUSE.nii.gz', 'tfm_cache_dir': str(tmp_path / 'cache')}
+    for name, suffix in [('t1', 't1_suff'), ('fl', 'fl_suff'), ('dlwmls', 'dlwmls_suff'), ('dlmuse', 'dlmuse_suff')]:
+        layout[name + '_dir'] = str(tmp_path / name)
+        os.makedirs(layout[name + '_dir'])
+        data = np.zeros((8, 8, 8), np.uint8)
+        data[2:4, 2:4, 2:4] = 1
+        nib.save(nib.Nifti1Image(data, np.eye(4)), os.path.join(layout[name + '_dir'], 'sub000' + layout[suffix]))
+    layout.update(t1_lps_dir=layout['t1_dir'], t1_lps_suff=layout['t1_suff'], flair_lps_dir=layout['fl_dir'])
+
+    images = load_subject_images('sub000', layout)
+    assert images['transform'] is None and 'flair' in images
+
+    key = images['cache_key']
+    cache.store(layout['tfm_cache_dir'], key, sitk.TranslationTransform(3, (1.0, 2.0, 3.0)))
+    images = load_subject_images('sub000', layout)
+    assert images['cache_key'] == key
+    assert images['transform'].GetParameters() == (1.0, 2.0, 3.0)
+    assert 'flair' not in images
+    assert images['t1'].GetSize() == (8, 8, 8)
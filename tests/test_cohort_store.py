@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+
+from NiChart_DLWMLS.cohort_store import (
+    append_subject,
+    iter_chunks,
+    lesion_frequency,
+    merge_store,
+    read_grids,
+    read_index,
+    subject_volume
+)
+
+SHAPE = (6, 5, 4)
+AFFINE = np.diag([2.0, 2.0, 2.0, 1.0])
+
+
+def subject(seed: int, shape=SHAPE):
+    rng = np.random.default_rng(seed)
+    lesion = (rng.random(shape) < 0.3).astype(np.uint8)
+    segmented = lesion.astype(np.uint16) * rng.integers(1, 300, size=shape, dtype=np.uint16)
+    return lesion, segmented
+
+
+def test_subjects_round_trip_and_keep_their_slot(tmp_path):
+    store = str(tmp_path / 'store')
+    for index in range(3):
+        append_subject(store, f's{index}', *subject(index), AFFINE)
+    # Stored again on the same grid: same slot, new volumes
+    grid, slot = append_subject(store, 's1', *subject(7), AFFINE)
+
+    assert slot == 1
+    assert read_grids(store)[grid]['slots'] == 3
+    for mrid, seed in [('s0', 0), ('s1', 7), ('s2', 2)]:
+        lesion, segmented = subject(seed)
+        assert np.array_equal(subject_volume(store, mrid, 'lesion'), lesion)
+        assert np.array_equal(subject_volume(store, mrid, 'segmented'), segmented)
+
+
+def test_lesion_frequency_streams_the_main_grid(tmp_path):
+    store = str(tmp_path / 'store')
+    lesions = []
+    for index in range(5):
+        lesion, segmented = subject(index)
+        append_subject(store, f's{index}', lesion, segmented, AFFINE)
+        lesions.append(lesion)
+    # A subject on another grid is left out
+    append_subject(store, 'other', *subject(9, (3, 3, 3)), AFFINE)
+
+    lesion_bytes = int(np.prod(SHAPE))
+    chunks = list(iter_chunks(store, 'lesion', max_bytes=2 * lesion_bytes))
+    assert [len(mrids) for mrids, _ in chunks] == [2, 2, 1]
+    frequency, affine, covered = lesion_frequency(store, max_bytes=2 * lesion_bytes)
+
+    assert sorted(covered) == [f's{index}' for index in range(5)]
+    assert np.allclose(frequency, np.mean(lesions, axis=0))
+    assert np.array_equal(affine, AFFINE)
+
+
+def test_merge_store_appends_every_subject(tmp_path):
+    src, dst = str(tmp_path / 'src'), str(tmp_path / 'dst')
+    append_subject(dst, 'a', *subject(0), AFFINE)
+    append_subject(src, 'b', *subject(1), AFFINE)
+    append_subject(src, 'c', *subject(2, (3, 3, 3)), AFFINE)
+
+    assert merge_store(src, dst) == 2
+    assert sorted(read_index(dst)) == ['a', 'b', 'c']
+    assert np.array_equal(subject_volume(dst, 'c', 'segmented'), subject(2, (3, 3, 3))[1])
+
+
+def test_mismatched_shapes_are_rejected(tmp_path):
+    lesion, _ = subject(0)
+    with pytest.raises(ValueError):
+        append_subject(str(tmp_path / 'store'), 's0', lesion, np.zeros((2, 2, 2), np.uint16), AFFINE)
@@ -0,0 +1,82 @@
+import csv
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from NiChart_DLWMLS.cohort_table import INDEX_COLUMN, append_row, finalize_table, read_table
+
+LABELS = [4, 11, 47, 81, 600]
+
+
+def volumes(index: int) -> dict:
+    return {81: 1.5 * index, 4: 0.1 * index + 1e-7, 47: float(index)}
+
+
+def append_many(table_path: str, mrids: list) -> None:
+    for mrid in mrids:
+        append_row(table_path, mrid, volumes(int(mrid[3:])), LABELS)
+
+
+def test_concurrent_appends_keep_every_row_whole(tmp_path):
+    table = str(tmp_path / 'table.csv')
+    batches = [[f'sub{w * 50 + i:03d}' for i in range(50)] for w in range(4)]
+    with ProcessPoolExecutor(max_workers=4) as pool:
+        list(pool.map(append_many, [table] * len(batches), batches))
+
+    with open(table, newline='') as f:
+        rows = list(csv.reader(f))
+    assert rows[0] == [INDEX_COLUMN] + [str(label) for label in LABELS]
+    # One header, no interleaved or torn rows
+    assert len(rows) == 201
+    assert all(len(row) == len(LABELS) + 1 for row in rows)
+    assert sorted(row[0] for row in rows[1:]) == sorted(m for batch in batches for m in batch)
+
+
+def test_columns_follow_the_label_list_with_absent_labels_at_zero(tmp_path):
+    table = str(tmp_path / 'table.csv')
+    append_row(table, 'sub001', {600: 2.0, 4: 1.0, 9999: 5.0}, LABELS)
+
+    df = read_table(table)
+    assert list(df.columns) == ['4', '11', '47', '81', '600']
+    assert list(df.loc['sub001']) == [1.0, 0.0, 0.0, 0.0, 2.0]
+
+
+def test_last_row_of_a_subject_wins_and_keeps_full_precision(tmp_path):
+    table = str(tmp_path / 'table.csv')
+    append_many(table, ['sub001', 'sub002'])
+    append_row(table, 'sub001', {81: 0.1 + 0.2}, LABELS)
+
+    df = read_table(table)
+    assert sorted(df.index) == ['sub001', 'sub002']
+    assert df.loc['sub001', '81'] == 0.1 + 0.2
+    assert df.loc['sub002', '4'] == volumes(2)[4]
+
+
+def test_finalize_fills_a_partial_table_from_the_subject_csvs(tmp_path):
+    table = str(tmp_path / 'table.csv')
+    append_many(table, ['sub003', 'sub001', 'sub003'])
+    # sub002 finished in an earlier run, before the table existed
+    subject_csv = {m: str(tmp_path / f'{m}.csv') for m in ['sub001', 'sub002', 'sub003', 'sub004']}
+    pd.DataFrame(volumes(2), index=['sub002']).to_csv(subject_csv['sub002'])
+
+    df = finalize_table(table, LABELS, ['sub001', 'sub002', 'sub003', 'sub004'], subject_csv)
+
+    # sub004 has no volumes at all and is left out
+    assert list(df.index) == ['sub001', 'sub002', 'sub003']
+    assert df.loc['sub002', '4'] == volumes(2)[4]
+    assert df.loc['sub002', '11'] == 0.0
+    assert read_table(table).equals(df)
+    assert not [name for name in os.listdir(tmp_path) if name.endswith('.tmp')]
+
+
+def test_finalize_rebuilds_a_table_with_other_label_columns(tmp_path):
+    table = str(tmp_path / 'table.csv')
+    append_row(table, 'sub001', volumes(1), [4, 81])
+    subject_csv = {'sub001': str(tmp_path / 'sub001.csv')}
+    pd.DataFrame(volumes(1), index=['sub001']).to_csv(subject_csv['sub001'])
+
+    df = finalize_table(table, LABELS, ['sub001'], subject_csv)
+
+    assert list(df.columns) == [str(label) for label in LABELS]
+    assert df.loc['sub001', '47'] == 1.0
@@ -0,0 +1,130 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from conftest import run_pipeline
+from NiChart_DLWMLS.composite_rois import (
+    composite_volumes,
+    load_composites,
+    periventricular_volumes,
+    write_composite_names
+)
+
+
+def test_composite_names_cover_the_packaged_indices(tmp_path):
+    composites = load_composites()
+    path = str(tmp_path / 'names.csv')
+    write_composite_names(composites, path)
+
+    names = pd.read_csv(path)
+    assert list(names.columns) == ['Index', 'Name']
+    assert list(names['Index']) == list(range(1001, 1060))
+    assert names.set_index('Index')['Name'][1001] == 'Frontal_GM_R'
+    assert names.set_index('Index')['Name'][1057] == 'Total'
+    assert names.set_index('Index')['Name'][1058] == 'Periventricular_WM'
+
+
+def write_list(tmp_path, rows) -> str:
+    path = str(tmp_path / 'composites.csv')
+    pd.DataFrame(rows, columns=['Index', 'Name', 'Label']).to_csv(path, index=False)
+    return path
+
+
+def test_nested_composites_resolve_to_their_labels(tmp_path):
+    path = write_list(tmp_path, [
+        (1001, 'Left', 4), (1001, 'Left', 6),
+        (1002, 'Right', 5), (1002, 'Right', 5),
+        (1003, 'Both', 1001), (1003, 'Both', 1002), (1003, 'Both', 9),
+    ])
+    composites = load_composites(path)
+
+    assert composites['indices'] == [1001, 1002, 1003]
+    assert composites['names'] == ['Left', 'Right', 'Both']
+    members = {index: set(np.flatnonzero(row.toarray()))
+               for index, row in zip(composites['indices'], composites['matrix'])}
+    assert members == {1001: {4, 6}, 1002: {5}, 1003: {4, 5, 6, 9}}
+
+
+def test_composite_volumes_are_sums_of_their_labels(tmp_path):
+    composites = load_composites(write_list(tmp_path, [
+        (1001, 'Left', 4), (1001, 'Left', 6), (1002, 'Right', 5), (1003, 'Both', 1001), (1003, 'Both', 5),
+    ]))
+    # Labels outside every composite, or beyond the largest member, are left out
+    volumes = composite_volumes({4: 1.5, 5: 2.0, 6: 0.25, 7: 100.0, 5000: 100.0}, composites)
+    assert volumes == {1001: 1.75, 1002: 2.0, 1003: 3.75}
+    assert composite_volumes({}, composites) == {1001: 0.0, 1002: 0.0, 1003: 0.0}
+
+
+def test_packaged_total_covers_every_other_composite_label():
+    composites = load_composites()
+    matrix = composites['matrix'].toarray() != 0
+    total = matrix[composites['names'].index('Total')]
+    assert total[matrix.any(axis=0)].all()
+
+
+def test_composite_including_itself_is_rejected(tmp_path):
+    path = write_list(tmp_path, [(1001, 'A', 1002), (1002, 'B', 1001)])
+    with pytest.raises(ValueError):
+        load_composites(path)
+
+
+SPLIT_ROWS = [(1001, 'WM', 81), (1001, 'WM', 82), (1002, 'Lateral_Ventricles', 51),
+              (1003, 'Periventricular_WM', 1001), (1004, 'Deep_WM', 1001)]
+
+
+def test_periventricular_and_deep_composites_are_not_label_sums(tmp_path):
+    composites = load_composites(write_list(tmp_path, SPLIT_ROWS))
+
+    assert composites['split'] == {'periventricular': 1003, 'deep': 1004, 'labels': [81, 82], 'ventricles': [51]}
+    volumes = composite_volumes({81: 3.0, 82: 1.0, 51: 5.0}, composites, {1003: 2.5, 1004: 1.5})
+    assert volumes == {1001: 4.0, 1002: 5.0, 1003: 2.5, 1004: 1.5}
+    assert load_composites(write_list(tmp_path, SPLIT_ROWS[:2]))['split'] is None
+    with pytest.raises(ValueError):
+        load_composites(write_list(tmp_path, [row for row in SPLIT_ROWS if row[1] != 'Lateral_Ventricles']))
+
+
+def test_wm_lesions_are_split_by_the_distance_to_the_ventricles(tmp_path):
+    split = load_composites(write_list(tmp_path, SPLIT_ROWS))['split']
+    label_map = np.full((40, 12, 12), 81, dtype=np.uint16)
+    label_map[:, 6:] = 82
+    label_map[:4] = 51
+    segmented = np.zeros(label_map.shape, dtype=np.uint16)
+    # x is the distance (2 mm voxels) to the ventricles, which end at x = 3
+    for x in (5, 8, 9, 20, 39):
+        segmented[x, 3, 3] = label_map[x, 3, 3]
+    segmented[8, 9, 9] = label_map[8, 9, 9]
+    # Lesions outside the WM labels are in neither composite
+    segmented[2, 3, 3] = 51
+
+    volumes = periventricular_volumes(segmented, label_map, (2.0, 2.0, 2.0), 8.0, split, distance=10.0)
+
+    # Distances 4, 10 and 10 mm are periventricular; 12, 34 and 72 mm deep
+    assert volumes == {1003: 3 * 8.0, 1004: 3 * 8.0}
+
+    # The same lesions as a block of the label map
+    block = segmented[5:21, 3:10, 3:10]
+    assert periventricular_volumes(block, label_map, (2.0, 2.0, 2.0), 8.0, split,
+                                   distance=10.0, offset=(5, 3, 3)) == {1003: 24.0, 1004: 16.0}
+
+
+def test_no_ventricles_near_the_lesions_makes_them_all_deep(tmp_path):
+    split = load_composites(write_list(tmp_path, SPLIT_ROWS))['split']
+    label_map = np.full((30, 5, 5), 81, dtype=np.uint16)
+    label_map[0] = 51
+    segmented = np.zeros(label_map.shape, dtype=np.uint16)
+    segmented[20:25, 2, 2] = 81
+
+    assert periventricular_volumes(segmented, label_map, (1.0, 1.0, 1.0), 1.0, split) == {1003: 0.0, 1004: 5.0}
+    assert periventricular_volumes(np.zeros_like(segmented), label_map, (1.0, 1.0, 1.0), 1.0, split) == \
+        {1003: 0.0, 1004: 0.0}
+
+
+def test_split_covers_the_cerebral_wm_lesions(tmp_path, cohort, dlwmls_stub):
+    out_dir = str(tmp_path / 'out')
+    run_pipeline(cohort, out_dir, dlwmls_stub)
+
+    df = pd.read_csv(os.path.join(out_dir, 'sub000_DLWMLS_DLMUSE_Segmented_Volumes.csv'), index_col=0)
+    assert df.loc['sub000', '1052'] > 0
+    assert df.loc['sub000', '1058'] + df.loc['sub000', '1059'] == pytest.approx(df.loc['sub000', '1052'])
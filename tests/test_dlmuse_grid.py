@@ -0,0 +1,35 @@
+import os
+
+import nibabel as nib
+import numpy as np
+
+from conftest import run_pipeline
+from NiChart_DLWMLS.utils import GRID_TOLERANCE
+
+
+def segmented(out_dir: str, mrid: str) -> nib.Nifti1Image:
+    return nib.load(os.path.join(out_dir, 'DLWMLS_DLMUSE_Segmented', mrid + '_DLWMLS_DLMUSE_Segmented.nii.gz'))
+
+
+def rewrite_dlmuse(inputs: str, mrid: str, expand: bool, shift: float) -> None:
+    path = os.path.join(inputs, 'dlmuse', mrid + '_T1_LPS_DLMUSE.nii.gz')
+    img = nib.load(path)
+    data = np.asanyarray(img.dataobj)
+    affine = img.affine.copy()
+    affine[:3, 3] += shift
+    nib.save(nib.Nifti1Image(data[..., np.newaxis] if expand else data, affine), path)
+
+
+def test_4d_dlmuse_map_within_the_grid_tolerance_is_segmented_as_3d(tmp_path, cohort, dlwmls_stub):
+    reference = str(tmp_path / 'reference')
+    run_pipeline(cohort, reference, dlwmls_stub)
+
+    # A single-volume 4D map, its origin off by less than the tolerance preflight allows
+    rewrite_dlmuse(cohort, 'sub000', expand=True, shift=GRID_TOLERANCE / 2)
+    out_dir = str(tmp_path / 'out')
+    log = run_pipeline(cohort, out_dir, dlwmls_stub).stdout
+
+    assert 'excluded' not in log
+    img = segmented(out_dir, 'sub000')
+    assert img.shape == segmented(reference, 'sub000').shape
+    assert np.array_equal(np.asanyarray(img.dataobj), np.asanyarray(segmented(reference, 'sub000').dataobj))
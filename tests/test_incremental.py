@@ -0,0 +1,95 @@
+import os
+
+import nibabel as nib
+import numpy as np
+import pytest
+
+from conftest import dlwmls_calls, run_pipeline, write_dlmuse
+
+
+def segmented(out_dir: str, mrid: str) -> np.ndarray:
+    path = os.path.join(out_dir, 'DLWMLS_DLMUSE_Segmented', mrid + '_DLWMLS_DLMUSE_Segmented.nii.gz')
+    return np.asanyarray(nib.load(path).dataobj)
+
+
+@pytest.mark.parametrize('overlap', ['False', 'True'])
+def test_new_dlmuse_map_does_not_rerun_dlwmls(tmp_path, cohort, dlwmls_stub, overlap):
+    out_dir = str(tmp_path / 'out')
+    run_pipeline(cohort, out_dir, dlwmls_stub, '--incremental', 'True', '--overlap', overlap)
+    assert len(dlwmls_calls(dlwmls_stub)) == 1
+    before = segmented(out_dir, 'sub001')
+
+    # A new DLMUSE map of one subject: every lesion moves to other labels
+    write_dlmuse(cohort, 'sub001', [91, 92, 93, 94, 95, 96, 97, 98])
+    log = run_pipeline(cohort, out_dir, dlwmls_stub, '--incremental', 'True', '--overlap', overlap).stdout
+
+    assert "1 subjects up to date, 1 to process" in log
+    assert len(dlwmls_calls(dlwmls_stub)) == 1
+    after = segmented(out_dir, 'sub001')
+    assert np.array_equal(after != 0, before != 0)
+    assert set(np.unique(after[after != 0])) <= set(range(91, 99))
+
+
+@pytest.mark.parametrize('overlap', ['False', 'True'])
+def test_new_dlmuse_map_does_not_rerun_registration(tmp_path, cohort, dlwmls_stub, overlap):
+    out_dir = str(tmp_path / 'out')
+    run_pipeline(cohort, out_dir, dlwmls_stub, '--incremental', 'True', '--overlap', overlap)
+    transform = os.path.join(out_dir, 'TFMs', 'sub001_FL_to_T1.tfm')
+    registered_at = os.stat(transform).st_mtime_ns
+
+    write_dlmuse(cohort, 'sub001', [91, 92, 93, 94, 95, 96, 97, 98])
+    log = run_pipeline(cohort, out_dir, dlwmls_stub, '--incremental', 'True', '--overlap', overlap).stdout
+
+    assert "Reading transform from " + transform in log
+    assert os.stat(transform).st_mtime_ns == registered_at
+    assert not os.listdir(os.path.join(out_dir, 'FLAIR_LPS'))
+
+
+def test_new_flair_image_reruns_dlwmls_for_that_subject_only(tmp_path, cohort, dlwmls_stub):
+    out_dir = str(tmp_path / 'out')
+    run_pipeline(cohort, out_dir, dlwmls_stub, '--incremental', 'True')
+    os.utime(os.path.join(cohort, 'fl', 'sub000_FL_LPS.nii.gz'))
+    run_pipeline(cohort, out_dir, dlwmls_stub, '--incremental', 'True')
+
+    calls = dlwmls_calls(dlwmls_stub)
+    assert len(calls) == 2
+    assert calls[1] == ['sub000_FL_LPS.nii.gz']
+
+
+@pytest.mark.parametrize('overlap', ['False', 'True'])
+def test_new_t1_image_does_not_rerun_dlwmls(tmp_path, cohort, dlwmls_stub, overlap):
+    out_dir = str(tmp_path / 'out')
+    run_pipeline(cohort, out_dir, dlwmls_stub, '--incremental', 'True', '--overlap', overlap)
+    transform = os.path.join(out_dir, 'TFMs', 'sub000_FL_to_T1.tfm')
+    registered_at = os.stat(transform).st_mtime_ns
+
+    os.utime(os.path.join(cohort, 't1', 'sub000_T1.nii.gz'))
+    log = run_pipeline(cohort, out_dir, dlwmls_stub, '--incremental', 'True', '--overlap', overlap).stdout
+
+    assert "1 subjects up to date, 1 to process" in log
+    assert len(dlwmls_calls(dlwmls_stub)) == 1
+    assert os.stat(transform).st_mtime_ns != registered_at
+    assert segmented(out_dir, 'sub000').any()
+
+
+def test_overlapped_chunks_start_before_every_flair_is_reoriented(tmp_path, cohort, dlwmls_stub):
+    out_dir = str(tmp_path / 'out')
+    run_pipeline(cohort, out_dir, dlwmls_stub, '--overlap', 'True', '--dlwmls_chunk_size', '1')
+
+    calls = dlwmls_calls(dlwmls_stub)
+    assert sorted(calls) == [['sub000_FL_LPS.nii.gz'], ['sub001_FL_LPS.nii.gz']]
+    for mrid in ('sub000', 'sub001'):
+        assert segmented(out_dir, mrid).any()
+
+
+def test_registration_settings_change_reruns_registration_only(tmp_path, cohort, dlwmls_stub):
+    out_dir = str(tmp_path / 'out')
+    run_pipeline(cohort, out_dir, dlwmls_stub, '--incremental', 'True')
+
+    # The thread count does not change the transform
+    log = run_pipeline(cohort, out_dir, dlwmls_stub, '--incremental', 'True', '--reg_threads', '1').stdout
+    assert "2 subjects up to date, 0 to process" in log
+
+    log = run_pipeline(cohort, out_dir, dlwmls_stub, '--incremental', 'True', '--reg_preset', 'fast').stdout
+    assert "0 subjects up to date, 2 to process" in log
+    assert len(dlwmls_calls(dlwmls_stub)) == 1
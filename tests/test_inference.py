@@ -0,0 +1,95 @@
+import os
+import time
+
+import nibabel as nib
+import numpy as np
+import pytest
+
+from conftest import dlwmls_calls, make_subject
+from NiChart_DLWMLS.pipeline import infer_subjects
+
+MRIDS = ['sub000', 'sub001', 'sub002', 'sub003', 'sub004']
+
+
+@pytest.fixture
+def layout(tmp_path, cohort, dlwmls_stub, monkeypatch):
+    """
+    Layout of an inference run on five phantom FLAIR images, with the DLWMLS
+    stand-in on the PATH.
+    """
+    for index, mrid in enumerate(MRIDS[2:], 2):
+        make_subject(cohort, mrid, seed=index)
+    monkeypatch.setenv('PATH', dlwmls_stub['path'] + os.pathsep + os.environ.get('PATH', ''))
+    monkeypatch.setenv('DLWMLS_STUB_LOG', dlwmls_stub['log'])
+    out_dir = tmp_path / 'out'
+    (out_dir / 'DLWMLS').mkdir(parents=True)
+    return {
+        'out_dir': str(out_dir),
+        'flair_lps_dir': os.path.join(cohort, 'fl'),
+        'fl_suff': '_FL_LPS.nii.gz',
+        'dlwmls_dir': str(out_dir / 'DLWMLS'),
+        'dlwmls_suff': '_FL_LPS_DLWMLS.nii.gz',
+    }
+
+
+def masks(layout: dict) -> dict:
+    return {name[:-len(layout['dlwmls_suff'])]: np.asanyarray(nib.load(os.path.join(layout['dlwmls_dir'], name)).dataobj)
+            for name in os.listdir(layout['dlwmls_dir'])}
+
+
+def test_failed_call_is_retried(layout, dlwmls_stub, monkeypatch):
+    monkeypatch.setenv('DLWMLS_STUB_FAIL', '1')
+    assert infer_subjects(MRIDS, layout, 'cpu', retries=1) == []
+    assert len(dlwmls_calls(dlwmls_stub)) == 2
+    assert sorted(masks(layout)) == MRIDS
+    assert not os.path.exists(os.path.join(layout['out_dir'], 'DLWMLS_staging'))
+
+
+@pytest.mark.parametrize('retries', [0, 2])
+def test_non_zero_exit_fails_the_chunk_after_every_retry(layout, dlwmls_stub, monkeypatch, retries):
+    monkeypatch.setenv('DLWMLS_STUB_FAIL', '100')
+    assert infer_subjects(MRIDS, layout, 'cpu', retries=retries) == MRIDS
+    assert len(dlwmls_calls(dlwmls_stub)) == retries + 1
+    assert masks(layout) == {}
+
+
+def test_only_the_failed_chunk_is_lost(layout, dlwmls_stub, monkeypatch):
+    monkeypatch.setenv('DLWMLS_STUB_FAIL', '1')
+    failed = infer_subjects(MRIDS, layout, 'cpu', chunk_size=2, retries=0)
+    assert failed == MRIDS[:2]
+    assert sorted(masks(layout)) == MRIDS[2:]
+
+
+def test_call_past_the_timeout_is_killed(layout, dlwmls_stub, monkeypatch):
+    monkeypatch.setenv('DLWMLS_STUB_DELAY', '30')
+    start = time.monotonic()
+    assert infer_subjects(MRIDS[:2], layout, 'cpu', timeout=0.5, retries=1) == MRIDS[:2]
+    assert time.monotonic() - start < 15
+    assert len(dlwmls_calls(dlwmls_stub)) == 2
+    assert masks(layout) == {}
+
+
+def test_missing_mask_is_retried_alone(layout, dlwmls_stub, monkeypatch):
+    monkeypatch.setenv('DLWMLS_STUB_SKIP', 'sub001_FL_LPS.nii.gz')
+    assert infer_subjects(MRIDS, layout, 'cpu', retries=1) == ['sub001']
+    calls = dlwmls_calls(dlwmls_stub)
+    assert calls == [[m + '_FL_LPS.nii.gz' for m in MRIDS], ['sub001_FL_LPS.nii.gz']]
+    assert sorted(masks(layout)) == [m for m in MRIDS if m != 'sub001']
+
+
+@pytest.mark.parametrize('chunk_size, calls', [(0, 2), (2, 3)])
+def test_workers_merge_into_the_masks_of_a_single_call(layout, dlwmls_stub, chunk_size, calls):
+    assert infer_subjects(MRIDS, layout, 'cpu') == []
+    expected = masks(layout)
+    for name in os.listdir(layout['dlwmls_dir']):
+        os.remove(os.path.join(layout['dlwmls_dir'], name))
+
+    assert infer_subjects(MRIDS, layout, 'cpu', chunk_size=chunk_size, workers=2, threads=1) == []
+
+    worker_calls = dlwmls_calls(dlwmls_stub)[1:]
+    assert len(worker_calls) == calls
+    assert sorted(name for call in worker_calls for name in call) == [m + '_FL_LPS.nii.gz' for m in MRIDS]
+    merged = masks(layout)
+    assert sorted(merged) == MRIDS
+    for mrid in MRIDS:
+        assert np.array_equal(merged[mrid], expected[mrid])
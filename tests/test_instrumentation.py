@@ -0,0 +1,65 @@
+import json
+import os
+import threading
+
+import numpy as np
+import pytest
+
+from conftest import run_pipeline
+from NiChart_DLWMLS import instrumentation
+from NiChart_DLWMLS.instrumentation import configure, load_records, stage, summarize
+
+
+def test_stage_reports_its_own_peak_and_io(tmp_path):
+    configure(records_dir=str(tmp_path / 'records'))
+    try:
+        # A large allocation before the stage is not its peak
+        big = np.ones(64 * 1024 * 1024 // 8)
+        del big
+        data = tmp_path / 'data.bin'
+        data.write_bytes(b'x' * 1024 * 1024)
+
+        def read_in_background() -> None:
+            for _ in range(8):
+                data.read_bytes()
+
+        with stage('load', 'sub000'):
+            reader = threading.Thread(target=read_in_background)
+            reader.start()
+            reader.join()
+            data.read_bytes()
+    finally:
+        configure()
+
+    record, = load_records(str(tmp_path / 'records'))
+    assert record['peak_rss_mb'] < record['process_peak_rss_mb'] - 32
+    # Only the bytes of the stage's own thread
+    assert 1024 * 1024 <= record['read_bytes'] < 2 * 1024 * 1024
+    assert instrumentation._active_stages == 0
+
+
+def test_summary_leaves_out_unknown_measurements():
+    records = [{'stage': 'dlwmls', 'wall_s': 1.0, 'cpu_s': 1.0, 'peak_rss_mb': None,
+                'read_bytes': 0, 'write_bytes': 0}]
+    summary = summarize(records)['dlwmls']
+    assert summary['count'] == 1
+    assert 'peak_rss_mb' not in summary
+    assert summary['wall_s']['total'] == 1.0
+
+
+@pytest.mark.parametrize('overlap', ['False', 'True'])
+def test_register_records_hold_the_registration_metrics(tmp_path, cohort, dlwmls_stub, overlap):
+    out_dir = str(tmp_path / 'out')
+    run_pipeline(cohort, out_dir, dlwmls_stub, '--report', 'True', '--overlap', overlap)
+
+    with open(os.path.join(out_dir, 'run_report.json')) as f:
+        report = json.load(f)
+    registrations = [r for r in report['records'] if r['stage'] == 'register']
+    assert sorted(r['mrid'] for r in registrations) == ['sub000', 'sub001']
+    for record in registrations:
+        assert 0 < record['reg_time_s'] <= record['wall_s']
+        assert record['reg_metric'] < 0 and record['reg_iterations'] > 0
+    assert set(report['summary']['register']) >= {'reg_time_s', 'reg_metric'}
+    assert 'reg_time_s' not in report['summary']['segment']
+    with open(os.path.join(out_dir, 'run_report.csv')) as f:
+        assert 'reg_metric' in f.readline().split(',')
@@ -0,0 +1,98 @@
+import os
+
+import nibabel as nib
+import numpy as np
+import pandas as pd
+import pytest
+import SimpleITK as sitk
+
+from conftest import run_pipeline
+from NiChart_DLWMLS.utils import nifti_suffix, save_nifti, write_image
+
+SHAPE = (20, 18, 16)
+
+
+def gzip_level_flag(path: str) -> int:
+    """
+    The XFL byte of a gzip header: 2 for the smallest level (9), 4 for the fastest (1).
+    """
+    with open(path, 'rb') as f:
+        header = f.read(10)
+    assert header[:2] == b'\x1f\x8b'
+    return header[8]
+
+
+def phantom_image() -> nib.Nifti1Image:
+    data = np.random.default_rng(0).integers(0, 4, SHAPE).astype(np.uint8)
+    affine = np.diag([-1.5, -1.5, 2.0, 1.0])
+    affine[:3, 3] = [10.0, -4.0, 3.0]
+    return nib.Nifti1Image(data, affine)
+
+
+@pytest.mark.parametrize('suffix, ext, expected', [
+    ('_T1.nii.gz', '.nii', '_T1.nii'),
+    ('_T1.nii', '.nii.gz', '_T1.nii.gz'),
+    ('_T1.nii.gz', '.nii.gz', '_T1.nii.gz'),
+    ('_DLWMLS_REG_to_T1', '.nii', '_DLWMLS_REG_to_T1.nii'),
+])
+def test_nifti_suffix_replaces_the_extension(suffix, ext, expected):
+    assert nifti_suffix(suffix, ext) == expected
+
+
+@pytest.mark.parametrize('level, flag', [(1, 4), (9, 2)])
+def test_save_nifti_writes_the_gzip_level(tmp_path, level, flag):
+    img = phantom_image()
+    path = str(tmp_path / 'image.nii.gz')
+    save_nifti(img, path, compresslevel=level)
+
+    assert gzip_level_flag(path) == flag
+    saved = nib.load(path)
+    assert np.array_equal(np.asanyarray(saved.dataobj), img.get_fdata().astype(np.uint8))
+    assert np.allclose(saved.affine, img.affine)
+
+
+@pytest.mark.parametrize('level, flag', [(1, 4), (9, 2)])
+def test_write_image_with_a_level_matches_the_itk_writer(tmp_path, level, flag):
+    default, leveled = str(tmp_path / 'default.nii.gz'), str(tmp_path / 'leveled.nii.gz')
+    nib.save(phantom_image(), str(tmp_path / 'in.nii.gz'))
+    image = sitk.ReadImage(str(tmp_path / 'in.nii.gz'))
+    write_image(image, default)
+    write_image(image, leveled, compresslevel=level)
+
+    assert gzip_level_flag(leveled) == flag
+    expected, written = sitk.ReadImage(default), sitk.ReadImage(leveled)
+    assert np.array_equal(sitk.GetArrayFromImage(written), sitk.GetArrayFromImage(expected))
+    assert np.allclose(written.GetOrigin(), expected.GetOrigin())
+    assert np.allclose(written.GetSpacing(), expected.GetSpacing())
+    assert np.allclose(written.GetDirection(), expected.GetDirection())
+
+
+def test_level_is_ignored_for_uncompressed_images(tmp_path):
+    path = str(tmp_path / 'image.nii')
+    save_nifti(phantom_image(), path, compresslevel=9)
+    with open(path, 'rb') as f:
+        assert f.read(2) != b'\x1f\x8b'
+    # An uncompressed image is memory-mapped on read
+    assert isinstance(nib.load(path).dataobj.get_unscaled(), np.memmap)
+
+
+def test_uncompressed_intermediates_give_the_gzipped_volumes(tmp_path, cohort, dlwmls_stub):
+    gzipped, plain = str(tmp_path / 'gzipped'), str(tmp_path / 'plain')
+    run_pipeline(cohort, gzipped, dlwmls_stub, '--remove_intermediate', 'False',
+                 '--intermediate_compresslevel', '1')
+    run_pipeline(cohort, plain, dlwmls_stub, '--remove_intermediate', 'False',
+                 '--intermediate_ext', '.nii')
+
+    for folder in ('T1_LPS', 'DLWMLS_TFM_to_T1'):
+        names = os.listdir(os.path.join(plain, folder))
+        assert names and all(name.endswith('.nii') for name in names), folder
+        for name in os.listdir(os.path.join(gzipped, folder)):
+            assert gzip_level_flag(os.path.join(gzipped, folder, name)) == 4
+    # FLAIR_LPS and DLWMLS are the DLWMLS input and output and stay gzipped
+    assert all(name.endswith('.nii.gz') for name in os.listdir(os.path.join(plain, 'DLWMLS')))
+
+    tables = [name for name in os.listdir(gzipped) if name.endswith('.csv')]
+    assert 'DLWMLS_DLMUSE_Segmented_Volumes.csv' in tables
+    for name in tables:
+        expected = pd.read_csv(os.path.join(gzipped, name))
+        assert pd.read_csv(os.path.join(plain, name)).equals(expected), name
@@ -0,0 +1,38 @@
+import os
+from typing import Dict
+
+import nibabel as nib
+import numpy as np
+
+from conftest import make_subject, run_pipeline
+
+
+def output_files(out_dir: str) -> Dict[str, str]:
+    """
+    Every file of an output folder, by its path relative to the folder.
+    """
+    files = {}
+    for root, _, names in os.walk(out_dir):
+        for name in names:
+            path = os.path.join(root, name)
+            files[os.path.relpath(path, out_dir)] = path
+    return files
+
+
+def test_worker_pool_gives_the_outputs_of_a_single_process(tmp_path, cohort, dlwmls_stub):
+    make_subject(cohort, 'sub002', seed=2)
+    single, pool = str(tmp_path / 'single'), str(tmp_path / 'pool')
+    run_pipeline(cohort, single, dlwmls_stub, '--jobs', '1')
+    run_pipeline(cohort, pool, dlwmls_stub, '--jobs', '3')
+
+    expected, files = output_files(single), output_files(pool)
+    assert sorted(files) == sorted(expected)
+    assert any(name.endswith('.csv') for name in files)
+    for name, path in files.items():
+        if name.endswith('.nii.gz'):
+            # Compared by content: the gzip header holds the write time
+            assert np.array_equal(np.asanyarray(nib.load(path).dataobj),
+                                  np.asanyarray(nib.load(expected[name]).dataobj)), name
+        else:
+            with open(path, 'rb') as f, open(expected[name], 'rb') as g:
+                assert f.read() == g.read(), name
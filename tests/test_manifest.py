@@ -0,0 +1,164 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import List
+
+import pytest
+
+from NiChart_DLWMLS.manifest import (
+    STAGES,
+    input_path,
+    load_manifest,
+    mark_stage_done,
+    plan_stages,
+    stage_outputs,
+    start_subject,
+    subject_inputs,
+    subject_layout
+)
+
+MRID = 'sub000'
+INPUTS = {'t1': {'size': 1, 'mtime_ns': 1}, 'fl': {'size': 2, 'mtime_ns': 2}, 'dlmuse': {'size': 3, 'mtime_ns': 3}}
+PARAMS = {'version': '1', 'device': 'cpu', 'registration': {'iterations': 100},
+          'dlmuse_suff': '_T1_LPS_DLMUSE.nii.gz', 'composites': None}
+
+
+@pytest.fixture
+def layout(tmp_path):
+    folders = ['t1_lps_dir', 'flair_lps_dir', 'dlwmls_dir', 'tfm_dir', 'dlwmls_tfmed_dir', 'segmented_dir']
+    layout = {name: str(tmp_path / name) for name in folders}
+    for folder in layout.values():
+        os.makedirs(folder)
+    layout.update({
+        'out_dir': str(tmp_path),
+        'manifest': True,
+        't1_lps_suff': '_T1_LPS.nii.gz',
+        'fl_suff': '_FL.nii.gz',
+        'dlwmls_suff': '_FL_DLWMLS.nii.gz',
+        'fl_to_t1_xfm_suff': '_FL_to_T1.tfm',
+        'dlwmls_to_t1_reg_suff': '_DLWMLS_REG_to_T1.nii.gz',
+        'dlwmls_dlmuse_segmented_suff': '_DLWMLS_DLMUSE_Segmented.nii.gz',
+        'dlwmls_roi_volume_csv_suff': '_DLWMLS_DLMUSE_Segmented_Volumes.csv',
+    })
+    return layout
+
+
+def finished_entry(layout: dict, removed: List[str] = ()) -> dict:
+    """
+    Manifest entry of a finished subject whose outputs all exist, except
+    those of the removed stages (e.g. intermediates removed with -r True);
+    'flair_lps' removes only the LPS FLAIR image of the reorient stage.
+    """
+    flair_lps = os.path.join(layout['flair_lps_dir'], MRID + layout['fl_suff'])
+    for stage in STAGES:
+        for path in stage_outputs(MRID, layout, stage):
+            if stage in removed or (path == flair_lps and 'flair_lps' in removed):
+                if os.path.exists(path):
+                    os.remove(path)
+            else:
+                open(path, 'w').close()
+    return {'mrid': MRID, 'inputs': INPUTS, 'params': PARAMS, 'stages': list(STAGES)}
+
+
+def changed(base: dict, key: str, value: object) -> dict:
+    return dict(base, **{key: value})
+
+
+def test_new_subject_runs_every_stage(layout):
+    assert plan_stages({}, INPUTS, PARAMS, layout, MRID) == STAGES
+
+
+def test_finished_subject_is_up_to_date_without_its_intermediates(layout):
+    entry = finished_entry(layout, removed=['reorient', 'dlwmls', 'register', 'apply'])
+    assert plan_stages(entry, INPUTS, PARAMS, layout, MRID) == []
+
+
+@pytest.mark.parametrize('removed, expected', [
+    # Every intermediate kept
+    ([], ['apply', 'segment']),
+    # -r True in incremental mode: LPS T1, DLWMLS mask and transform kept
+    (['flair_lps', 'apply'], ['apply', 'segment']),
+    # Transform removed too: it is redone, from a reoriented FLAIR
+    (['flair_lps', 'register', 'apply'], ['reorient', 'register', 'apply', 'segment']),
+    # DLWMLS mask removed: inference runs again, on the kept LPS FLAIR
+    (['dlwmls', 'apply'], ['dlwmls', 'apply', 'segment']),
+])
+def test_new_dlmuse_map_reruns_only_the_missing_producers(layout, removed, expected):
+    entry = finished_entry(layout, removed=removed)
+    inputs = changed(INPUTS, 'dlmuse', {'size': 3, 'mtime_ns': 4})
+    assert plan_stages(entry, inputs, PARAMS, layout, MRID) == expected
+
+
+@pytest.mark.parametrize('key, value, expected', [
+    ('device', 'cuda', ['dlwmls', 'register', 'apply', 'segment']),
+    ('registration', {'iterations': 50}, ['register', 'apply', 'segment']),
+    ('dlmuse_suff', '_DLMUSE.nii.gz', ['apply', 'segment']),
+    ('composites', 'abc', ['apply', 'segment']),
+    # Parameters without a stage invalidate everything
+    ('version', '2', STAGES),
+])
+def test_changed_parameter_invalidates_its_stage_and_the_later_ones(layout, key, value, expected):
+    entry = finished_entry(layout)
+    assert plan_stages(entry, INPUTS, changed(PARAMS, key, value), layout, MRID) == expected
+
+
+def test_new_flair_image_reruns_every_stage(layout):
+    entry = finished_entry(layout)
+    inputs = changed(INPUTS, 'fl', {'size': 9, 'mtime_ns': 9})
+    assert plan_stages(entry, inputs, PARAMS, layout, MRID) == STAGES
+
+
+@pytest.mark.parametrize('removed', [[], ['flair_lps', 'apply']])
+def test_new_t1_image_keeps_the_dlwmls_mask(layout, removed):
+    entry = finished_entry(layout, removed=removed)
+    inputs = changed(INPUTS, 't1', {'size': 9, 'mtime_ns': 9})
+    assert plan_stages(entry, inputs, PARAMS, layout, MRID) == ['reorient', 'register', 'apply', 'segment']
+
+
+def test_same_content_by_hash_is_not_a_change(layout):
+    entry = finished_entry(layout, removed=['flair_lps', 'apply'])
+    entry['inputs'] = changed(INPUTS, 'dlmuse', {'size': 3, 'mtime_ns': 3, 'sha256': 'a'})
+    touched = changed(INPUTS, 'dlmuse', {'size': 3, 'mtime_ns': 8, 'sha256': 'a'})
+    assert plan_stages(entry, touched, PARAMS, layout, MRID) == []
+
+
+def test_missing_final_output_reruns_the_last_stages(layout):
+    entry = finished_entry(layout)
+    os.remove(stage_outputs(MRID, layout, 'segment')[1])
+    assert plan_stages(entry, INPUTS, PARAMS, layout, MRID) == ['apply', 'segment']
+
+
+def test_start_subject_forgets_only_the_planned_stages(layout):
+    start_subject(layout, MRID, INPUTS, PARAMS, STAGES)
+    for stage in STAGES:
+        mark_stage_done(layout, MRID, stage)
+    start_subject(layout, MRID, INPUTS, PARAMS, ['apply', 'segment'])
+    assert load_manifest(layout, MRID)['stages'] == ['reorient', 'dlwmls', 'register']
+
+
+def test_concurrent_stage_updates_are_all_kept(layout):
+    start_subject(layout, MRID, INPUTS, PARAMS, STAGES)
+    stages = [f'stage_{index}' for index in range(40)]
+    with ProcessPoolExecutor(max_workers=4) as pool:
+        list(pool.map(mark_stage_done, [layout] * len(stages), [MRID] * len(stages), stages))
+    assert sorted(load_manifest(layout, MRID)['stages']) == sorted(stages)
+
+
+def test_inputs_are_taken_from_the_folder_index(layout, tmp_path):
+    (tmp_path / 'other').mkdir()
+    indexed = tmp_path / 'other' / 'sub000_T1.nii.gz'
+    indexed.write_bytes(b't1')
+    layout.update({'t1_dir': str(tmp_path / 't1'), 't1_suff': '_T1.nii.gz',
+                   'fl_dir': str(tmp_path / 'fl'), 'dlmuse_dir': str(tmp_path / 'dlmuse'),
+                   'dlmuse_suff': '_DLMUSE.nii.gz',
+                   'inputs': {'t1': {MRID: str(indexed), 'sub001': 'elsewhere'}, 'fl': {}, 'dlmuse': {}}})
+
+    assert input_path(MRID, layout, 't1') == str(indexed)
+    # Subjects the index does not list fall back to the folder and suffix
+    assert input_path(MRID, layout, 'fl') == os.path.join(layout['fl_dir'], MRID + '_FL.nii.gz')
+    fingerprints = subject_inputs(MRID, layout)
+    assert fingerprints['t1']['size'] == 2
+    assert fingerprints['fl'] == {} and fingerprints['dlmuse'] == {}
+
+    trimmed = subject_layout(layout, MRID)
+    assert trimmed['inputs'] == {'t1': {MRID: str(indexed)}, 'fl': {}, 'dlmuse': {}}
+    assert 'sub001' in layout['inputs']['t1']
@@ -0,0 +1,83 @@
+import threading
+import time
+from typing import List
+
+import numpy as np
+
+from NiChart_DLWMLS.prefetch import Prefetcher, loaded_bytes
+
+
+def load(mrid: str) -> dict:
+    return {'mrid': mrid, 'data': np.zeros(1000)}
+
+
+def test_subject_taken_out_of_order_is_loaded():
+    with Prefetcher(load, ['a', 'b', 'c'], depth=1) as prefetcher:
+        assert prefetcher.get('c')['mrid'] == 'c'
+        assert prefetcher.get('a')['mrid'] == 'a'
+
+
+def test_subject_held_back_by_the_memory_cap_is_loaded():
+    with Prefetcher(load, ['a', 'b', 'c', 'd'], depth=3, max_bytes=1) as prefetcher:
+        for mrid in ['a', 'b', 'c', 'd']:
+            assert prefetcher.get(mrid)['mrid'] == mrid
+
+
+def test_subject_not_in_the_order_is_left_to_the_stage():
+    with Prefetcher(load, ['a'], depth=1) as prefetcher:
+        assert prefetcher.get('x') is None
+        assert prefetcher.get('a')['mrid'] == 'a'
+        assert prefetcher.get('a') is None
+
+
+class RecordingLoad:
+    """
+    A load that records the order subjects are started in, and holds every
+    load until it is released.
+    """
+
+    def __init__(self) -> None:
+        self.started: List[str] = []
+        self.release = threading.Event()
+        self.lock = threading.Lock()
+
+    def __call__(self, mrid: str) -> dict:
+        with self.lock:
+            self.started.append(mrid)
+        self.release.wait(10)
+        return load(mrid)
+
+
+def wait_for(condition, timeout: float = 10.0) -> None:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_subjects_load_in_order_at_most_depth_ahead():
+    recording = RecordingLoad()
+    mrids = ['a', 'b', 'c', 'd', 'e']
+    with Prefetcher(recording, mrids, depth=2, workers=1) as prefetcher:
+        recording.release.set()
+        for mrid in mrids:
+            assert prefetcher.get(mrid)['mrid'] == mrid
+            # Never more than depth subjects started and not taken
+            assert len(recording.started) <= mrids.index(mrid) + 1 + 2
+    assert recording.started == mrids
+
+
+def test_no_new_load_starts_while_the_memory_cap_is_held():
+    recording = RecordingLoad()
+    size = loaded_bytes(load('a'))
+    with Prefetcher(recording, ['a', 'b', 'c', 'd'], depth=3, max_bytes=2 * size) as prefetcher:
+        recording.release.set()
+        wait_for(lambda: prefetcher._held_bytes() == 3 * size)
+
+        # Two subjects (the cap) are still held: 'd' does not start
+        prefetcher.get('a')
+        assert 'd' not in recording.started
+        # One is held: below the cap
+        prefetcher.get('b')
+        wait_for(lambda: 'd' in recording.started)
+        assert [prefetcher.get(m)['mrid'] for m in ['c', 'd']] == ['c', 'd']
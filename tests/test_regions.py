@@ -0,0 +1,96 @@
+import numpy as np
+import pytest
+import SimpleITK as sitk
+
+from NiChart_DLWMLS.utils import (
+    lesion_region,
+    paste_region,
+    read_image_grid,
+    resample_mask,
+    resample_mask_region,
+    sitk_image_affine
+)
+
+
+def image(size, spacing, origin, data=None) -> sitk.Image:
+    img = sitk.GetImageFromArray(np.zeros(size[::-1], np.float32) if data is None else data)
+    img.SetSpacing(spacing)
+    img.SetOrigin(origin)
+    return img
+
+
+def lesion_mask() -> sitk.Image:
+    """
+    FLAIR-space mask with two lesions, on another grid than the T1 image.
+    """
+    data = np.zeros((30, 40, 36), np.float32)
+    data[10:14, 12:20, 5:9] = 1
+    data[20, 30, 25:28] = 1
+    return image((36, 40, 30), (1.1, 0.9, 1.3), (-4.0, 3.0, -2.0), data)
+
+
+TRANSFORMS = {
+    'identity': sitk.Transform(3, sitk.sitkIdentity),
+    'translation': sitk.TranslationTransform(3, (2.3, -1.7, 0.6)),
+    'rotation': sitk.Euler3DTransform((10.0, 15.0, 12.0), 0.1, -0.05, 0.2, (1.0, 0.5, -0.5)),
+    'affine': sitk.AffineTransform((1.05, 0.02, 0.0, -0.03, 0.97, 0.01, 0.0, 0.04, 1.1), (0.5, -1.0, 2.0)),
+}
+
+
+@pytest.mark.parametrize('name', list(TRANSFORMS))
+def test_region_resampling_equals_full_resampling(name):
+    fixed = image((48, 44, 40), (1.0, 1.0, 1.2), (-6.0, -3.0, -8.0))
+    mask = lesion_mask()
+    transform = TRANSFORMS[name]
+
+    full = sitk.GetArrayFromImage(resample_mask(fixed, mask, transform)) != 0
+    region = lesion_region(fixed, mask, transform)
+    assert region is not None
+    pasted = paste_region(fixed, resample_mask_region(fixed, mask, transform, region), region)
+
+    assert full.any()
+    assert np.array_equal(sitk.GetArrayFromImage(pasted) != 0, full)
+    assert np.array_equal(sitk_image_affine(pasted), sitk_image_affine(fixed))
+
+
+def test_lesions_outside_the_fixed_grid_give_no_region():
+    fixed = image((10, 10, 10), (1.0, 1.0, 1.0), (0.0, 0.0, 0.0))
+    transform = sitk.TranslationTransform(3, (-100.0, 0.0, 0.0))
+    assert lesion_region(fixed, lesion_mask(), transform) is None
+    assert lesion_region(fixed, image((5, 5, 5), (1, 1, 1), (0, 0, 0)), TRANSFORMS['identity']) is None
+
+
+def test_image_grid_resamples_like_the_image(tmp_path):
+    path = str(tmp_path / 't1.nii.gz')
+    fixed = image((48, 44, 40), (1.0, 1.0, 1.2), (-6.0, -3.0, -8.0))
+    sitk.WriteImage(fixed, path)
+    fixed = sitk.ReadImage(path, sitk.sitkFloat32)
+    grid = read_image_grid(path)
+    mask, transform = lesion_mask(), TRANSFORMS['rotation']
+
+    region = lesion_region(fixed, mask, transform)
+    assert lesion_region(grid, mask, transform) == region
+    from_image = paste_region(fixed, resample_mask_region(fixed, mask, transform, region), region)
+    from_grid = paste_region(grid, resample_mask_region(grid, mask, transform, region), region)
+    assert np.array_equal(sitk.GetArrayFromImage(from_grid), sitk.GetArrayFromImage(from_image))
+    assert np.array_equal(sitk_image_affine(from_grid), sitk_image_affine(from_image))
+
+
+def test_image_grid_holds_no_voxels_of_the_image(tmp_path):
+    path = str(tmp_path / 't1.nii.gz')
+    fixed = image((48, 44, 40), (1.0, 1.0, 1.2), (-6.0, -3.0, -8.0))
+    fixed.SetDirection((0.0, 1.0, 0.0, -1.0, 0.0, 0.0, 0.0, 0.0, 1.0))
+    sitk.WriteImage(fixed, path)
+    fixed = sitk.ReadImage(path)
+
+    grid = read_image_grid(path)
+
+    assert grid.reference.GetNumberOfPixels() == 1
+    assert grid.GetSize() == fixed.GetSize()
+    assert np.allclose(grid.GetOrigin(), fixed.GetOrigin())
+    assert np.allclose(grid.GetSpacing(), fixed.GetSpacing())
+    assert np.allclose(grid.GetDirection(), fixed.GetDirection())
+    # Indices outside the 1-voxel reference map like those of the image
+    assert np.allclose(grid.TransformIndexToPhysicalPoint((47, 0, 39)), fixed.TransformIndexToPhysicalPoint((47, 0, 39)))
+    point = fixed.TransformIndexToPhysicalPoint((30, 20, 10))
+    assert np.allclose(grid.TransformPhysicalPointToContinuousIndex(point), (30, 20, 10))
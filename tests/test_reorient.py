@@ -0,0 +1,82 @@
+import os
+
+import nibabel as nib
+import numpy as np
+
+from NiChart_DLWMLS.utils import reorient_to_lps
+
+SHAPE = (6, 7, 5)
+
+
+def write_image(path: str, affine: np.ndarray, slope: float = 1.0, inter: float = 0.0) -> np.ndarray:
+    """
+    Writes an int16 image with the given scaling; returns its raw voxel values.
+    """
+    raw = np.arange(np.prod(SHAPE), dtype=np.int16).reshape(SHAPE) - 50
+    img = nib.Nifti1Image(raw, affine)
+    img.header.set_data_dtype(np.int16)
+    img.header.set_slope_inter(slope, inter)
+    nib.save(img, path)
+    return raw
+
+
+def test_reoriented_image_keeps_its_dtype_and_scaling(tmp_path):
+    ras = np.diag([2.0, 1.5, 3.0, 1.0])
+    ras[:3, 3] = [-10.0, 4.0, 2.0]
+    input_path, output_path = str(tmp_path / 'ras.nii.gz'), str(tmp_path / 'lps.nii.gz')
+    write_image(input_path, ras, slope=2.0, inter=-5.0)
+
+    reorient_to_lps(input_path, output_path)
+
+    original, reoriented = nib.load(input_path), nib.load(output_path)
+    assert nib.aff2axcodes(reoriented.affine) == ('L', 'P', 'S')
+    assert reoriented.get_data_dtype() == np.int16
+    assert reoriented.dataobj.slope == 2.0 and reoriented.dataobj.inter == -5.0
+    expected = original.as_reoriented(nib.orientations.axcodes2ornt(('L', 'P', 'S')))
+    assert np.allclose(reoriented.affine, expected.affine)
+    assert np.array_equal(reoriented.get_fdata(), expected.get_fdata())
+    # Same world coordinate, same value
+    point = original.affine @ [1, 2, 3, 1]
+    index = np.rint(np.linalg.inv(reoriented.affine) @ point).astype(int)[:3]
+    assert reoriented.get_fdata()[tuple(index)] == original.get_fdata()[1, 2, 3]
+
+
+def test_lps_image_is_linked_not_reencoded(tmp_path):
+    lps = np.diag([-1.0, -1.0, 1.0, 1.0])
+    input_path, output_path = str(tmp_path / 'in.nii.gz'), str(tmp_path / 'out.nii.gz')
+    write_image(input_path, lps, slope=0.5, inter=1.0)
+
+    reorient_to_lps(input_path, output_path)
+    assert os.path.samefile(input_path, output_path)
+
+
+def test_lps_image_to_another_format_is_reencoded(tmp_path):
+    lps = np.diag([-1.0, -1.0, 1.0, 1.0])
+    input_path, output_path = str(tmp_path / 'in.nii.gz'), str(tmp_path / 'out.nii')
+    write_image(input_path, lps, slope=0.5, inter=1.0)
+
+    reorient_to_lps(input_path, output_path)
+
+    assert not os.path.samefile(input_path, output_path)
+    original, output = nib.load(input_path), nib.load(output_path)
+    assert output.get_data_dtype() == np.int16
+    assert np.array_equal(output.get_fdata(), original.get_fdata())
+
+
+def test_rerun_replaces_a_linked_output_without_writing_through_it(tmp_path):
+    lps = np.diag([-1.0, -1.0, 1.0, 1.0])
+    ras = np.diag([1.0, 1.0, 1.0, 1.0])
+    first, second = str(tmp_path / 'first.nii.gz'), str(tmp_path / 'second.nii.gz')
+    output_path = str(tmp_path / 'out.nii.gz')
+    write_image(first, lps)
+    write_image(second, ras, slope=3.0)
+    reorient_to_lps(first, output_path)
+    with open(first, 'rb') as f:
+        before = f.read()
+
+    reorient_to_lps(second, output_path)
+
+    with open(first, 'rb') as f:
+        assert f.read() == before
+    assert not os.path.samefile(first, output_path)
+    assert nib.load(output_path).dataobj.slope == 3.0
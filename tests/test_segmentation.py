@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+
+from NiChart_DLWMLS.utils import segment_lesions_by_labels
+
+SHAPE = (23, 31, 19)
+# Unordered and sparse, with gaps, a large value and a label without lesion
+LABELS = [604, 4, 47, 31, 2, 1001, 65535, 208]
+
+
+def phantom(seed: int = 0) -> tuple:
+    """
+    A random label map of LABELS (and background) and a lesion mask that
+    misses the last label.
+    """
+    rng = np.random.default_rng(seed)
+    label_map = np.array([0] + LABELS, dtype=np.uint16)[rng.integers(0, len(LABELS) + 1, SHAPE)]
+    lesion_mask = rng.random(SHAPE) < 0.2
+    lesion_mask[label_map == LABELS[-1]] = False
+    lesion_mask[:3] = False
+    return lesion_mask, label_map
+
+
+def loop_segmentation(lesion_mask: np.ndarray, label_map: np.ndarray, voxel_volume: float) -> tuple:
+    """
+    The per-label loop that segment_lesions_by_labels replaces.
+    """
+    data_a = lesion_mask.astype(bool)
+    data_b = label_map.astype(np.uint16)
+    volume_results = {}
+    final_segmented_data = np.zeros_like(data_b, dtype=data_b.dtype)
+    for label in np.unique(data_b[data_b > 0]):
+        intersection_data = data_a & (data_b == label)
+        final_segmented_data[intersection_data] = label
+        volume_results[label] = np.sum(intersection_data) * voxel_volume
+    return final_segmented_data, volume_results
+
+
+@pytest.mark.parametrize('dtype', [np.uint16, np.int32, np.float32])
+def test_bincount_split_equals_the_label_loop(dtype):
+    lesion_mask, label_map = phantom()
+    label_map = label_map.astype(dtype)
+    expected_data, expected_volumes = loop_segmentation(lesion_mask, label_map, 0.75)
+
+    data, volumes = segment_lesions_by_labels(lesion_mask.astype(np.uint8), label_map, 0.75)
+
+    assert data.dtype == np.uint16
+    assert np.array_equal(data, expected_data)
+    assert list(volumes) == list(expected_volumes)
+    assert volumes == expected_volumes
+
+
+def test_lesion_block_equals_the_whole_mask():
+    lesion_mask, label_map = phantom(seed=1)
+    nonzero = np.nonzero(lesion_mask)
+    start = [int(i.min()) for i in nonzero]
+    stop = [int(i.max()) + 1 for i in nonzero]
+    block = lesion_mask[tuple(slice(a, b) for a, b in zip(start, stop))]
+
+    data, volumes = segment_lesions_by_labels(block, label_map, 2.0, offset=tuple(start))
+
+    expected_data, expected_volumes = segment_lesions_by_labels(lesion_mask, label_map, 2.0)
+    assert np.array_equal(data, expected_data)
+    assert volumes == expected_volumes
+    assert volumes[LABELS[-1]] == 0
+
+
+def test_empty_lesion_mask_reports_every_label_at_zero():
+    _, label_map = phantom()
+    data, volumes = segment_lesions_by_labels(np.zeros((0, 0, 0), np.uint8), label_map, 1.0, offset=(0, 0, 0))
+    assert not data.any()
+    assert sorted(volumes) == sorted(LABELS)
+    assert set(volumes.values()) == {0}
@@ -0,0 +1,71 @@
+import os
+
+import numpy as np
+import pytest
+
+from NiChart_DLWMLS.cohort_store import COHORT_STORE_NAME, append_subject, read_index, subject_volume
+from NiChart_DLWMLS.cohort_table import COHORT_TABLE_NAME, append_row, read_table
+from NiChart_DLWMLS.shards import merge_shards, partition, shard_dir
+
+SIZES = {'s0': 900, 's1': 100, 's2': 500, 's3': 400, 's4': 300, 's5': 300, 's6': 50}
+
+
+@pytest.fixture
+def inputs(tmp_path):
+    """
+    FLAIR and T1 inputs of subjects of known total sizes.
+    """
+    index = {'fl': {}, 't1': {}}
+    for mrid, size in SIZES.items():
+        for kind in index:
+            path = tmp_path / f'{mrid}_{kind}.nii.gz'
+            path.write_bytes(b'x' * (size // 2))
+            index[kind][mrid] = str(path)
+    return index
+
+
+def test_partition_is_a_balanced_deterministic_cover(inputs):
+    mrids = list(SIZES)
+    shards = partition(mrids, inputs, 3)
+
+    assert sorted(m for shard in shards for m in shard) == sorted(mrids)
+    for shard in shards:
+        assert shard == [m for m in mrids if m in shard]
+    totals = sorted(sum(SIZES[m] for m in shard) for shard in shards)
+    # Largest first to the smallest shard: 900 | 500+300+50 | 400+300+100
+    assert totals == [800, 850, 900]
+    assert partition(list(reversed(mrids)), inputs, 3) == [list(reversed(s)) for s in shards]
+
+
+def test_partition_into_more_shards_than_subjects(inputs):
+    shards = partition(['s0', 's1'], inputs, 4)
+    assert sorted(len(s) for s in shards) == [0, 0, 1, 1]
+
+
+def test_merge_combines_outputs_tables_and_stores(tmp_path):
+    out_dir = str(tmp_path / 'out')
+    affine = np.eye(4)
+    for index, mrids in enumerate([['s1', 's3'], ['s0', 's2']]):
+        shard = shard_dir(out_dir, index, 2)
+        os.makedirs(os.path.join(shard, 'DLWMLS_DLMUSE_Segmented'))
+        for mrid in mrids:
+            open(os.path.join(shard, 'DLWMLS_DLMUSE_Segmented', mrid + '_DLWMLS_DLMUSE_Segmented.nii.gz'), 'w').close()
+            open(os.path.join(shard, mrid + '_DLWMLS_DLMUSE_Segmented_Volumes.csv'), 'w').close()
+            append_row(os.path.join(shard, COHORT_TABLE_NAME + '.csv'), mrid, {81: float(index + 1)}, [81, 82])
+            lesion = np.zeros((3, 4, 5), np.uint8)
+            lesion[index, 0, 0] = 1
+            append_subject(os.path.join(shard, COHORT_STORE_NAME), mrid, lesion, lesion.astype(np.uint16) * 81, affine)
+
+    result = merge_shards(out_dir, mrids=['s0', 's1', 's2', 's3'])
+
+    assert result['shards'] == 2 and result['subjects'] == 4
+    assert not os.path.exists(os.path.join(out_dir, 'shards'))
+    assert sorted(os.listdir(os.path.join(out_dir, 'DLWMLS_DLMUSE_Segmented'))) == \
+        [m + '_DLWMLS_DLMUSE_Segmented.nii.gz' for m in ['s0', 's1', 's2', 's3']]
+    table = read_table(os.path.join(out_dir, COHORT_TABLE_NAME + '.csv'))
+    assert list(table.index) == ['s0', 's1', 's2', 's3']
+    assert list(table['81']) == [2.0, 1.0, 2.0, 1.0]
+    store = os.path.join(out_dir, COHORT_STORE_NAME)
+    assert sorted(read_index(store)) == ['s0', 's1', 's2', 's3']
+    assert subject_volume(store, 's2', 'lesion')[1, 0, 0] == 1
+    assert subject_volume(store, 's3', 'segmented')[0, 0, 0] == 81
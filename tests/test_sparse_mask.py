@@ -0,0 +1,70 @@
+import os
+
+import nibabel as nib
+import numpy as np
+import pytest
+
+from NiChart_DLWMLS.sparse_mask import (
+    convert_folder,
+    converted_path,
+    decode_runs,
+    encode_runs,
+    load_segmentation,
+    load_sparse,
+    save_sparse
+)
+
+
+def label_image(seed: int = 0) -> np.ndarray:
+    """
+    Sparse uint16 labels with runs that cross rows and change label mid-run.
+    """
+    rng = np.random.default_rng(seed)
+    data = np.zeros((9, 7, 5), dtype=np.uint16)
+    data[rng.random(data.shape) < 0.15] = rng.integers(1, 300, size=1, dtype=np.uint16)
+    data[7:, 2, 1] = 4
+    data[:3, 3, 1] = 4
+    data[2:6, 5, 4] = [11, 11, 12, 12]
+    return data
+
+
+@pytest.mark.parametrize('data', [label_image(0), label_image(1), np.zeros((4, 3, 2), np.uint8),
+                                  np.full((3, 3, 3), 7, np.int16)])
+def test_runs_round_trip(data):
+    starts, lengths, values = encode_runs(data)
+    assert np.array_equal(decode_runs(starts, lengths, values, data.shape, data.dtype), data)
+    assert int(lengths.sum()) == np.count_nonzero(data)
+
+
+def test_sparse_file_rebuilds_the_nifti_file_exactly(tmp_path):
+    affine = np.array([[-1.2, 0, 0, 90], [0, 1.2, 0, -126], [0, 0, 1.5, -72], [0, 0, 0, 1]])
+    header = nib.Nifti1Header()
+    header.set_data_dtype(np.uint16)
+    img = nib.Nifti1Image(label_image(2), affine, header)
+    img.header['descrip'] = b'segmented'
+
+    save_sparse(img, str(tmp_path / 'mask.npz'))
+    copy = load_sparse(str(tmp_path / 'mask.npz'))
+
+    nib.save(img, str(tmp_path / 'source.nii'))
+    nib.save(copy, str(tmp_path / 'copy.nii'))
+    assert (tmp_path / 'source.nii').read_bytes() == (tmp_path / 'copy.nii').read_bytes()
+
+
+def test_folder_conversion_round_trip(tmp_path):
+    folder = tmp_path / 'DLWMLS_DLMUSE_Segmented'
+    folder.mkdir()
+    sources = {}
+    for index in range(3):
+        path = str(folder / f'sub{index:03d}_DLWMLS_DLMUSE_Segmented.nii.gz')
+        nib.save(nib.Nifti1Image(label_image(index), np.eye(4)), path)
+        sources[path] = label_image(index)
+
+    written = convert_folder(str(folder), 'sparse')
+    assert sorted(written) == sorted(converted_path(p, 'sparse') for p in sources)
+    assert all(name.endswith('.npz') for name in os.listdir(folder))
+
+    convert_folder(str(folder), 'nifti')
+    for path, data in sources.items():
+        assert np.array_equal(np.asanyarray(load_segmentation(path).dataobj), data)
+    assert not any(name.endswith('.npz') for name in os.listdir(folder))
@@ -0,0 +1,47 @@
+import os
+import subprocess
+import sys
+from typing import Dict
+
+from conftest import REPO_DIR
+
+# Libraries that only the processing stages may import
+HEAVY_MODULES = ['torch', 'SimpleITK', 'nibabel', 'pandas', 'scipy']
+# Import time budget of the command line (see benchmarks/startup.py)
+BUDGET_MS = 200
+
+
+def help_import_times() -> Dict[str, int]:
+    """
+    Import time (us) of every module `NiChart_DLWMLS --help` imports, from
+    `python -X importtime`; top-level imports are cumulative.
+    """
+    env = dict(os.environ)
+    env['PYTHONPATH'] = REPO_DIR + os.pathsep + env.get('PYTHONPATH', '')
+    completed = subprocess.run([sys.executable, '-X', 'importtime', '-m', 'NiChart_DLWMLS', '--help'],
+                               cwd=REPO_DIR, env=env, stdout=subprocess.DEVNULL,
+                               stderr=subprocess.PIPE, text=True)
+    assert completed.returncode == 0, completed.stderr[-3000:]
+    times = {}
+    for line in completed.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # After the separator's space, nested imports are indented below
+        # the module that imports them
+        times[name[1:].rstrip()] = int(cumulative)
+    return times
+
+
+def test_help_imports_no_heavy_library():
+    modules = {name.strip().split('.')[0] for name in help_import_times()}
+    assert not modules & set(HEAVY_MODULES)
+
+
+def test_help_imports_within_budget():
+    # Best of three runs, to ride out a busy machine
+    totals = []
+    for _ in range(3):
+        times = help_import_times()
+        totals.append(sum(t for name, t in times.items() if not name.startswith(' ')) / 1000.0)
+    assert 0 < min(totals) <= BUDGET_MS
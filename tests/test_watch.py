@@ -0,0 +1,68 @@
+import os
+import time
+
+import pytest
+
+from NiChart_DLWMLS.watch import input_signature, ready_subjects
+
+SETTLE = 60.0
+
+
+@pytest.fixture
+def inputs(tmp_path):
+    """
+    Input index of two subjects whose files were last written an hour ago.
+    """
+    index = {'fl': {}, 't1': {}}
+    old = time.time() - 3600
+    for mrid in ['sub000', 'sub001']:
+        for kind in index:
+            path = tmp_path / f'{mrid}_{kind}.nii.gz'
+            path.write_bytes(b'x')
+            os.utime(path, (old, old))
+            index[kind][mrid] = str(path)
+    return index
+
+
+def test_quiet_complete_subjects_are_ready(inputs):
+    assert ready_subjects(['sub001', 'sub000'], inputs, {}, {}, SETTLE) == ['sub001', 'sub000']
+
+
+def test_subject_being_written_waits_until_it_settles(inputs):
+    with open(inputs['fl']['sub000'], 'ab') as f:
+        f.write(b'more')
+    seen = {}
+    assert ready_subjects(['sub000', 'sub001'], inputs, seen, {}, SETTLE) == ['sub001']
+
+    # Unchanged since it was first seen, for the settle time by our own clock
+    signature, _ = seen['sub000']
+    seen['sub000'] = (signature, time.time_ns() - int(SETTLE * 1e9))
+    assert ready_subjects(['sub000'], inputs, seen, {}, SETTLE) == ['sub000']
+
+
+def test_change_restarts_the_settle_time(inputs):
+    seen = {}
+    assert ready_subjects(['sub000'], inputs, seen, {}, SETTLE) == ['sub000']
+    seen['sub000'] = (seen['sub000'][0], time.time_ns() - int(SETTLE * 1e9))
+    with open(inputs['t1']['sub000'], 'ab') as f:
+        f.write(b'more')
+    assert ready_subjects(['sub000'], inputs, seen, {}, SETTLE) == []
+
+
+def test_handled_subject_is_ready_again_only_for_new_inputs(inputs):
+    handled = {'sub000': input_signature('sub000', inputs)}
+    assert ready_subjects(['sub000', 'sub001'], inputs, {}, handled, SETTLE) == ['sub001']
+
+    new = time.time() - 1800
+    os.utime(inputs['fl']['sub000'], (new, new))
+    assert ready_subjects(['sub000'], inputs, {}, handled, SETTLE) == ['sub000']
+
+
+def test_subject_with_a_missing_input_is_not_ready(inputs):
+    seen = {}
+    ready_subjects(['sub000'], inputs, seen, {}, SETTLE)
+    os.remove(inputs['t1']['sub000'])
+    assert ready_subjects(['sub000'], inputs, seen, {}, SETTLE) == []
+    assert 'sub000' not in seen
+    del inputs['t1']['sub001']
+    assert ready_subjects(['sub001'], inputs, seen, {}, SETTLE) == []